@@ -0,0 +1,139 @@
+# coding: utf-8
+
+import argparse
+import json
+import os
+import threading
+import time
+import numpy as np
+import torch
+
+import warnings
+warnings.filterwarnings("ignore")
+
+from inference import get_device, load_model
+from utils import demix, is_oom_error, measure_peak_rss, get_device_name, get_tuning_key, load_tuning_profiles, TUNING_PROFILES_PATH
+
+
+def run_trial(model, config, device, model_type, mix, batch_size, num_overlap):
+    # Returns (elapsed seconds, peak memory bytes) of one separation, None on out of memory
+    config.inference.batch_size = batch_size
+    config.inference.num_overlap = num_overlap
+    is_cuda = str(device).startswith('cuda')
+    if is_cuda:
+        torch.cuda.synchronize(device)
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+        base_memory = torch.cuda.memory_allocated(device)
+    else:
+        import psutil
+        base_memory = psutil.Process().memory_info().rss
+        stop = threading.Event()
+        peak = [base_memory]
+        thread = threading.Thread(target=measure_peak_rss, args=(stop, peak), daemon=True)
+        thread.start()
+
+    start_time = time.time()
+    try:
+        # Without OOM recovery the trial fails instead of running a smaller batch than batch_size
+        demix(config, model, mix, device, model_type=model_type, oom_recovery=False)
+        if is_cuda:
+            torch.cuda.synchronize(device)
+    except Exception as e:
+        if not is_oom_error(e):
+            raise
+        return None
+    finally:
+        if not is_cuda:
+            stop.set()
+            thread.join()
+    elapsed = time.time() - start_time
+
+    if is_cuda:
+        peak_memory = torch.cuda.max_memory_allocated(device) - base_memory
+    else:
+        peak_memory = peak[0] - base_memory
+    return elapsed, peak_memory
+
+
+def autotune(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_type", type=str, default='mdx23c', help="One of bandit, bandit_v2, bs_roformer, htdemucs, mdx23c, mel_band_roformer, scnet, scnet_unofficial, segm_models, swin_upernet, torchseg")
+    parser.add_argument("--config_path", type=str, help="path to config file")
+    parser.add_argument("--start_check_point", type=str, default='', help="Initial checkpoint to valid weights (speed doesn't depend on weights, random init is fine)")
+    parser.add_argument("--device_ids", nargs='+', type=int, default=0, help='list of gpu ids')
+    parser.add_argument("--force_cpu", action='store_true', help="Force the use of CPU even if CUDA is available")
+    parser.add_argument("--seconds", type=float, default=30, help="length of the synthetic test signal")
+    parser.add_argument("--batch_sizes", nargs='+', type=int, default=[1, 2, 4, 8, 16], help="batch sizes to try, larger ones are skipped after running out of memory")
+    parser.add_argument("--overlaps", nargs='+', type=int, default=None, help="num_overlap values to tune for (default: the one from config)")
+    parser.add_argument("--cpu_threads", nargs='+', type=int, default=None, help="numbers of CPU threads to try on CPU (default: torch default, half and all logical cores)")
+    parser.add_argument("--max_memory_gb", type=float, default=None, help="skip settings with higher peak memory")
+    parser.add_argument("--profiles_path", type=str, default=TUNING_PROFILES_PATH, help="where tuning profiles are stored")
+    if args is None:
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args(args)
+    # load_model expects the inference.py arguments
+    args.use_tta = False
+
+    device = get_device(args)
+    model, config = load_model(args, device)
+    model.eval()
+
+    sr = 44100
+    rng = np.random.default_rng(0)
+    mix = (rng.standard_normal((2, int(args.seconds * sr))) * 0.1).astype(np.float32)
+    overlaps = args.overlaps if args.overlaps is not None else [config.inference.num_overlap]
+    thread_counts = [None]
+    if str(device) == 'cpu':
+        thread_counts = args.cpu_threads
+        if thread_counts is None:
+            thread_counts = sorted({torch.get_num_threads(), max(os.cpu_count() // 2, 1), os.cpu_count()})
+    max_memory = None if args.max_memory_gb is None else args.max_memory_gb * 1024 ** 3
+
+    # Warm up (cudnn benchmark, allocator) so the first trial isn't slower for other reasons
+    run_trial(model, config, device, args.model_type, mix[:, :sr * 5], args.batch_sizes[0], overlaps[0])
+
+    results = []
+    for num_threads in thread_counts:
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        for num_overlap in overlaps:
+            for batch_size in args.batch_sizes:
+                trial = run_trial(model, config, device, args.model_type, mix, batch_size, num_overlap)
+                if trial is None:
+                    print('Threads: {} Overlap: {} Batch size: {:3d} Out of memory'.format(num_threads, num_overlap, batch_size))
+                    break
+                elapsed, peak_memory = trial
+                fits = max_memory is None or peak_memory <= max_memory
+                print('Threads: {} Overlap: {} Batch size: {:3d} Speed: {:.2f}x realtime Peak memory: {:.2f} GB{}'.format(
+                    num_threads, num_overlap, batch_size, args.seconds / elapsed, peak_memory / 1024 ** 3, '' if fits else ' (over limit)'))
+                if not fits:
+                    break
+                results.append({'num_threads': num_threads, 'num_overlap': num_overlap, 'batch_size': batch_size,
+                                'speed': args.seconds / elapsed, 'peak_memory': peak_memory})
+
+    if len(results) == 0:
+        print('No setting fits, profile is not written')
+        return None
+
+    # Fastest thread count overall, then the fastest batch size for every overlap with it
+    best = max(results, key=lambda x: x['speed'])
+    profile = {'batch_size': dict(), 'num_threads': best['num_threads'], 'device_name': get_device_name(device),
+               'seconds': args.seconds, 'results': results}
+    for num_overlap in overlaps:
+        candidates = [r for r in results if r['num_overlap'] == num_overlap and r['num_threads'] == best['num_threads']]
+        if len(candidates) > 0:
+            profile['batch_size'][str(num_overlap)] = max(candidates, key=lambda x: x['speed'])['batch_size']
+    print('Tuned: batch_size {} num_threads {}'.format(profile['batch_size'], profile['num_threads']))
+
+    profiles = load_tuning_profiles(args.profiles_path)
+    profiles[get_tuning_key(args.model_type, args.config_path, device)] = profile
+    with open(args.profiles_path, 'w') as f:
+        json.dump(profiles, f, indent=2)
+    print('Profile saved to {}, inference.py uses it for this config on this device'.format(args.profiles_path))
+    return profile
+
+
+if __name__ == "__main__":
+    autotune(None)
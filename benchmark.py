@@ -0,0 +1,232 @@
+# coding: utf-8
+
+# Speed benchmark of all model types with random weights (no checkpoints needed), e.g.
+#   python benchmark.py --lengths 10 60 --output_json bench.json --output_csv bench.csv
+# Every config runs in its own process, so import time and peak memory aren't
+# shared between models.
+
+import argparse
+import csv
+import glob
+import importlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+
+# Config file name part -> model_type, checked in this order
+CONFIG_MODEL_TYPES = [
+    ('mel_band_roformer', 'mel_band_roformer'),
+    ('bs_roformer', 'bs_roformer'),
+    ('bs_mamba2', 'bs_mamba2'),
+    ('scnet_unofficial', 'scnet_unofficial'),
+    ('scnet', 'scnet'),
+    ('bandit_v2', 'bandit_v2'),
+    ('bandit', 'bandit'),
+    ('htdemucs', 'htdemucs'),
+    ('demucs', 'htdemucs'),
+    ('drumsep', 'htdemucs'),
+    ('mdx23c', 'mdx23c'),
+    ('segm_models', 'segm_models'),
+    ('torchseg', 'torchseg'),
+    ('swin_upernet', 'swin_upernet'),
+    ('apollo', 'apollo'),
+]
+
+# Modules imported by utils.get_model_from_config for every model_type
+MODEL_MODULES = {
+    'mdx23c': 'models.mdx23c_tfc_tdf_v3',
+    'htdemucs': 'models.demucs4ht',
+    'segm_models': 'models.segm_models',
+    'torchseg': 'models.torchseg_models',
+    'mel_band_roformer': 'models.bs_roformer',
+    'bs_roformer': 'models.bs_roformer',
+    'swin_upernet': 'models.upernet_swin_transformers',
+    'bandit': 'models.bandit.core.model',
+    'bandit_v2': 'models.bandit_v2.bandit',
+    'scnet_unofficial': 'models.scnet_unofficial',
+    'scnet': 'models.scnet',
+    'apollo': 'models.look2hear.models',
+    'bs_mamba2': 'models.ts_bs_mamba2',
+}
+
+CSV_FIELDS = ['model_type', 'config_path', 'device', 'length_sec', 'elapsed', 'rtf', 'chunks', 'chunks_per_sec',
+              'peak_rss_mb', 'peak_vram_mb', 'construct_time', 'import_time', 'num_params', 'error']
+
+
+def get_model_type(config_path):
+    name = os.path.basename(config_path)
+    for part, model_type in CONFIG_MODEL_TYPES:
+        if part in name:
+            return model_type
+    return None
+
+
+def benchmark_config(model_type, config_path, lengths, force_cpu=False, device_ids=0, batch_size=None):
+    # Runs in a separate process, imports are timed so they are done here and not at the top
+    start_time = time.time()
+    import torch
+    from utils import get_model_from_config, demix, measure_peak_rss
+    importlib.import_module(MODEL_MODULES[model_type])
+    import_time = time.time() - start_time
+
+    stop = threading.Event()
+    peak = [0]
+    thread = threading.Thread(target=measure_peak_rss, args=(stop, peak), daemon=True)
+    thread.start()
+
+    device = 'cpu'
+    if not force_cpu and torch.cuda.is_available():
+        device = 'cuda:{}'.format(device_ids[0] if type(device_ids) == list else device_ids)
+    elif not force_cpu and torch.backends.mps.is_available():
+        device = 'mps'
+
+    start_time = time.time()
+    model, config = get_model_from_config(model_type, config_path)
+    model = model.to(device).eval()
+    construct_time = time.time() - start_time
+    if batch_size is not None:
+        config.inference.batch_size = batch_size
+    num_params = sum(p.numel() for p in model.parameters())
+
+    # Count chunks actually run through the model
+    chunks = [0]
+    model.register_forward_pre_hook(lambda module, inputs: chunks.__setitem__(0, chunks[0] + inputs[0].shape[0]))
+
+    sr = 44100
+    if model_type == 'htdemucs':
+        sr = config.training.samplerate
+    elif 'sample_rate' in config.audio:
+        sr = config.audio.sample_rate
+    channels = 2
+    if 'num_channels' in config.audio:
+        channels = config.audio.num_channels
+    rng = np.random.default_rng(0)
+
+    # Warm up, so lazy initialization (cudnn benchmark, allocator) isn't counted for the first length
+    demix(config, model, (rng.standard_normal((channels, sr)) * 0.1).astype(np.float32), device, model_type=model_type)
+
+    results = []
+    for length in lengths:
+        mix = (rng.standard_normal((channels, int(length * sr))) * 0.1).astype(np.float32)
+        chunks[0] = 0
+        if device.startswith('cuda'):
+            torch.cuda.synchronize()
+        start_time = time.time()
+        demix(config, model, mix, device, model_type=model_type)
+        if device.startswith('cuda'):
+            torch.cuda.synchronize()
+        elapsed = time.time() - start_time
+        results.append({
+            'model_type': model_type,
+            'config_path': config_path,
+            'device': device,
+            'length_sec': length,
+            'elapsed': elapsed,
+            'rtf': elapsed / length,
+            'chunks': chunks[0],
+            'chunks_per_sec': chunks[0] / elapsed,
+            'construct_time': construct_time,
+            'import_time': import_time,
+            'num_params': num_params,
+        })
+
+    stop.set()
+    thread.join()
+    for result in results:
+        # Peak of the whole process, the longest length dominates it
+        result['peak_rss_mb'] = peak[0] / 1024 ** 2
+        if device.startswith('cuda'):
+            result['peak_vram_mb'] = torch.cuda.max_memory_allocated() / 1024 ** 2
+    return results
+
+
+def run_benchmark_process(model_type, config_path, args):
+    # Run from the repository folder, so models package is importable
+    command = [sys.executable, os.path.abspath(__file__), '--model_type', model_type, '--config_path', os.path.abspath(config_path),
+               '--lengths'] + [str(length) for length in args.lengths]
+    if args.force_cpu:
+        command.append('--force_cpu')
+    if args.batch_size is not None:
+        command += ['--batch_size', str(args.batch_size)]
+    if type(args.device_ids) == list:
+        command += ['--device_ids'] + [str(device_id) for device_id in args.device_ids]
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), timeout=args.timeout)
+    for line in process.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    lines = [line for line in process.stdout.splitlines() if line.strip() != '']
+    error = lines[-1] if len(lines) > 0 else 'exit code {}'.format(process.returncode)
+    return [{'model_type': model_type, 'config_path': config_path, 'error': error}]
+
+
+def benchmark(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--configs", nargs='+', type=str, default=None, help="config files to benchmark (default: all in configs/)")
+    parser.add_argument("--model_types", nargs='+', type=str, default=None, help="only benchmark these model types")
+    parser.add_argument("--model_type", type=str, default=None, help="benchmark --config_path with this model type in this process")
+    parser.add_argument("--config_path", type=str, default=None, help="config for --model_type")
+    parser.add_argument("--lengths", nargs='+', type=float, default=[10, 60], help="lengths of synthetic audio in seconds")
+    parser.add_argument("--batch_size", type=int, default=None, help="override inference.batch_size of configs")
+    parser.add_argument("--device_ids", nargs='+', type=int, default=0, help='list of gpu ids')
+    parser.add_argument("--force_cpu", action='store_true', help="Force the use of CPU even if CUDA is available")
+    parser.add_argument("--timeout", type=float, default=3600, help="max time for one config in seconds")
+    parser.add_argument("--output_json", type=str, default=None, help="save results to json file")
+    parser.add_argument("--output_csv", type=str, default=None, help="save results to csv file")
+    if args is None:
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args(args)
+
+    if args.model_type is not None:
+        results = benchmark_config(args.model_type, args.config_path, args.lengths, force_cpu=args.force_cpu,
+                                   device_ids=args.device_ids, batch_size=args.batch_size)
+        print(RESULT_PREFIX + json.dumps(results))
+        return results
+
+    config_paths = args.configs
+    if config_paths is None:
+        root = os.path.dirname(os.path.abspath(__file__))
+        config_paths = sorted(glob.glob(os.path.join(root, 'configs', '**', '*.yaml'), recursive=True))
+
+    results = []
+    for config_path in config_paths:
+        model_type = get_model_type(config_path)
+        if model_type is None:
+            print('Skip config with unknown model type: {}'.format(config_path))
+            continue
+        if args.model_types is not None and model_type not in args.model_types:
+            continue
+        print('Benchmark {} ({})'.format(config_path, model_type))
+        try:
+            config_results = run_benchmark_process(model_type, config_path, args)
+        except subprocess.TimeoutExpired:
+            config_results = [{'model_type': model_type, 'config_path': config_path, 'error': 'timeout'}]
+        for result in config_results:
+            if 'error' in result:
+                print('  Failed: {}'.format(result['error']))
+            else:
+                print('  {:.0f} sec: RTF {:.3f} Chunks/sec {:.2f} Peak RSS {:.0f} MB Construct {:.2f} sec Import {:.2f} sec'.format(
+                    result['length_sec'], result['rtf'], result['chunks_per_sec'], result['peak_rss_mb'],
+                    result['construct_time'], result['import_time']))
+        results += config_results
+
+    if args.output_json is not None:
+        with open(args.output_json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.output_csv is not None:
+        with open(args.output_csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(results)
+    return results
+
+
+if __name__ == "__main__":
+    benchmark(None)
@@ -0,0 +1,71 @@
+# coding: utf-8
+
+import argparse
+import glob
+import os
+import time
+import torch
+
+from utils import get_state_dict
+
+
+def convert_checkpoint(checkpoint_path, overwrite=False):
+    """
+    Saves the weights of a .ckpt/.pth/.th checkpoint as .safetensors next to it. Loading code
+    (utils.load_state_dict_file) picks up the converted file automatically.
+    """
+    from safetensors.torch import save_file
+
+    output_path = os.path.splitext(checkpoint_path)[0] + '.safetensors'
+    if os.path.isfile(output_path) and not overwrite:
+        print('Skip, already converted: {}'.format(checkpoint_path))
+        return output_path
+
+    start_time = time.time()
+    try:
+        checkpoint = torch.load(checkpoint_path, map_location='cpu', weights_only=True)
+    except Exception:
+        # htdemucs and apollo checkpoints also pickle training state, same as inference.py loads them
+        checkpoint = torch.load(checkpoint_path, map_location='cpu', weights_only=False)
+    state_dict = get_state_dict(checkpoint)
+
+    tensors = dict()
+    for name, value in state_dict.items():
+        if not isinstance(value, torch.Tensor):
+            print('Skip not tensor entry: {}'.format(name))
+            continue
+        # safetensors can't store views or tensors sharing memory
+        tensors[name] = value.detach().clone().contiguous()
+    save_file(tensors, output_path)
+    print('Converted: {} -> {} ({:.2f} sec)'.format(checkpoint_path, output_path, time.time() - start_time))
+    return output_path
+
+
+def convert_checkpoints(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, default='pretrain', help="checkpoint file or folder with checkpoints to convert")
+    parser.add_argument("--overwrite", action='store_true', help="convert again if .safetensors file already exists")
+    if args is None:
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args(args)
+
+    if os.path.isdir(args.input):
+        paths = []
+        for ext in ['ckpt', 'pth', 'th']:
+            paths += glob.glob(os.path.join(args.input, '*.{}'.format(ext)))
+        paths.sort()
+    else:
+        paths = [args.input]
+    print('Checkpoints found: {}'.format(len(paths)))
+
+    for path in paths:
+        try:
+            convert_checkpoint(path, overwrite=args.overwrite)
+        except Exception as e:
+            print('Cannot convert checkpoint: {}'.format(path))
+            print('Error message: {}'.format(str(e)))
+
+
+if __name__ == "__main__":
+    convert_checkpoints(None)
@@ -34,41 +34,261 @@ def load_chunk(path, length, chunk_size, offset=None):
     return x.T
 
 
-def get_track_set_length(params):
-    path, instruments, file_types = params
-    # Check lengths of all instruments (it can be different in some cases)
-    lengths_arr = []
-    for instr in instruments:
-        length = -1
-        for extension in file_types:
-            path_to_audio_file = path + '/{}.{}'.format(instr, extension)
-            if os.path.isfile(path_to_audio_file):
-                length = len(sf.read(path_to_audio_file)[0])
-                break
-        if length == -1:
-            print('Cant find file "{}" in folder {}'.format(instr, path))
+# Metadata index: sqlite database with audio file info, entries are valid while path, mtime and size are the same
+SILENCE_DB = -60  # blocks quieter than this count as silence in silence_ratio
+STATS_BLOCK_SIZE = 4096  # also frame size of activity envelopes
+
+
+def get_activity_envelope(x):
+    # Mean abs of every STATS_BLOCK_SIZE frames of (frames, channels) audio, the same measure as min_mean_abs of chunks
+    blocks = int(np.ceil(len(x) / STATS_BLOCK_SIZE))
+    padded = np.zeros((blocks * STATS_BLOCK_SIZE, x.shape[1]), dtype=np.float32)
+    padded[:len(x)] = np.abs(x)
+    return padded.reshape(blocks, -1).mean(axis=1).astype(np.float16)
+
+
+def get_active_offsets(envelope, length, chunk_size, min_mean_abs):
+    """
+    Mask of activity envelope blocks: True if chunk starting at the block is not quiet (mean abs of its
+    whole blocks >= min_mean_abs). Chunks longer than the track are padded with zeros, so the only
+    offset 0 is checked against the mean of the whole track
+    """
+    if chunk_size > length:
+        return np.array([envelope.astype(np.float64).sum() * STATS_BLOCK_SIZE / chunk_size >= min_mean_abs])
+    chunk_blocks = max(chunk_size // STATS_BLOCK_SIZE, 1)
+    offsets = (length - chunk_size) // STATS_BLOCK_SIZE + 1
+    cumsum = np.concatenate([[0.], np.cumsum(envelope, dtype=np.float64)])
+    if len(cumsum) < offsets + chunk_blocks:
+        cumsum = np.concatenate([cumsum, np.full(offsets + chunk_blocks - len(cumsum), cumsum[-1])])
+    means = (cumsum[chunk_blocks:offsets + chunk_blocks] - cumsum[:offsets]) / chunk_blocks
+    return means >= min_mean_abs
+
+
+def read_audio_info(params):
+    # Row of metadata index for one file. Length is read from the header, rms, silence_ratio and
+    # activity envelope need to decode the whole file, so they are computed only with_stats
+    path, with_stats = params
+    stat = os.stat(path)
+    info = sf.info(path)
+    row = {
+        'path': path,
+        'mtime': stat.st_mtime,
+        'size': stat.st_size,
+        'frames': info.frames,
+        'samplerate': info.samplerate,
+        'channels': info.channels,
+        'rms': None,
+        'silence_ratio': None,
+        'activity': None,
+    }
+    if with_stats:
+        sum_squares = 0.
+        silent_blocks = 0
+        envelope = []
+        for block in sf.blocks(path, blocksize=STATS_BLOCK_SIZE, dtype='float32', always_2d=True):
+            block_squares = float(np.square(block, dtype=np.float64).sum())
+            sum_squares += block_squares
+            block_rms = np.sqrt(block_squares / block.size)
+            silent_blocks += int(20 * np.log10(block_rms + 1e-10) < SILENCE_DB)
+            envelope.append(get_activity_envelope(block)[0])
+        row['rms'] = float(np.sqrt(sum_squares / max(info.frames * info.channels, 1)))
+        row['silence_ratio'] = silent_blocks / max(len(envelope), 1)
+        row['activity'] = np.array(envelope, dtype=np.float16).tobytes()
+    return row
+
+
+def update_metadata_index(index_path, paths, with_stats=False, procs=1, verbose=True):
+    """
+    Returns {path: row} for all paths, reads only files which are new or changed since the last run
+    (or have no stats yet, if with_stats). Files which can't be read are missing in result.
+    row['activity'] is float16 activity envelope as bytes (get_activity_envelope)
+    """
+    import sqlite3
+
+    columns = ['path', 'mtime', 'size', 'frames', 'samplerate', 'channels', 'rms', 'silence_ratio', 'activity']
+    connection = sqlite3.connect(index_path, timeout=60)
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, frames INTEGER, '
+        'samplerate INTEGER, channels INTEGER, rms REAL, silence_ratio REAL, activity BLOB)'
+    )
+    # Index made before activity envelopes were added
+    if 'activity' not in [values[1] for values in connection.execute('PRAGMA table_info(files)')]:
+        connection.execute('ALTER TABLE files ADD COLUMN activity BLOB')
+    rows = dict()
+    for values in connection.execute('SELECT {} FROM files'.format(', '.join(columns))):
+        rows[values[0]] = dict(zip(columns, values))
+
+    result = dict()
+    to_read = []
+    for path in paths:
+        row = rows.get(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            print('Cant find track: {}'.format(path))
             continue
-        lengths_arr.append(length)
-    lengths_arr = np.array(lengths_arr)
-    if lengths_arr.min() != lengths_arr.max():
-        print('Warning: lengths of stems are different for path: {}. ({} != {})'.format(
-            path,
-            lengths_arr.min(),
-            lengths_arr.max())
-        )
-    # We use minimum to allow overflow for soundfile read in non-equal length cases
-    return path, lengths_arr.min()
+        if row is not None and row['mtime'] == stat.st_mtime and row['size'] == stat.st_size and (not with_stats or row['activity'] is not None):
+            result[path] = row
+        else:
+            to_read.append(path)
 
+    if verbose:
+        print('Metadata index {}: {} files up to date, {} to read'.format(index_path, len(result), len(to_read)))
+    new_rows = []
+    if len(to_read) > 0:
+        params = zip(to_read, itertools.repeat(with_stats))
+        if procs <= 1:
+            iterator = map(safe_read_audio_info, params)
+        else:
+            p = multiprocessing.Pool(processes=procs)
+            iterator = p.imap(safe_read_audio_info, params)
+        for row in tqdm(iterator, total=len(to_read), disable=not verbose):
+            if row is not None:
+                new_rows.append(row)
+                result[row['path']] = row
+        if procs > 1:
+            p.close()
+
+    connection.executemany(
+        'INSERT OR REPLACE INTO files ({}) VALUES ({})'.format(', '.join(columns), ', '.join(['?'] * len(columns))),
+        [[row[c] for c in columns] for row in new_rows]
+    )
+    connection.commit()
+    connection.close()
+    return result
+
+
+def safe_read_audio_info(params):
+    try:
+        return read_audio_info(params)
+    except Exception as e:
+        print('Problem with path: {} ({})'.format(params[0], e))
+        return None
+
+
+# Packed dataset (pack_dataset.py): all stems decoded to one memory-mapped array of shape (frames, 2)
+PACKED_AUDIO = 'packed_audio.bin'
+PACKED_INDEX = 'packed_index.pkl'
+
+
+def get_packed_path(data_path):
+    # Folder with packed dataset or None if data_path is a usual dataset
+    paths = data_path if type(data_path) == list else [data_path]
+    packed = [path for path in paths if os.path.isfile(os.path.join(path, PACKED_INDEX))]
+    if len(packed) == 0:
+        return None
+    if len(paths) > 1:
+        print('Packed dataset must be the only data path, got: {}'.format(paths))
+        exit()
+    return packed[0]
+
+
+def load_packed_chunk(audio, offset, length, chunk_size, scale=1.0, chunk_offset=None):
+    # The same as load_chunk, but slices stem stored at offset in packed audio. offset -1 - missing stem
+    if offset < 0:
+        return np.zeros((2, chunk_size), dtype=np.float32)
+    if chunk_size <= length:
+        if chunk_offset is None:
+            chunk_offset = np.random.randint(length - chunk_size + 1)
+        start = offset + chunk_offset
+        x = audio[start:start + chunk_size].astype(np.float32)
+    else:
+        x = np.zeros((chunk_size, 2), dtype=np.float32)
+        x[:length] = audio[offset:offset + length]
+    if scale != 1.0:
+        x *= scale
+    return x.T
 
-# For multiprocessing
-def get_track_length(params):
-    path = params
-    length = len(sf.read(path)[0])
-    return (path, length)
+
+# Stem augmentations which MSSDataset.augment_batch applies to whole batches on the training device
+# (augmentations.on_device), instead of augm_data in DataLoader workers
+DEVICE_AUGMENTATIONS = ['channel_shuffle', 'random_inverse', 'random_polarity', 'seven_band_parametric_eq', 'gaussian_noise']
+# Filters of AU.SevenBandParametricEQ: type, range of center frequency in Hz
+EQ_BANDS = [
+    ('low_shelf', 42., 95.),
+    ('peaking', 91., 204.),
+    ('peaking', 196., 441.),
+    ('peaking', 421., 948.),
+    ('peaking', 909., 2045.),
+    ('peaking', 1957., 4404.),
+    ('high_shelf', 4216., 9486.),
+]
+
+
+def random_uniform(n, low, high, device):
+    return torch.empty(n, dtype=torch.float64, device=device).uniform_(low, high)
+
+
+def get_seven_band_eq_response(n, min_gain_db, max_gain_db, length, sample_rate, device):
+    """
+    Frequency responses (n, length // 2 + 1) of n random 7-band parametric EQs for rfft of length.
+    Same RBJ biquads and parameter ranges as AU.SevenBandParametricEQ
+    """
+    w = 2 * np.pi * torch.fft.rfftfreq(length, dtype=torch.float64, device=device)
+    z = torch.exp(-1j * w)
+    powers = torch.stack([torch.ones_like(z), z, z * z])
+    response = torch.ones(n, len(w), dtype=torch.complex128, device=device)
+    for kind, min_freq, max_freq in EQ_BANDS:
+        # center frequency is uniform on mel scale
+        mel = random_uniform(n, 2595 * np.log10(1 + min_freq / 700), 2595 * np.log10(1 + max_freq / 700), device)
+        w0 = 2 * np.pi * 700 * (10 ** (mel / 2595) - 1) / sample_rate
+        gain = 10 ** (random_uniform(n, min_gain_db, max_gain_db, device) / 40)
+        if kind == 'peaking':
+            alpha = torch.sin(w0) / 2 / random_uniform(n, 0.5, 5., device)
+            b = [1 + alpha * gain, -2 * torch.cos(w0), 1 - alpha * gain]
+            a = [1 + alpha / gain, -2 * torch.cos(w0), 1 - alpha / gain]
+        else:
+            alpha = torch.sin(w0) / 2 / random_uniform(n, 0.1, 0.999, device)
+            sign = 1 if kind == 'low_shelf' else -1
+            cos, shelf_alpha = torch.cos(w0), 2 * torch.sqrt(gain) * alpha
+            b = [gain * ((gain + 1) - sign * (gain - 1) * cos + shelf_alpha),
+                 sign * 2 * gain * ((gain - 1) - sign * (gain + 1) * cos),
+                 gain * ((gain + 1) - sign * (gain - 1) * cos - shelf_alpha)]
+            a = [(gain + 1) + sign * (gain - 1) * cos + shelf_alpha,
+                 -sign * 2 * ((gain - 1) + sign * (gain + 1) * cos),
+                 (gain + 1) + sign * (gain - 1) * cos - shelf_alpha]
+        b = torch.stack(b, dim=-1).to(powers.dtype)
+        a = torch.stack(a, dim=-1).to(powers.dtype)
+        response *= (b @ powers) / (a @ powers)
+    return response
+
+
+def augment_stems(x, augs, sample_rate=44100):
+    # DEVICE_AUGMENTATIONS of augm_data for stems x (n, channels, length), every stem has its own random parameters
+    n = x.shape[0]
+    if 'channel_shuffle' in augs:
+        if augs['channel_shuffle'] > 0:
+            mask = torch.rand(n, device=x.device) < augs['channel_shuffle']
+            x = torch.where(mask[:, None, None], x.flip(1), x)
+    if 'random_inverse' in augs:
+        if augs['random_inverse'] > 0:
+            mask = torch.rand(n, device=x.device) < augs['random_inverse']
+            x = torch.where(mask[:, None, None], x.flip(2), x)
+    if 'random_polarity' in augs:
+        if augs['random_polarity'] > 0:
+            mask = torch.rand(n, device=x.device) < augs['random_polarity']
+            x = torch.where(mask[:, None, None], -x, x)
+    if 'seven_band_parametric_eq' in augs:
+        if augs['seven_band_parametric_eq'] > 0:
+            mask = torch.rand(n, device=x.device) < augs['seven_band_parametric_eq']
+            if mask.any():
+                # filtering in frequency domain, circular at chunk borders unlike sosfilt
+                response = get_seven_band_eq_response(int(mask.sum()), augs['seven_band_parametric_eq_min_gain_db'],
+                                                      augs['seven_band_parametric_eq_max_gain_db'], x.shape[-1],
+                                                      sample_rate, x.device)
+                x = x.clone()
+                spec = torch.fft.rfft(x[mask].float(), dim=-1) * response[:, None].to(torch.complex64)
+                x[mask] = torch.fft.irfft(spec, n=x.shape[-1], dim=-1).to(x.dtype)
+    if 'gaussian_noise' in augs:
+        if augs['gaussian_noise'] > 0:
+            mask = torch.rand(n, device=x.device) < augs['gaussian_noise']
+            amplitude = random_uniform(n, augs['gaussian_noise_min_amplitude'], augs['gaussian_noise_max_amplitude'], x.device)
+            x = x + (amplitude * mask).to(x.dtype)[:, None, None] * torch.randn_like(x)
+    return x
 
 
 class MSSDataset(torch.utils.data.Dataset):
-    def __init__(self, config, data_path, metadata_path="metadata.pkl", dataset_type=1, batch_size=None, verbose=True):
+    def __init__(self, config, data_path, metadata_path="metadata.db", dataset_type=1, batch_size=None, verbose=True):
         self.verbose = verbose
         self.config = config
         self.dataset_type = dataset_type # 1, 2, 3 or 4
@@ -79,19 +299,53 @@ class MSSDataset(torch.utils.data.Dataset):
         self.batch_size = batch_size
         self.file_types = ['wav', 'flac']
         self.metadata_path = metadata_path
+        self.packed_path = get_packed_path(data_path)
+        self.packed_audio = None
+        self.file_info = dict()
+        self.stem_paths = dict()
+        self.activity = None
+        # Sample non-quiet chunks from activity envelopes (decodes all audio once for metadata index)
+        # instead of reading random chunks until one passes min_mean_abs. Off unless training.activity_index is set
+        self.use_activity_index = config.audio.min_mean_abs > 0 and bool(config.training.get('activity_index', False))
 
         # Augmentation block
         self.aug = False
+        self.aug_on_device = False
         if 'augmentations' in config:
             if config['augmentations'].enable is True:
                 if self.verbose:
                     print('Use augmentation for training')
                 self.aug = True
+                # DEVICE_AUGMENTATIONS, mixup and loudness are left to augment_batch in training loop
+                if 'on_device' in config['augmentations']:
+                    self.aug_on_device = bool(config['augmentations']['on_device'])
+                if self.aug_on_device and self.verbose:
+                    print('Augmentations on training device: {}, mixup, loudness'.format(', '.join(DEVICE_AUGMENTATIONS)))
+                if self.aug_on_device and self.batch_size == 1 and 'mixup' in config['augmentations']:
+                    print('Warning: mixup on device mixes stems of different samples in batch, it does nothing for batch_size 1')
         else:
             if self.verbose:
                 print('There is no augmentations block in config. Augmentations disabled for training...')
 
-        metadata = self.get_metadata()
+        # Cache of augmented stem chunks (dataset types 1, 2, 3), every chunk is used in cache_reuse mixes.
+        # Every DataLoader worker has its own cache of up to cache_size_mb
+        self.cache_reuse = 0
+        self.cache_size = 1024 * 1024 ** 2
+        if self.aug:
+            if 'cache_reuse' in config['augmentations']:
+                self.cache_reuse = int(config['augmentations']['cache_reuse'])
+            if 'cache_size_mb' in config['augmentations']:
+                self.cache_size = int(config['augmentations']['cache_size_mb'] * 1024 ** 2)
+            if self.cache_reuse > 1 and self.verbose:
+                print('Cache augmented chunks: reuse {} times, up to {} MB per worker'.format(
+                    self.cache_reuse, self.cache_size // 1024 ** 2))
+        self.aug_cache = dict()  # {instr: [[chunk, uses left]]}
+        self.aug_cache_bytes = 0
+
+        if self.packed_path is not None:
+            metadata = self.get_packed_metadata()
+        else:
+            metadata = self.get_metadata()
 
         if self.dataset_type in [1, 4]:
             if len(metadata) > 0:
@@ -107,38 +361,19 @@ class MSSDataset(torch.utils.data.Dataset):
         self.metadata = metadata
         self.chunk_size = config.audio.chunk_size
         self.min_mean_abs = config.audio.min_mean_abs
+        self.build_activity_index()
 
     def __len__(self):
         return self.config.training.num_steps * self.batch_size
 
-    def read_from_metadata_cache(self, track_paths, instr=None):
-        metadata = []
-        if os.path.isfile(self.metadata_path):
-            if self.verbose:
-                print('Found metadata cache file: {}'.format(self.metadata_path))
-            old_metadata = pickle.load(open(self.metadata_path, 'rb'))
-        else:
-            return track_paths, metadata
-
-        if instr:
-            old_metadata = old_metadata[instr]
-
-        # We will not re-read tracks existed in old metadata file
-        track_paths_set = set(track_paths)
-        for old_path, file_size in old_metadata:
-            if old_path in track_paths_set:
-                metadata.append([old_path, file_size])
-                track_paths_set.remove(old_path)
-        track_paths = list(track_paths_set)
-        if len(metadata) > 0:
-            print('Old metadata was used for {} tracks.'.format(len(metadata)))
-        return track_paths, metadata
-
-
     def get_metadata(self):
         read_metadata_procs = multiprocessing.cpu_count()
         if 'read_metadata_procs' in self.config['training']:
             read_metadata_procs = int(self.config['training']['read_metadata_procs'])
+        # rms, silence ratio and activity envelope of every file in metadata index, requires to decode all audio once
+        with_stats = self.use_activity_index
+        if 'metadata_stats' in self.config['training']:
+            with_stats = with_stats or bool(self.config['training']['metadata_stats'])
 
         if self.verbose:
             print(
@@ -159,127 +394,254 @@ class MSSDataset(torch.utils.data.Dataset):
                 track_paths += sorted(glob(self.data_path + '/*'))
 
             track_paths = [path for path in track_paths if os.path.basename(path)[0] != '.' and os.path.isdir(path)]
-            track_paths, metadata = self.read_from_metadata_cache(track_paths, None)
+            stem_paths = self.stem_paths
+            for path in track_paths:
+                for instr in self.instruments:
+                    for extension in self.file_types:
+                        if os.path.isfile(path + '/{}.{}'.format(instr, extension)):
+                            stem_paths[(path, instr)] = path + '/{}.{}'.format(instr, extension)
+                            break
+            self.file_info = update_metadata_index(self.metadata_path, list(stem_paths.values()), with_stats,
+                                                   read_metadata_procs, self.verbose)
 
-            if read_metadata_procs <= 1:
-                for path in tqdm(track_paths):
-                    track_path, track_length = get_track_set_length((path, self.instruments, self.file_types))
-                    metadata.append((track_path, track_length))
-            else:
-                p = multiprocessing.Pool(processes=read_metadata_procs)
-                with tqdm(total=len(track_paths)) as pbar:
-                    track_iter = p.imap(
-                        get_track_set_length,
-                        zip(track_paths, itertools.repeat(self.instruments), itertools.repeat(self.file_types))
+            metadata = []
+            for path in track_paths:
+                # Check lengths of all instruments (it can be different in some cases)
+                lengths_arr = []
+                for instr in self.instruments:
+                    if (path, instr) not in stem_paths:
+                        print('Cant find file "{}" in folder {}'.format(instr, path))
+                        continue
+                    if stem_paths[(path, instr)] in self.file_info:
+                        lengths_arr.append(self.file_info[stem_paths[(path, instr)]]['frames'])
+                if len(lengths_arr) == 0:
+                    continue
+                lengths_arr = np.array(lengths_arr)
+                if lengths_arr.min() != lengths_arr.max():
+                    print('Warning: lengths of stems are different for path: {}. ({} != {})'.format(
+                        path,
+                        lengths_arr.min(),
+                        lengths_arr.max())
                     )
-                    for track_path, track_length in track_iter:
-                        metadata.append((track_path, track_length))
-                        pbar.update()
-                p.close()
+                # We use minimum to allow overflow for soundfile read in non-equal length cases
+                metadata.append((path, lengths_arr.min()))
+
+        elif self.dataset_type in [2, 3]:
+            paths = dict()
+            if self.dataset_type == 2:
+                for instr in self.instruments:
+                    paths[instr] = []
+                    data_paths = self.data_path if type(self.data_path) == list else [self.data_path]
+                    for tp in data_paths:
+                        paths[instr] += sorted(glob(tp + '/{}/*.wav'.format(instr)))
+                        paths[instr] += sorted(glob(tp + '/{}/*.flac'.format(instr)))
+            else:
+                import pandas as pd
+                data_paths = self.data_path if type(self.data_path) == list else [self.data_path]
+                for instr in self.instruments:
+                    paths[instr] = []
+                for csv_path in data_paths:
+                    if self.verbose:
+                        print('Reading tracks from: {}'.format(csv_path))
+                    df = pd.read_csv(csv_path)
+                    for instr in self.instruments:
+                        part = df[df['instrum'] == instr]
+                        print('Tracks found for {}: {}'.format(instr, len(part)))
+                        paths[instr] += list(part['path'].values)
 
-        elif self.dataset_type == 2:
+            all_paths = [path for instr in self.instruments for path in paths[instr]]
+            self.file_info = update_metadata_index(self.metadata_path, all_paths, with_stats,
+                                                   read_metadata_procs, self.verbose)
             metadata = dict()
+            skipped = 0
             for instr in self.instruments:
                 metadata[instr] = []
-                track_paths = []
-                if type(self.data_path) == list:
-                    for tp in self.data_path:
-                        track_paths += sorted(glob(tp + '/{}/*.wav'.format(instr)))
-                        track_paths += sorted(glob(tp + '/{}/*.flac'.format(instr)))
-                else:
-                    track_paths += sorted(glob(self.data_path + '/{}/*.wav'.format(instr)))
-                    track_paths += sorted(glob(self.data_path + '/{}/*.flac'.format(instr)))
-
-                track_paths, metadata[instr] = self.read_from_metadata_cache(track_paths, instr)
-
-                if read_metadata_procs <= 1:
-                    for path in tqdm(track_paths):
-                        length = len(sf.read(path)[0])
-                        metadata[instr].append((path, length))
-                else:
-                    p = multiprocessing.Pool(processes=read_metadata_procs)
-                    for out in tqdm(p.imap(get_track_length, track_paths), total=len(track_paths)):
-                        metadata[instr].append(out)
-
-        elif self.dataset_type == 3:
-            import pandas as pd
-            if type(self.data_path) != list:
-                data_path = [self.data_path]
-
-            metadata = dict()
-            for i in range(len(self.data_path)):
-                if self.verbose:
-                    print('Reading tracks from: {}'.format(self.data_path[i]))
-                df = pd.read_csv(self.data_path[i])
-
-                skipped = 0
-                for instr in self.instruments:
-                    part = df[df['instrum'] == instr].copy()
-                    print('Tracks found for {}: {}'.format(instr, len(part)))
-                for instr in self.instruments:
-                    part = df[df['instrum'] == instr].copy()
-                    metadata[instr] = []
-                    track_paths = list(part['path'].values)
-                    track_paths, metadata[instr] = self.read_from_metadata_cache(track_paths, instr)
-
-                    for path in tqdm(track_paths):
-                        if not os.path.isfile(path):
-                            print('Cant find track: {}'.format(path))
-                            skipped += 1
-                            continue
-                        # print(path)
-                        try:
-                            length = len(sf.read(path)[0])
-                        except:
-                            print('Problem with path: {}'.format(path))
-                            skipped += 1
-                            continue
-                        metadata[instr].append((path, length))
-                if skipped > 0:
-                    print('Missing tracks: {} from {}'.format(skipped, len(df)))
+                for path in paths[instr]:
+                    if path in self.file_info:
+                        metadata[instr].append((path, self.file_info[path]['frames']))
+                    else:
+                        skipped += 1
+            if skipped > 0:
+                print('Missing tracks: {} from {}'.format(skipped, len(all_paths)))
         else:
             print('Unknown dataset type: {}. Must be 1, 2, 3 or 4'.format(self.dataset_type))
             exit()
 
-        # Save metadata
-        pickle.dump(metadata, open(self.metadata_path, 'wb'))
+        if self.use_activity_index:
+            self.activity = dict()
+            for path, row in self.file_info.items():
+                if row['activity'] is not None:
+                    self.activity[path] = np.frombuffer(row['activity'], dtype=np.float16)
+        for row in self.file_info.values():
+            del row['activity']
         return metadata
 
+    def get_packed_metadata(self):
+        # Same as get_metadata, but every entry has offset of stem in packed audio:
+        # [(track_path, length, {instr: offset})] for types 1, 4 and {instr: [(path, length, offset)]} for 2, 3
+        index = pickle.load(open(os.path.join(self.packed_path, PACKED_INDEX), 'rb'))
+        if self.verbose:
+            print('Use packed dataset: {} ({} frames, {})'.format(self.packed_path, index['frames'], index['dtype']))
+        if (self.dataset_type in [1, 4]) != (index['dataset_type'] in [1, 4]):
+            print('Packed dataset was made for dataset type {}, it can\'t be used as type {}'.format(
+                index['dataset_type'], self.dataset_type))
+            exit()
+        for instr in self.instruments:
+            if instr not in index['instruments']:
+                print('Instrument {} is not in packed dataset {}'.format(instr, self.packed_path))
+                exit()
+        self.packed_dtype = index['dtype']
+        self.packed_frames = index['frames']
+        self.packed_scale = index['scale']
+        if self.use_activity_index:
+            # packed datasets made before activity envelopes have no 'activity'
+            self.activity = index.get('activity')
+        return index['metadata']
+
+    def get_packed_audio(self):
+        # Opened on first use, so every DataLoader worker maps the file itself instead of receiving a copy
+        if self.packed_audio is None:
+            self.packed_audio = np.memmap(os.path.join(self.packed_path, PACKED_AUDIO), dtype=self.packed_dtype,
+                                          mode='r', shape=(self.packed_frames, 2))
+        return self.packed_audio
+
+    def get_activity_key(self, entry, instr):
+        # Key of stem in self.activity: offset in packed audio or audio file path
+        if self.dataset_type in [1, 4]:
+            if self.packed_path is not None:
+                return entry[2][instr]
+            return self.stem_paths.get((entry[0], instr))
+        if self.packed_path is not None:
+            return entry[2]
+        return entry[0]
+
+    def build_activity_index(self):
+        """
+        Mask of non-quiet chunk offsets (in STATS_BLOCK_SIZE blocks) for every stem, built from activity
+        envelopes. load_source samples chunks from them directly instead of reading and rejecting quiet ones
+        """
+        self.activity_masks = None
+        if self.activity is None:
+            return
+        self.activity_masks = dict()
+        self.activity_entries = dict()
+        self.activity_weights = dict()
+        for instr in self.instruments:
+            entries = self.metadata if self.dataset_type in [1, 4] else self.metadata[instr]
+            masks = dict()
+            for i, entry in enumerate(entries):
+                envelope = self.activity.get(self.get_activity_key(entry, instr))
+                if envelope is None:
+                    continue
+                mask = get_active_offsets(envelope, entry[1], self.chunk_size, self.min_mean_abs)
+                if mask.any():
+                    masks[i] = mask
+            self.activity_masks[instr] = masks
+            self.activity_entries[instr] = list(masks.keys())
+            # Rejection sampling kept chunks of uniformly chosen tracks, so tracks were used in proportion
+            # to their share of non-quiet chunks. The same weights keep the distribution of chunks
+            self.activity_weights[instr] = list(itertools.accumulate(masks[i].mean() for i in masks))
+            if self.verbose:
+                print('Activity index for {}: {} of {} tracks have non-quiet chunks'.format(instr, len(masks), len(entries)))
+            if len(masks) == 0:
+                print('Warning: no chunks of {} pass min_mean_abs: {}'.format(instr, self.min_mean_abs))
+        # Envelopes aren't needed anymore, don't copy them to DataLoader workers
+        self.activity = None
+
+    def sample_active_offset(self, mask, length):
+        # Random chunk offset from non-quiet blocks of mask, None for tracks shorter than chunk
+        if self.chunk_size > length:
+            return None
+        offset = np.random.choice(np.flatnonzero(mask)) * STATS_BLOCK_SIZE
+        return offset + np.random.randint(min(STATS_BLOCK_SIZE, length - self.chunk_size - offset + 1))
+
+    def load_stem_chunk(self, entry, instr, offset=None):
+        # Chunk of instr from metadata entry (track for types 1, 4, audio file for types 2, 3), random offset if None
+        if self.packed_path is not None:
+            stem_offset = entry[2][instr] if self.dataset_type in [1, 4] else entry[2]
+            return load_packed_chunk(self.get_packed_audio(), stem_offset, entry[1], self.chunk_size, self.packed_scale,
+                                     offset)
+        if self.dataset_type in [1, 4]:
+            track_path, track_length = entry
+            paths = [track_path + '/{}.{}'.format(instr, extension) for extension in self.file_types]
+            paths = [path for path in paths if os.path.isfile(path)]
+            if len(paths) == 0:
+                return np.zeros((2, self.chunk_size), dtype=np.float32)
+            path_to_audio_file = paths[0]
+        else:
+            path_to_audio_file, track_length = entry
+        try:
+            return load_chunk(path_to_audio_file, track_length, self.chunk_size, offset)
+        except Exception as e:
+            # Sometimes error during FLAC reading, catch it and use zero stem
+            print('Error: {} Path: {}'.format(e, path_to_audio_file))
+            return np.zeros((2, self.chunk_size), dtype=np.float32)
+
+    def get_cached_source(self, instr):
+        """
+        Random cached chunk of instr, or None if a new one must be made. Chunks are reused only when the
+        cache is full, so it's filled with different chunks first and every new chunk is used cache_reuse times
+        """
+        entries = self.aug_cache.get(instr)
+        if not entries or self.aug_cache_bytes + entries[0][0].nbytes <= self.cache_size:
+            return None
+        i = random.randrange(len(entries))
+        source = entries[i][0]
+        entries[i][1] -= 1
+        if entries[i][1] <= 0:
+            entries[i] = entries[-1]
+            entries.pop()
+            self.aug_cache_bytes -= source.nbytes
+        return source
+
+    def add_cached_source(self, instr, source):
+        # Evict chunks with the least uses left until the new one fits
+        while self.aug_cache_bytes + source.nbytes > self.cache_size and self.aug_cache_bytes > 0:
+            key, i = min(((key, i) for key in self.aug_cache for i in range(len(self.aug_cache[key]))),
+                         key=lambda x: self.aug_cache[x[0]][x[1]][1])
+            entries = self.aug_cache[key]
+            self.aug_cache_bytes -= entries[i][0].nbytes
+            entries[i] = entries[-1]
+            entries.pop()
+        if self.aug_cache_bytes + source.nbytes <= self.cache_size:
+            self.aug_cache.setdefault(instr, []).append([source, self.cache_reuse - 1])
+            self.aug_cache_bytes += source.nbytes
+
     def load_source(self, metadata, instr):
+        # Cached chunks aren't changed in place later: mixup and loudness work with stacked copies
+        use_cache = self.cache_reuse > 1 and self.dataset_type in [1, 2, 3]
+        if use_cache:
+            source = self.get_cached_source(instr)
+            if source is not None:
+                return source
+
+        entries = metadata if self.dataset_type in [1, 4] else metadata[instr]
         while True:
-            if self.dataset_type in [1, 4]:
-                track_path, track_length = random.choice(metadata)
-                for extension in self.file_types:
-                    path_to_audio_file = track_path + '/{}.{}'.format(instr, extension)
-                    if os.path.isfile(path_to_audio_file):
-                        try:
-                            source = load_chunk(path_to_audio_file, track_length, self.chunk_size)
-                        except Exception as e:
-                            # Sometimes error during FLAC reading, catch it and use zero stem
-                            print('Error: {} Path: {}'.format(e, path_to_audio_file))
-                            source = np.zeros((2, self.chunk_size), dtype=np.float32)
-                        break
+            offset = None
+            if self.activity_masks is not None and len(self.activity_entries[instr]) > 0:
+                i = random.choices(self.activity_entries[instr], cum_weights=self.activity_weights[instr])[0]
+                entry = entries[i]
+                offset = self.sample_active_offset(self.activity_masks[instr][i], entry[1])
             else:
-                track_path, track_length = random.choice(metadata[instr])
-                try:
-                    source = load_chunk(track_path, track_length, self.chunk_size)
-                except Exception as e:
-                    # Sometimes error during FLAC reading, catch it and use zero stem
-                    print('Error: {} Path: {}'.format(e, track_path))
-                    source = np.zeros((2, self.chunk_size), dtype=np.float32)
-
-            if np.abs(source).mean() >= self.min_mean_abs:  # remove quiet chunks
+                entry = random.choice(entries)
+            source = self.load_stem_chunk(entry, instr, offset)
+
+            # remove quiet chunks, with activity index it's only a check (index works with whole blocks)
+            if np.abs(source).mean() >= self.min_mean_abs:
                 break
         if self.aug:
             source = self.augm_data(source, instr)
-        return torch.tensor(source, dtype=torch.float32)
+        source = torch.tensor(source, dtype=torch.float32)
+        if use_cache:
+            self.add_cached_source(instr, source)
+        return source
 
     def load_random_mix(self):
         res = []
         for instr in self.instruments:
             s1 = self.load_source(self.metadata, instr)
             # Mixup augmentation. Multiple mix of same type of stems
-            if self.aug:
+            if self.aug and not self.aug_on_device:
                 if 'mixup' in self.config['augmentations']:
                     if self.config['augmentations'].mixup:
                         mixup = [s1]
@@ -301,25 +663,27 @@ class MSSDataset(torch.utils.data.Dataset):
         return res
 
     def load_aligned_data(self):
-        track_path, track_length = random.choice(self.metadata)
+        track_index = random.randrange(len(self.metadata))
+        track = self.metadata[track_index]
+        track_path, track_length = track[:2]
         res = []
         for i in self.instruments:
             attempts = 10
+            mask = None
+            if self.activity_masks is not None:
+                mask = self.activity_masks[i].get(track_index)
+                if mask is None:
+                    # Index knows that all chunks of this stem are quiet, retries won't help
+                    attempts = 1
             while attempts:
-                for extension in self.file_types:
-                    path_to_audio_file = track_path + '/{}.{}'.format(i, extension)
-                    if os.path.isfile(path_to_audio_file):
-                        try:
-                            source = load_chunk(path_to_audio_file, track_length, self.chunk_size)
-                        except Exception as e:
-                            # Sometimes error during FLAC reading, catch it and use zero stem
-                            print('Error: {} Path: {}'.format(e, path_to_audio_file))
-                            source = np.zeros((2, self.chunk_size), dtype=np.float32)
-                        break
+                offset = None
+                if mask is not None:
+                    offset = self.sample_active_offset(mask, track_length)
+                source = self.load_stem_chunk(track, i, offset)
                 if np.abs(source).mean() >= self.min_mean_abs:  # remove quiet chunks
                     break
                 attempts -= 1
-                if attempts <= 0:
+                if attempts <= 0 and self.activity_masks is None:
                     print('Attempts max!', track_path)
             res.append(source)
         res = np.stack(res, axis=0)
@@ -328,19 +692,24 @@ class MSSDataset(torch.utils.data.Dataset):
                 res[i] = self.augm_data(res[i], instr)
         return torch.tensor(res, dtype=torch.float32)
 
-    def augm_data(self, source, instr):
-        # source.shape = (2, 261120) - first channels, second length
-        source_shape = source.shape
-        applied_augs = []
+    def get_stem_augmentations(self, instr):
+        augs = dict()
         if 'all' in self.config['augmentations']:
-            augs = self.config['augmentations']['all']
-        else:
-            augs = dict()
+            augs.update(self.config['augmentations']['all'])
 
         # We need to add to all augmentations specific augs for stem. And rewrite values if needed
         if instr in self.config['augmentations']:
             for el in self.config['augmentations'][instr]:
                 augs[el] = self.config['augmentations'][instr][el]
+        return augs
+
+    def augm_data(self, source, instr):
+        # source.shape = (2, 261120) - first channels, second length
+        source_shape = source.shape
+        applied_augs = []
+        augs = self.get_stem_augmentations(instr)
+        if self.aug_on_device:
+            augs = {el: augs[el] for el in augs if el not in DEVICE_AUGMENTATIONS}
 
         # Channel shuffle
         if 'channel_shuffle' in augs:
@@ -609,6 +978,49 @@ class MSSDataset(torch.utils.data.Dataset):
         # print(applied_augs)
         return source
 
+    def augment_batch(self, batch, mix):
+        """
+        Augmentations of augmentations.on_device for a batch from DataLoader, on the device of batch:
+        DEVICE_AUGMENTATIONS of every stem, mixup and loudness, all with random parameters for every stem.
+        batch: (batch_size, instruments, channels, length). Returns (batch, mix) like __getitem__ without on_device
+        """
+        if not self.aug_on_device:
+            return batch, mix
+        with torch.no_grad():
+            # Difference made by effects on mixture (mp3_compression_on_mixture) is kept in the new mixture
+            residual = mix - batch.sum(1)
+            batch = torch.stack([
+                augment_stems(batch[:, i], self.get_stem_augmentations(instr)) for i, instr in enumerate(self.instruments)
+            ], dim=1)
+            num = batch.shape[0]
+
+            # Mixup with stems of the same instrument from other samples of the batch, instead of loading new ones
+            if 'mixup' in self.config['augmentations'] and self.dataset_type in [1, 2, 3] and num > 1:
+                if self.config['augmentations'].mixup:
+                    low = self.config.augmentations.loudness_min
+                    high = self.config.augmentations.loudness_max
+                    mixup = batch * random_uniform(batch.shape[:2], low, high, batch.device).to(batch.dtype)[..., None, None]
+                    count = torch.ones(batch.shape[:2], device=batch.device)
+                    for prob in self.config.augmentations.mixup_probs:
+                        mask = torch.rand(batch.shape[:2], device=batch.device) < prob
+                        loud_values = random_uniform(batch.shape[:2], low, high, batch.device) * mask
+                        mixup += batch.roll(random.randint(1, num - 1), dims=0) * loud_values.to(batch.dtype)[..., None, None]
+                        count += mask
+                    batch = mixup / count[..., None, None]
+
+            if 'loudness' in self.config['augmentations']:
+                if self.config['augmentations']['loudness']:
+                    loud_values = random_uniform(batch.shape[:2], self.config['augmentations']['loudness_min'],
+                                                 self.config['augmentations']['loudness_max'], batch.device)
+                    batch = batch * loud_values.to(batch.dtype)[..., None, None]
+
+            mix = batch.sum(1) + residual
+
+        if self.config.training.target_instrument is not None:
+            index = self.config.training.instruments.index(self.config.training.target_instrument)
+            return batch[:, index], mix
+        return batch, mix
+
     def __getitem__(self, index):
         if self.dataset_type in [1, 2, 3]:
             res = self.load_random_mix()
@@ -616,7 +1028,7 @@ class MSSDataset(torch.utils.data.Dataset):
             res = self.load_aligned_data()
 
         # Randomly change loudness of each stem
-        if self.aug:
+        if self.aug and not self.aug_on_device:
             if 'loudness' in self.config['augmentations']:
                 if self.config['augmentations']['loudness']:
                     loud_values = np.random.uniform(
@@ -645,8 +1057,8 @@ class MSSDataset(torch.utils.data.Dataset):
                     mix = mix[..., :required_shape[-1]]
                 mix = torch.tensor(mix, dtype=torch.float32)
 
-        # If we need only given stem (for roformers)
-        if self.config.training.target_instrument is not None:
+        # If we need only given stem (for roformers), with on_device augment_batch needs all of them
+        if self.config.training.target_instrument is not None and not self.aug_on_device:
             index = self.config.training.instruments.index(self.config.training.target_instrument)
             return res[index], mix
 
@@ -8,6 +8,10 @@ from tqdm.auto import tqdm
 import sys
 import os
 import glob
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import numpy as np
 import soundfile as sf
@@ -17,12 +21,129 @@ from utils import prefer_target_instrument
 # Using the embedded version of Python can also correctly import the utils module.
 current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(current_dir)
-from utils import demix, get_model_from_config
+from utils import demix, demix_stream, demix_tracks, get_model_from_config, load_checkpoint, apply_tuning_profile
+from profiler import StageProfiler, profile_stage
 
 import warnings
 warnings.filterwarnings("ignore")
 
 
+def read_audio_blocks(path, sr, block_size=262144, profiler=None, track=None):
+    """
+    Open an audio file for block-wise reading. Returns the expected length at sample rate sr
+    and an iterator over float32 (channels, length) blocks. Resampling is done on the fly
+    (same soxr_hq resampler as librosa.load) only if the file sample rate differs from sr.
+    Formats soundfile cannot decode are loaded whole with librosa.
+    """
+    try:
+        audio_file = sf.SoundFile(path)
+    except Exception:
+        with profile_stage(profiler, 'decode', track):
+            mix, _ = librosa.load(path, sr=sr, mono=False)
+        if len(mix.shape) == 1:
+            mix = np.stack([mix, mix], axis=0)
+        return mix.shape[-1], (mix[:, i:i + block_size] for i in range(0, mix.shape[-1], block_size))
+
+    def blocks():
+        with audio_file:
+            resampler = None
+            if audio_file.samplerate != sr:
+                import soxr
+                resampler = soxr.ResampleStream(audio_file.samplerate, sr, audio_file.channels, dtype='float32', quality='HQ')
+            while True:
+                with profile_stage(profiler, 'decode', track):
+                    data = audio_file.read(block_size, dtype='float32', always_2d=True)
+                last = len(data) < block_size
+                if resampler is not None:
+                    with profile_stage(profiler, 'resample', track):
+                        data = resampler.resample_chunk(data, last=last)
+                if len(data) > 0:
+                    data = data.T
+                    # Convert mono to stereo if needed
+                    if data.shape[0] == 1:
+                        data = np.concatenate([data, data], axis=0)
+                    yield data
+                if last:
+                    break
+
+    length = int(np.ceil(audio_file.frames * sr / audio_file.samplerate))
+    return length, blocks()
+
+
+def get_mean_std(path, sr, profiler=None, track=None):
+    # Statistics of the mono mix for normalization, computed in one pass over the blocks
+    _, blocks = read_audio_blocks(path, sr, profiler=profiler, track=track)
+    total, total_sq, count = 0., 0., 0
+    for block in blocks:
+        with profile_stage(profiler, 'mean_std', track):
+            mono = block.mean(0, dtype=np.float64)
+            total += mono.sum()
+            total_sq += np.square(mono).sum()
+            count += len(mono)
+    mean = total / count
+    std = np.sqrt(max(total_sq / count - mean ** 2, 0.))
+    return mean, std
+
+
+def put_until_stopped(blocks_queue, item, stop):
+    # Blocking put into a bounded queue which gives up once the consumer has stopped
+    while not stop.is_set():
+        try:
+            blocks_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def read_track(path, sr, normalize, blocks_queue, stop, profiler=None, track=None):
+    """
+    Producer for run_folder: decodes (and resamples) a track in a background thread.
+    Puts a header (length, mean, std) followed by the blocks and a None sentinel into
+    blocks_queue. Errors are passed to the consumer through the queue.
+    """
+    try:
+        mean, std = None, None
+        if normalize:
+            mean, std = get_mean_std(path, sr, profiler=profiler, track=track)
+        length, mix_blocks = read_audio_blocks(path, sr, profiler=profiler, track=track)
+        if not put_until_stopped(blocks_queue, (length, mean, std), stop):
+            return
+        for mix in mix_blocks:
+            if not put_until_stopped(blocks_queue, mix, stop):
+                return
+        put_until_stopped(blocks_queue, None, stop)
+    except Exception as e:
+        put_until_stopped(blocks_queue, e, stop)
+
+
+def write_track(output_files, subtype, sr, blocks_queue, profiler=None, track=None):
+    """
+    Consumer for run_folder: encodes the separated blocks of a track in a background thread.
+    Items of blocks_queue are dicts {instrument: (channels, length)}, None ends the track.
+    """
+    writers = dict()
+    try:
+        for instr in output_files:
+            writers[instr] = sf.SoundFile(output_files[instr], 'w', samplerate=sr, channels=2, subtype=subtype)
+        while True:
+            waveforms = blocks_queue.get()
+            if waveforms is None:
+                break
+            with profile_stage(profiler, 'encode', track):
+                for instr in writers:
+                    writers[instr].write(waveforms[instr].T)
+    except Exception as e:
+        print('Cannot write track: {}'.format(list(output_files.values())))
+        print('Error message: {}'.format(str(e)))
+        # Keep draining so the producer never blocks on a full queue
+        while blocks_queue.get() is not None:
+            pass
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
 def run_folder(model, args, config, device, verbose=False):
     start_time = time.time()
     model.eval()
@@ -30,93 +151,365 @@ def run_folder(model, args, config, device, verbose=False):
     all_mixtures_path.sort()
     print('Total files found: {}'.format(len(all_mixtures_path)))
 
-    instruments = prefer_target_instrument(config)
+    instruments = prefer_target_instrument(config)[:]
+    sr = 44100
 
     os.makedirs(args.store_dir, exist_ok=True)
 
+    read_workers = 2
+    if hasattr(args, 'read_workers'):
+        read_workers = max(args.read_workers, 1)
+    write_workers = 2
+    if hasattr(args, 'write_workers'):
+        write_workers = max(args.write_workers, 1)
+    queue_blocks = 8
+
+    normalize = False
+    if 'normalize' in config.inference:
+        if config.inference['normalize'] is True:
+            normalize = True
+
+    profiler = None
+    if hasattr(args, 'profile') and args.profile:
+        profiler = StageProfiler(device)
+        profiler.add_model_hooks(model)
+        for i, path in enumerate(all_mixtures_path):
+            profiler.set_track_name(i, os.path.basename(path))
+
+    # Decoding of the next tracks starts right away in background threads, queues bound
+    # the number of decoded blocks kept in memory for each of them
+    read_pool = ThreadPoolExecutor(max_workers=read_workers)
+    write_pool = ThreadPoolExecutor(max_workers=write_workers)
+    read_queues = []
+    read_stops = []
+    for path in all_mixtures_path:
+        blocks_queue = queue.Queue(maxsize=queue_blocks)
+        stop = threading.Event()
+        read_pool.submit(read_track, path, sr, normalize, blocks_queue, stop, profiler, len(read_queues))
+        read_queues.append(blocks_queue)
+        read_stops.append(stop)
+
+    total_progress = None
     if not verbose:
-        all_mixtures_path = tqdm(all_mixtures_path, desc="Total progress")
+        total_progress = tqdm(total=len(all_mixtures_path), desc="Total progress")
 
     if args.disable_detailed_pbar:
         detailed_pbar = False
     else:
         detailed_pbar = True
 
-    for path in all_mixtures_path:
+    # Create a new `instr` in instruments list, 'instrumental'
+    if args.extract_instrumental:
+        instr_main = 'vocals' if 'vocals' in instruments else instruments[0]
+        if 'instrumental' not in instruments:
+            instruments.append('instrumental')
+
+    # Tracks up to this length are separated whole and share chunk batches with the next
+    # tracks (demix_tracks), longer ones are streamed block by block (demix_stream)
+    cross_track_max_sec = 120
+    if hasattr(args, 'cross_track_max_sec'):
+        cross_track_max_sec = args.cross_track_max_sec
+    pool_length = int(cross_track_max_sec * sr)
+
+    headers = dict()
+
+    def get_header(i):
+        if i not in headers:
+            headers[i] = read_queues[i].get()
+        return headers[i]
+
+    def start_track(i):
+        # Header (length, mean, std) of track i, None if it can't be read
+        path = all_mixtures_path[i]
         print("Starting processing track: ", path)
-        if not verbose:
-            all_mixtures_path.set_postfix({'track': os.path.basename(path)})
-        try:
-            mix, sr = librosa.load(path, sr=44100, mono=False)
-        except Exception as e:
+        if total_progress:
+            total_progress.set_postfix({'track': os.path.basename(path)})
+            total_progress.update(1)
+        header = get_header(i)
+        if isinstance(header, Exception):
             print('Cannot read track: {}'.format(path))
-            print('Error message: {}'.format(str(e)))
-            continue
+            print('Error message: {}'.format(str(header)))
+            return None
+        return header
 
-        # Convert mono to stereo if needed
-        if len(mix.shape) == 1:
-            mix = np.stack([mix, mix], axis=0)
+    def start_writer(i):
+        file_name, _ = os.path.splitext(os.path.basename(all_mixtures_path[i]))
+        output_files = dict()
+        for instr in instruments:
+            output_files[instr], subtype = get_output_file(args, args.store_dir, f"{file_name}_{instr}")
+        write_queue = queue.Queue(maxsize=queue_blocks)
+        write_pool.submit(write_track, output_files, subtype, sr, write_queue, profiler, i)
+        return write_queue
+
+    def finish_waveforms(waveforms, mix, mean, std, track):
+        with profile_stage(profiler, 'postprocess', track):
+            if normalize:
+                for el in waveforms:
+                    waveforms[el] = waveforms[el] * std + mean
+            if args.extract_instrumental:
+                # Output "instrumental", which is an inverse of 'vocals' or the first stem in list if 'vocals' absent
+                waveforms['instrumental'] = mix - waveforms[instr_main]
+        return waveforms
+
+    def pooled_tracks(first, position, pooled_mixes):
+        # Consecutive short tracks starting from first, position[0] is set past the last one taken
+        i = first
+        while i < len(all_mixtures_path):
+            header = get_header(i)
+            if not isinstance(header, Exception) and header[0] > pool_length:
+                break
+            position[0] = i + 1
+            if start_track(i) is not None:
+                length, mean, std = header
+                try:
+                    with profile_stage(profiler, 'wait_read', i):
+                        mix = get_all_blocks(read_queues[i])
+                except Exception as e:
+                    print('Cannot read track: {}'.format(all_mixtures_path[i]))
+                    print('Error message: {}'.format(str(e)))
+                    mix = None
+                if mix is not None:
+                    pooled_mixes[i] = (mix, mean, std)
+                    if normalize:
+                        with profile_stage(profiler, 'normalize', i):
+                            mix = (mix - mean) / std
+                    yield i, mix
+            i += 1
+
+    try:
+        i = 0
+        while i < len(all_mixtures_path):
+            header = get_header(i)
+            if isinstance(header, Exception) or header[0] <= pool_length:
+                position = [i + 1]
+                pooled_mixes = dict()
+                try:
+                    # With TTA the channel and polarity inverse are folded into every chunk batch
+                    separated = demix_tracks(config, model, pooled_tracks(i, position, pooled_mixes), device,
+                                             model_type=args.model_type, use_tta=args.use_tta, pbar=detailed_pbar, profiler=profiler,
+                                             oom_recovery=True)
+                    for j, waveforms in separated:
+                        mix, mean, std = pooled_mixes.pop(j)
+                        write_queue = start_writer(j)
+                        write_queue.put(finish_waveforms(waveforms, mix, mean, std, j))
+                        write_queue.put(None)
+                except Exception as e:
+                    for j in pooled_mixes:
+                        print('Cannot process track: {}'.format(all_mixtures_path[j]))
+                    print('Error message: {}'.format(str(e)))
+                i = position[0]
+                continue
+
+            length, mean, std = start_track(i)
+            blocks_queue = read_queues[i]
+            stop = read_stops[i]
+
+            # Original blocks are kept until the matching output is written (for the instrumental)
+            mix_orig = deque()
 
-        mix_orig = mix.copy()
-        if 'normalize' in config.inference:
-            if config.inference['normalize'] is True:
-                mono = mix.mean(0)
-                mean = mono.mean()
-                std = mono.std()
-                mix = (mix - mean) / std
-
-        if args.use_tta:
-            # orig, channel inverse, polarity inverse
-            track_proc_list = [mix.copy(), mix[::-1].copy(), -1. * mix.copy()]
-        else:
-            track_proc_list = [mix.copy()]
-
-        full_result = []
-        for mix in track_proc_list:
-            waveforms = demix(config, model, mix, device, pbar=detailed_pbar, model_type=args.model_type)
-            full_result.append(waveforms)
-
-        # Average all values in single dict
-        waveforms = full_result[0]
-        for i in range(1, len(full_result)):
-            d = full_result[i]
-            for el in d:
-                if i == 2:
-                    waveforms[el] += -1.0 * d[el]
-                elif i == 1:
-                    waveforms[el] += d[el][::-1].copy()
-                else:
-                    waveforms[el] += d[el]
+            def prepare_blocks():
+                while True:
+                    with profile_stage(profiler, 'wait_read', i):
+                        mix = blocks_queue.get()
+                    if mix is None:
+                        return
+                    if isinstance(mix, Exception):
+                        raise mix
+                    mix_orig.append(mix)
+                    if normalize:
+                        with profile_stage(profiler, 'normalize', i):
+                            mix = (mix - mean) / std
+                    yield mix
+
+            waveform_blocks = demix_stream(config, model, prepare_blocks(), device, model_type=args.model_type, use_tta=args.use_tta,
+                                           profiler=profiler, track=i, oom_recovery=True)
+            write_queue = start_writer(i)
+
+            progress_bar = tqdm(total=length, desc="Processing audio chunks", leave=False) if detailed_pbar else None
+            try:
+                for waveforms in waveform_blocks:
+                    block_length = waveforms[instruments[0]].shape[-1]
+                    write_queue.put(finish_waveforms(waveforms, pop_samples(mix_orig, block_length), mean, std, i))
+                    if progress_bar:
+                        progress_bar.update(block_length)
+            except Exception as e:
+                print('Cannot process track: {}'.format(all_mixtures_path[i]))
+                print('Error message: {}'.format(str(e)))
+            finally:
+                stop.set()
+                write_queue.put(None)
+                if progress_bar:
+                    progress_bar.close()
+            i += 1
+    finally:
+        for stop in read_stops:
+            stop.set()
+        read_pool.shutdown(wait=True, cancel_futures=True)
+        # Wait until all stems are encoded
+        write_pool.shutdown(wait=True)
+        if profiler is not None:
+            profiler.remove_hooks()
+
+    if profiler is not None:
+        profiler.print_summary()
+        profiler.save(os.path.join(args.store_dir, 'profile'))
+
+    time.sleep(1)
+    print("Elapsed time: {:.2f} sec".format(time.time() - start_time))
+
+
+def get_all_blocks(blocks_queue):
+    # Whole track from the blocks of read_track
+    blocks = []
+    while True:
+        mix = blocks_queue.get()
+        if mix is None:
+            break
+        if isinstance(mix, Exception):
+            raise mix
+        blocks.append(mix)
+    return np.concatenate(blocks, axis=-1)
+
+
+def pop_samples(blocks, length):
+    # Take the first length samples from a deque of (channels, n) blocks
+    out = []
+    while length > 0 and len(blocks) > 0:
+        block = blocks.popleft()
+        if block.shape[-1] > length:
+            blocks.appendleft(block[:, length:])
+            block = block[:, :length]
+        out.append(block)
+        length -= block.shape[-1]
+    return np.concatenate(out, axis=-1)
+
+
+def get_output_file(args, store_dir, name):
+    # Output path and soundfile subtype of a stem
+    if args.flac_file:
+        subtype = 'PCM_16' if args.pcm_type == 'PCM_16' else 'PCM_24'
+        return os.path.join(store_dir, f"{name}.flac"), subtype
+    return os.path.join(store_dir, f"{name}.wav"), 'FLOAT'
+
+
+def read_audio(path, sr):
+    _, blocks = read_audio_blocks(path, sr)
+    return np.concatenate(list(blocks), axis=-1)
+
+
+def write_stem(path, waveform, sr, subtype):
+    try:
+        sf.write(path, waveform.T, sr, subtype=subtype)
+    except Exception as e:
+        print('Cannot write track: {}'.format(path))
+        print('Error message: {}'.format(str(e)))
+
+
+def separate_track(model, args, config, device, mix, pbar=False):
+    # Whole-track counterpart of the run_folder loop body, returns {instrument: (channels, length)}
+    instruments = prefer_target_instrument(config)
+    mix_orig = mix
+    normalize = False
+    if 'normalize' in config.inference:
+        if config.inference['normalize'] is True:
+            normalize = True
+    if normalize:
+        mono = mix.mean(0, dtype=np.float64)
+        mean, std = mono.mean(), mono.std()
+        mix = (mix - mean) / std
+
+    waveforms = demix(config, model, mix, device, pbar=pbar, model_type=args.model_type, use_tta=args.use_tta, oom_recovery=True)
+
+    if normalize:
         for el in waveforms:
-            waveforms[el] = waveforms[el] / len(full_result)
+            waveforms[el] = waveforms[el] * std + mean
+    if args.extract_instrumental:
+        instr_main = 'vocals' if 'vocals' in instruments else instruments[0]
+        waveforms['instrumental'] = mix_orig - waveforms[instr_main]
+    return waveforms
 
-        # Create a new `instr` in instruments list, 'instrumental' 
-        if args.extract_instrumental:
-            instr = 'vocals' if 'vocals' in instruments else instruments[0]
-            if 'instrumental' not in instruments:
-                instruments.append('instrumental')
-            # Output "instrumental", which is an inverse of 'vocals' or the first stem in list if 'vocals' absent
-            waveforms['instrumental'] = mix_orig - waveforms[instr]
 
-        for instr in instruments:
-            estimates = waveforms[instr].T
-            if 'normalize' in config.inference:
-                if config.inference['normalize'] is True:
-                    estimates = estimates * std + mean
+# Stems with these in the name are final outputs, they are never passed to the next stage
+INSTRUMENTAL_SUFFIXES = ('_instrumental', '_aspiration')
+
+
+def run_pipeline(stages, input_folder, save_intermediate=False, verbose=False):
+    """
+    Chain separation models in one process, e.g. vocals -> karaoke -> dereverb. stages is a list
+    of (model, args, config, device) with args from parse_args. Every stage separates the stems
+    of the previous stage which are not instrumental, the same as running it on the previous
+    store_dir, but waveforms are passed in memory. Instrumental stems of every stage are written
+    to {store_dir}/instrumental and the other stems of the last stage to its store_dir. Stems
+    passed on to the next stage are written only with save_intermediate.
+    """
+    start_time = time.time()
+    all_mixtures_path = glob.glob(input_folder + '/*.*')
+    all_mixtures_path.sort()
+    print('Total files found: {}'.format(len(all_mixtures_path)))
+    sr = 44100
+
+    for i, (model, args, config, device) in enumerate(stages):
+        print('Stage {}: {} -> {}'.format(i + 1, args.start_check_point, args.store_dir))
+        model.eval()
+        os.makedirs(os.path.join(args.store_dir, 'instrumental'), exist_ok=True)
+
+    first_args = stages[0][1]
+    write_workers = 2
+    if hasattr(first_args, 'write_workers'):
+        write_workers = max(first_args.write_workers, 1)
+    detailed_pbar = not first_args.disable_detailed_pbar
+
+    # The next track is decoded while the current one goes through all stages
+    read_pool = ThreadPoolExecutor(max_workers=1)
+    write_pool = ThreadPoolExecutor(max_workers=write_workers)
+    try:
+        next_read = None
+        if len(all_mixtures_path) > 0:
+            next_read = read_pool.submit(read_audio, all_mixtures_path[0], sr)
+        for i, path in enumerate(all_mixtures_path):
+            print("Starting processing track: ", path)
+            read = next_read
+            if i + 1 < len(all_mixtures_path):
+                next_read = read_pool.submit(read_audio, all_mixtures_path[i + 1], sr)
+            try:
+                mix = read.result()
+            except Exception as e:
+                print('Cannot read track: {}'.format(path))
+                print('Error message: {}'.format(str(e)))
+                continue
+
             file_name, _ = os.path.splitext(os.path.basename(path))
-            if args.flac_file:
-                output_file = os.path.join(args.store_dir, f"{file_name}_{instr}.flac")
-                subtype = 'PCM_16' if args.pcm_type == 'PCM_16' else 'PCM_24'
-                sf.write(output_file, estimates, sr, subtype=subtype)
-            else:
-                output_file = os.path.join(args.store_dir, f"{file_name}_{instr}.wav")
-                sf.write(output_file, estimates, sr, subtype='FLOAT')
+            inputs = [(file_name, mix)]
+            try:
+                for stage_index, (model, args, config, device) in enumerate(stages):
+                    last = stage_index == len(stages) - 1
+                    next_inputs = []
+                    for name, mix in inputs:
+                        waveforms = separate_track(model, args, config, device, mix, pbar=detailed_pbar)
+                        for instr in waveforms:
+                            stem_name = f"{name}_{instr}"
+                            if any(suffix in stem_name.lower() for suffix in INSTRUMENTAL_SUFFIXES):
+                                output_file, subtype = get_output_file(args, os.path.join(args.store_dir, 'instrumental'), stem_name)
+                                write_pool.submit(write_stem, output_file, waveforms[instr], sr, subtype)
+                                continue
+                            if last or save_intermediate:
+                                output_file, subtype = get_output_file(args, args.store_dir, stem_name)
+                                write_pool.submit(write_stem, output_file, waveforms[instr], sr, subtype)
+                            if not last:
+                                next_inputs.append((stem_name, waveforms[instr].astype(np.float32)))
+                    inputs = next_inputs
+            except Exception as e:
+                print('Cannot process track: {}'.format(path))
+                print('Error message: {}'.format(str(e)))
+    finally:
+        read_pool.shutdown(wait=True, cancel_futures=True)
+        # Wait until all stems are encoded
+        write_pool.shutdown(wait=True)
 
-    time.sleep(1)
     print("Elapsed time: {:.2f} sec".format(time.time() - start_time))
 
 
-def proc_folder(args):
+def parse_args(args):
     parser = argparse.ArgumentParser()
     parser.add_argument("--model_type", type=str, default='mdx23c', help="One of bandit, bandit_v2, bs_roformer, htdemucs, mdx23c, mel_band_roformer, scnet, scnet_unofficial, segm_models, swin_upernet, torchseg")
     parser.add_argument("--config_path", type=str, help="path to config file")
@@ -129,12 +522,20 @@ def proc_folder(args):
     parser.add_argument("--force_cpu", action = 'store_true', help="Force the use of CPU even if CUDA is available")
     parser.add_argument("--flac_file", action = 'store_true', help="Output flac file instead of wav")
     parser.add_argument("--pcm_type", type=str, choices=['PCM_16', 'PCM_24'], default='PCM_24', help="PCM type for FLAC files (PCM_16 or PCM_24)")
-    parser.add_argument("--use_tta", action='store_true', help="Flag adds test time augmentation during inference (polarity and channel inverse). While this triples the runtime, it reduces noise and slightly improves prediction quality.")
+    parser.add_argument("--use_tta", action='store_true', help="Flag adds test time augmentation during inference (polarity and channel inverse). While this triples the runtime, it reduces noise and slightly improves prediction quality. Variants can be selected with tta_plan in the inference section of config (see tta_calibration.py).")
+    parser.add_argument("--read_workers", type=int, default=2, help="number of background threads decoding the next tracks while the current one is separated")
+    parser.add_argument("--write_workers", type=int, default=2, help="number of background threads encoding output files")
+    parser.add_argument("--cross_track_max_sec", type=float, default=120, help="tracks up to this length (seconds) are separated whole and share chunk batches with the next tracks, longer tracks are streamed. 0 disables")
+    parser.add_argument("--profile", action='store_true', help="record time and memory of every stage (decoding, resampling, model sub-modules, overlap-add, encoding), saves Chrome traces per track and a summary to store_dir/profile")
+    parser.add_argument("--disable_autotune_profile", action='store_true', help="use batch_size from config even if autotune.py made a profile for this config and device")
     if args is None:
         args = parser.parse_args()
     else:
         args = parser.parse_args(args)
+    return args
 
+
+def get_device(args):
     device = "cpu"
     if args.force_cpu:
         device = "cpu"
@@ -146,24 +547,17 @@ def proc_folder(args):
         device = "mps"
 
     print("Using device: ", device)
+    return device
+
 
+def load_model(args, device):
     model_load_start_time = time.time()
     torch.backends.cudnn.benchmark = True
 
     model, config = get_model_from_config(args.model_type, args.config_path)
     if args.start_check_point != '':
         print('Start from checkpoint: {}'.format(args.start_check_point))
-        if args.model_type in ['htdemucs', 'apollo']:
-            state_dict = torch.load(args.start_check_point, map_location=device, weights_only=False)
-            # Fix for htdemucs pretrained models
-            if 'state' in state_dict:
-                state_dict = state_dict['state']
-            # Fix for apollo pretrained models
-            if 'state_dict' in state_dict:
-                state_dict = state_dict['state_dict']
-        else:
-            state_dict = torch.load(args.start_check_point, map_location=device, weights_only=True)
-        model.load_state_dict(state_dict)
+        load_checkpoint(model, args.model_type, args.start_check_point, device)
     print("Instruments: {}".format(config.training.instruments))
 
     # in case multiple CUDA GPUs are used and --device_ids arg is passed
@@ -173,7 +567,15 @@ def proc_folder(args):
     model = model.to(device)
 
     print("Model load time: {:.2f} sec".format(time.time() - model_load_start_time))
+    return model, config
 
+
+def proc_folder(args):
+    args = parse_args(args)
+    device = get_device(args)
+    model, config = load_model(args, device)
+    if not args.disable_autotune_profile:
+        apply_tuning_profile(args.model_type, args.config_path, config, device)
     run_folder(model, args, config, device, verbose=True)
 
 
@@ -0,0 +1,248 @@
+# coding: utf-8
+
+# Long-lived inference process: models stay loaded between jobs, so chained
+# GUI stages don't pay for interpreter start, torch import and weight loading
+# again on every stage.
+#
+# Protocol is one JSON object per line.
+# Requests (stdin):
+#   {"id": 1, "cmd": "run", "args": [<inference.py arguments>]}
+#   {"id": 2, "cmd": "pipeline", "stages": [[<inference.py arguments>], ...], "save_intermediate": false}
+#   {"id": 3, "cmd": "unload"}
+# "pin": true in run/pipeline requests keeps their models loaded regardless of the budget,
+# until the model is released with
+#   {"id": 4, "cmd": "unpin", "args": [<inference.py arguments of the model>]}
+#   {"id": 5, "cmd": "exit"}
+# A pipeline reads --input_folder of the first stage and passes stems to the next
+# stages in memory (see inference.run_pipeline).
+# Events (stdout):
+#   {"event": "ready"}
+#   {"event": "start", "id": 1}
+#   {"event": "log", "id": 1, "text": "..."}
+#   {"event": "progress", "id": 1, "text": "...", "percent": 45}
+#   {"event": "done", "id": 1, "time": 12.3}
+#   {"event": "error", "id": 1, "message": "..."}
+
+import argparse
+import io
+import json
+import re
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+END_EVENTS = ('done', 'error')
+PERCENT_RE = re.compile(r'(\d+)%\|')
+ANSI_RE = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+
+
+class EventStream(io.TextIOBase):
+    # Replaces sys.stdout/sys.stderr in the worker: print() lines become log
+    # events and carriage return updates (tqdm) become progress events
+    def __init__(self, emit):
+        self.emit = emit
+        self.job_id = None
+        self.pending = ''
+        self.lock = threading.Lock()
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        with self.lock:
+            self.pending += text
+            while True:
+                pos = min([p for p in (self.pending.find('\n'), self.pending.find('\r')) if p != -1], default=-1)
+                if pos == -1:
+                    break
+                line = ANSI_RE.sub('', self.pending[:pos]).strip()
+                end = self.pending[pos]
+                self.pending = self.pending[pos + 1:]
+                if line == '':
+                    continue
+                if end == '\r':
+                    match = PERCENT_RE.search(line)
+                    self.emit('progress', id=self.job_id, text=line, percent=int(match.group(1)) if match else None)
+                else:
+                    self.emit('log', id=self.job_id, text=line)
+        return len(text)
+
+
+def serve(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ram_budget_gb", type=float, default=None, help="max size of models kept loaded on CPU, least recently used are unloaded first (default: no limit)")
+    parser.add_argument("--vram_budget_gb", type=float, default=None, help="max size of models kept loaded on each GPU (default: no limit)")
+    if args is None:
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args(args)
+
+    protocol_out = sys.stdout
+    protocol_lock = threading.Lock()
+
+    def emit(event, **fields):
+        fields['event'] = event
+        with protocol_lock:
+            protocol_out.write(json.dumps(fields) + '\n')
+            protocol_out.flush()
+
+    stream = EventStream(emit)
+    sys.stdout = stream
+    sys.stderr = stream
+
+    from inference import parse_args, get_device, run_folder, run_pipeline
+    from utils import apply_tuning_profile
+    from model_cache import ModelCache
+
+    def get_budget(budget_gb):
+        return None if budget_gb is None else int(budget_gb * 1024 ** 3)
+
+    models = ModelCache(ram_budget=get_budget(args.ram_budget_gb), vram_budget=get_budget(args.vram_budget_gb))
+
+    emit('ready')
+    for line in sys.stdin:
+        line = line.strip()
+        if line == '':
+            continue
+        job_id = None
+        try:
+            request = json.loads(line)
+            job_id = request.get('id')
+            stream.job_id = job_id
+            if request['cmd'] == 'exit':
+                emit('done', id=job_id, time=0.0)
+                break
+            emit('start', id=job_id)
+            start_time = time.time()
+            if request['cmd'] == 'unload':
+                models.clear()
+            elif request['cmd'] == 'unpin':
+                args = parse_args(request['args'])
+                if not models.unpin(args, get_device(args)):
+                    print('Model is not loaded: {}'.format(args.start_check_point))
+            elif request['cmd'] == 'run':
+                args = parse_args(request['args'])
+                device = get_device(args)
+                model, config = models.get(args, device, pin=request.get('pin', False))
+                if not args.disable_autotune_profile:
+                    apply_tuning_profile(args.model_type, args.config_path, config, device)
+                run_folder(model, args, config, device, verbose=True)
+            elif request['cmd'] == 'pipeline':
+                if len(request['stages']) == 0:
+                    raise ValueError('Pipeline has no stages')
+                stages = []
+                # Models of all stages are pinned until the request is done, so loading a later
+                # stage can't evict an earlier one
+                held = []
+                try:
+                    for stage_args in request['stages']:
+                        args = parse_args(stage_args)
+                        device = get_device(args)
+                        if not request.get('pin', False) and not models.is_pinned(args, device):
+                            held.append((args, device))
+                        model, config = models.get(args, device, pin=True)
+                        if not args.disable_autotune_profile:
+                            apply_tuning_profile(args.model_type, args.config_path, config, device)
+                        stages.append((model, args, config, device))
+                    run_pipeline(stages, stages[0][1].input_folder, save_intermediate=request.get('save_intermediate', False), verbose=True)
+                finally:
+                    for args, device in held:
+                        models.unpin(args, device)
+            else:
+                raise ValueError('Unknown command: {}'.format(request['cmd']))
+            emit('done', id=job_id, time=time.time() - start_time)
+        except (Exception, SystemExit) as e:
+            # argparse exits on bad arguments (and prints the usage), that must not kill the worker
+            if not isinstance(e, SystemExit):
+                traceback.print_exc()
+            emit('error', id=job_id, message='{}: {}'.format(type(e).__name__, e))
+        stream.job_id = None
+
+
+class InferenceWorkerClient:
+    # Used by the GUI to talk to a worker started with the inference environment,
+    # e.g. InferenceWorkerClient('.\\env\\python.exe inference_worker.py')
+    def __init__(self, command, env=None):
+        self.command = command
+        self.env = env
+        self.process = None
+        self.job_counter = 0
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        if self.is_alive():
+            return
+        self.process = subprocess.Popen(self.command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, text=True, bufsize=1, env=self.env)
+
+    def send(self, cmd, **fields):
+        self.job_counter += 1
+        fields.update(id=self.job_counter, cmd=cmd)
+        self.process.stdin.write(json.dumps(fields) + '\n')
+        self.process.stdin.flush()
+        return self.job_counter
+
+    def request(self, cmd, **fields):
+        # Yields events of the request until it is done or failed. Lines that
+        # are not JSON (e.g. interpreter errors before startup) come as log events
+        self.start()
+        process = self.process
+        try:
+            job_id = self.send(cmd, **fields)
+        except OSError:
+            yield {'event': 'error', 'id': None, 'message': 'Inference worker is not running'}
+            return
+        for line in process.stdout:
+            line = line.strip()
+            if line == '':
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError:
+                event = {'event': 'log', 'id': None, 'text': line}
+            yield event
+            if event['event'] in END_EVENTS and event.get('id') == job_id:
+                return
+        yield {'event': 'error', 'id': job_id, 'message': 'Inference worker exited with code {}'.format(process.wait())}
+
+    def run(self, args, pin=False):
+        return self.request('run', args=args, pin=pin)
+
+    def run_pipeline(self, stages, save_intermediate=False, pin=False):
+        return self.request('pipeline', stages=stages, save_intermediate=save_intermediate, pin=pin)
+
+    def unpin(self, args):
+        return self.request('unpin', args=args)
+
+    def shutdown(self, timeout=5):
+        if self.is_alive():
+            try:
+                self.send('exit')
+                self.process.wait(timeout=timeout)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+        self.terminate()
+
+    def terminate(self):
+        import psutil
+        if self.process is not None:
+            try:
+                parent = psutil.Process(self.process.pid)
+                children = parent.children(recursive=True)
+                for child in children:
+                    child.terminate()
+                parent.terminate()
+                gone, still_alive = psutil.wait_procs(children + [parent], timeout=5)
+                for p in still_alive:
+                    p.kill()
+            except psutil.NoSuchProcess:
+                pass
+        self.process = None
+
+
+if __name__ == "__main__":
+    serve(None)
@@ -0,0 +1,149 @@
+# coding: utf-8
+
+import copy
+import hashlib
+import os
+import time
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+from utils import get_model_from_config, load_checkpoint
+
+_checkpoint_hashes = dict()
+
+
+def get_checkpoint_hash(checkpoint_path, sample_size=1 << 20):
+    """
+    Content fingerprint of a checkpoint: file size plus the first and last sample_size bytes.
+    Hashing whole multi-GB checkpoints would cost about as much as loading them. Results are
+    memoized while the file size and modification time stay the same.
+    """
+    stat = os.stat(checkpoint_path)
+    memo_key = (os.path.abspath(checkpoint_path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _checkpoint_hashes:
+        digest = hashlib.sha1(str(stat.st_size).encode())
+        with open(checkpoint_path, 'rb') as f:
+            digest.update(f.read(sample_size))
+            if stat.st_size > sample_size:
+                f.seek(max(stat.st_size - sample_size, sample_size))
+                digest.update(f.read(sample_size))
+        _checkpoint_hashes[memo_key] = digest.hexdigest()
+    return _checkpoint_hashes[memo_key]
+
+
+def get_model_size(model):
+    # Bytes taken by parameters and buffers
+    size = 0
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        size += tensor.numel() * tensor.element_size()
+    return size
+
+
+class ModelCache:
+    """
+    Keeps constructed models with loaded weights between runs. Entries are keyed by
+    (model_type, config_path, checkpoint hash, device, dtype). When models on CPU exceed
+    ram_budget or models on a GPU exceed vram_budget (bytes, None for no limit), the least
+    recently used entries which are not pinned are evicted.
+    """
+    def __init__(self, ram_budget=None, vram_budget=None):
+        self.ram_budget = ram_budget
+        self.vram_budget = vram_budget
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def get_key(args, device, dtype=torch.float32):
+        checkpoint_hash = ''
+        if args.start_check_point != '':
+            checkpoint_hash = get_checkpoint_hash(args.start_check_point)
+        device = str(device)
+        if type(args.device_ids) == list and len(args.device_ids) > 1 and not args.force_cpu:
+            device += ' {}'.format(args.device_ids)
+        return args.model_type, os.path.abspath(args.config_path), checkpoint_hash, device, str(dtype)
+
+    def get(self, args, device, dtype=torch.float32, pin=False):
+        # Same as inference.load_model, but returns the cached (model, config) if possible. config is
+        # a copy, so settings changed by one request don't leak into the next ones
+        key = self.get_key(args, device, dtype)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            entry = self.entries[key]
+            entry['pinned'] = entry['pinned'] or pin
+            print('Use already loaded model: {}'.format(args.start_check_point))
+            return entry['model'], copy.deepcopy(entry['config'])
+
+        model_load_start_time = time.time()
+        torch.backends.cudnn.benchmark = True
+
+        # Weights are loaded on CPU first, so there is room on device before the model is moved
+        model, config = get_model_from_config(args.model_type, args.config_path)
+        if args.start_check_point != '':
+            print('Start from checkpoint: {}'.format(args.start_check_point))
+            load_checkpoint(model, args.model_type, args.start_check_point)
+        print("Instruments: {}".format(config.training.instruments))
+        model = model.to(dtype=dtype)
+        size = get_model_size(model)
+        self.evict(str(device), size)
+
+        # in case multiple CUDA GPUs are used and --device_ids arg is passed
+        if type(args.device_ids) == list and len(args.device_ids) > 1 and not args.force_cpu:
+            model = nn.DataParallel(model, device_ids=args.device_ids)
+        model = model.to(device)
+
+        self.entries[key] = {
+            'model': model,
+            'config': config,
+            'size': size,
+            'device': str(device),
+            'pinned': pin,
+            'name': args.start_check_point,
+        }
+        print("Model load time: {:.2f} sec".format(time.time() - model_load_start_time))
+        return model, copy.deepcopy(config)
+
+    def is_pinned(self, args, device, dtype=torch.float32):
+        key = self.get_key(args, device, dtype)
+        return key in self.entries and self.entries[key]['pinned']
+
+    def get_budget(self, device):
+        if device == 'cpu':
+            return self.ram_budget
+        return self.vram_budget
+
+    def evict(self, device, size):
+        # Free room for size bytes on device, least recently used models go first
+        budget = self.get_budget(device)
+        if budget is None:
+            return
+        used = sum(entry['size'] for entry in self.entries.values() if entry['device'] == device)
+        for key in list(self.entries.keys()):
+            if used + size <= budget:
+                break
+            entry = self.entries[key]
+            if entry['device'] != device or entry['pinned']:
+                continue
+            print('Unload model: {} ({:.2f} GB)'.format(entry['name'], entry['size'] / 1024 ** 3))
+            used -= entry['size']
+            del self.entries[key]
+        if used + size > budget:
+            print('Warning: models on {} take {:.2f} GB with budget {:.2f} GB (pinned models are never unloaded)'.format(
+                device, (used + size) / 1024 ** 3, budget / 1024 ** 3))
+        if device.startswith('cuda'):
+            torch.cuda.empty_cache()
+
+    def unpin(self, args, device, dtype=torch.float32):
+        # Makes a pinned model evictable again, models over the budget are unloaded right away
+        key = self.get_key(args, device, dtype)
+        if key not in self.entries:
+            return False
+        entry = self.entries[key]
+        entry['pinned'] = False
+        self.evict(entry['device'], 0)
+        return True
+
+    def clear(self):
+        self.entries.clear()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
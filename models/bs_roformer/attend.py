@@ -2,6 +2,7 @@ from functools import wraps
 from packaging import version
 from collections import namedtuple
 
+import math
 import os
 import torch
 from torch import nn, einsum
@@ -41,10 +42,12 @@ class Attend(nn.Module):
         self,
         dropout = 0.,
         flash = False,
-        scale = None
+        scale = None,
+        window_size = None
     ):
         super().__init__()
         self.scale = scale
+        self.window_size = window_size
         self.dropout = dropout
         self.attn_dropout = nn.Dropout(dropout)
 
@@ -94,6 +97,49 @@ class Attend(nn.Module):
 
         return out
 
+    def local_attn(self, q, k, v):
+        """
+        sliding window attention, every position attends to window_size positions on each side.
+        computed in blocks of window_size queries against their block and both neighbours,
+        so time and memory grow linearly with sequence length
+        """
+        n, w, device = q.shape[-2], self.window_size, q.device
+        scale = default(self.scale, q.shape[-1] ** -0.5)
+
+        padded_len = math.ceil(n / w) * w
+        num_blocks = padded_len // w
+
+        q = F.pad(q, (0, 0, 0, padded_len - n))
+        k, v = (F.pad(t, (0, 0, w, padded_len - n + w)) for t in (k, v))
+
+        # (b, h, blocks, w, d) queries and (b, h, blocks, 3w, d) keys / values
+        q = q.unflatten(-2, (num_blocks, w))
+        k, v = (t.unfold(-2, 3 * w, w).transpose(-1, -2) for t in (k, v))
+
+        q_pos = torch.arange(padded_len, device = device).view(num_blocks, w)
+        k_pos = torch.arange(-w, padded_len + w, device = device).unfold(0, 3 * w, w)
+        mask = ((k_pos[:, None, :] - q_pos[:, :, None]).abs() <= w) & (k_pos >= 0)[:, None, :] & (k_pos < n)[:, None, :]
+
+        if self.flash:
+            # memory efficient / math kernels, flash kernels don't take a mask
+            # scale is applied to q as in flash_attn, the scale argument needs pytorch 2.1
+            if exists(self.scale):
+                q = q * (scale / q.shape[-1] ** -0.5)
+
+            out = F.scaled_dot_product_attention(
+                q, k, v,
+                attn_mask = mask,
+                dropout_p = self.dropout if self.training else 0.
+            )
+        else:
+            sim = einsum("b h n i d, b h n j d -> b h n i j", q, k) * scale
+            sim = sim.masked_fill(~mask, -torch.finfo(sim.dtype).max)
+            attn = sim.softmax(dim=-1)
+            attn = self.attn_dropout(attn)
+            out = einsum("b h n i j, b h n j d -> b h n i d", attn, v)
+
+        return out.flatten(-3, -2)[..., :n, :]
+
     def forward(self, q, k, v):
         """
         einstein notation
@@ -107,6 +153,9 @@ class Attend(nn.Module):
 
         scale = default(self.scale, q.shape[-1] ** -0.5)
 
+        if exists(self.window_size) and k_len > self.window_size + 1:
+            return self.local_attn(q, k, v)
+
         if self.flash:
             return self.flash_attn(q, k, v)
 
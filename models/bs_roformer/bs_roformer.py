@@ -6,6 +6,7 @@ from torch.nn import Module, ModuleList
 import torch.nn.functional as F
 
 from models.bs_roformer.attend import Attend
+from models.bs_roformer.fused_bands import FusedBandSplit, FusedMaskEstimator
 from torch.utils.checkpoint import checkpoint
 
 from beartype.typing import Tuple, Optional, List, Callable
@@ -82,7 +83,8 @@ class Attention(Module):
             dim_head=64,
             dropout=0.,
             rotary_embed=None,
-            flash=True
+            flash=True,
+            window_size=None
     ):
         super().__init__()
         self.heads = heads
@@ -91,7 +93,7 @@ class Attention(Module):
 
         self.rotary_embed = rotary_embed
 
-        self.attend = Attend(flash=flash, dropout=dropout)
+        self.attend = Attend(flash=flash, dropout=dropout, window_size=window_size)
 
         self.norm = RMSNorm(dim)
         self.to_qkv = nn.Linear(dim, dim_inner * 3, bias=False)
@@ -189,7 +191,8 @@ class Transformer(Module):
             norm_output=True,
             rotary_embed=None,
             flash_attn=True,
-            linear_attn=False
+            linear_attn=False,
+            window_size=None
     ):
         super().__init__()
         self.layers = ModuleList([])
@@ -199,7 +202,7 @@ class Transformer(Module):
                 attn = LinearAttention(dim=dim, dim_head=dim_head, heads=heads, dropout=attn_dropout, flash=flash_attn)
             else:
                 attn = Attention(dim=dim, dim_head=dim_head, heads=heads, dropout=attn_dropout,
-                                 rotary_embed=rotary_embed, flash=flash_attn)
+                                 rotary_embed=rotary_embed, flash=flash_attn, window_size=window_size)
 
             self.layers.append(ModuleList([
                 attn,
@@ -360,6 +363,8 @@ class BSRoformer(Module):
             mlp_expansion_factor=4,
             use_torch_checkpoint=False,
             skip_connection=False,
+            fused_bands=False,  # run all bands of band split and mask estimators with batched matmuls (models/bs_roformer/fused_bands.py)
+            time_window_size=None,  # frames on each side the time transformers attend to (sliding window), None - whole chunk
     ):
         super().__init__()
 
@@ -389,7 +394,8 @@ class BSRoformer(Module):
             if linear_transformer_depth > 0:
                 tran_modules.append(Transformer(depth=linear_transformer_depth, linear_attn=True, **transformer_kwargs))
             tran_modules.append(
-                Transformer(depth=time_transformer_depth, rotary_embed=time_rotary_embed, **transformer_kwargs)
+                Transformer(depth=time_transformer_depth, rotary_embed=time_rotary_embed, window_size=time_window_size,
+                            **transformer_kwargs)
             )
             tran_modules.append(
                 Transformer(depth=freq_transformer_depth, rotary_embed=freq_rotary_embed, **transformer_kwargs)
@@ -415,20 +421,33 @@ class BSRoformer(Module):
 
         freqs_per_bands_with_complex = tuple(2 * f * self.audio_channels for f in freqs_per_bands)
 
-        self.band_split = BandSplit(
-            dim=dim,
-            dim_inputs=freqs_per_bands_with_complex
-        )
+        if fused_bands:
+            self.band_split = FusedBandSplit(
+                dim=dim,
+                dim_inputs=freqs_per_bands_with_complex
+            )
+        else:
+            self.band_split = BandSplit(
+                dim=dim,
+                dim_inputs=freqs_per_bands_with_complex
+            )
 
         self.mask_estimators = nn.ModuleList([])
 
         for _ in range(num_stems):
-            mask_estimator = MaskEstimator(
-                dim=dim,
-                dim_inputs=freqs_per_bands_with_complex,
-                depth=mask_estimator_depth,
-                mlp_expansion_factor=mlp_expansion_factor,
-            )
+            if fused_bands:
+                mask_estimator = FusedMaskEstimator(
+                    dim=dim,
+                    dim_inputs=freqs_per_bands_with_complex,
+                    hidden_dims=(dim * mlp_expansion_factor,) * (mask_estimator_depth - 1),
+                )
+            else:
+                mask_estimator = MaskEstimator(
+                    dim=dim,
+                    dim_inputs=freqs_per_bands_with_complex,
+                    depth=mask_estimator_depth,
+                    mlp_expansion_factor=mlp_expansion_factor,
+                )
 
             self.mask_estimators.append(mask_estimator)
 
@@ -444,38 +463,15 @@ class BSRoformer(Module):
             normalized=multi_stft_normalized
         )
 
-    def forward(
-            self,
-            raw_audio,
-            target=None,
-            return_loss_breakdown=False
-    ):
+    def stft(self, raw_audio):
         """
-        einops
-
-        b - batch
-        f - freq
-        t - time
-        s - audio channel (1 for mono, 2 for stereo)
-        n - number of 'stems'
-        c - complex (2)
-        d - feature dimension
+        (b, s, t) audio -> (b, (f s), t, c) STFT as real and imaginary parts, stereo merged into the frequency
         """
-
         device = raw_audio.device
 
         # defining whether model is loaded on MPS (MacOS GPU accelerator)
         x_is_mps = True if device.type == "mps" else False
 
-        if raw_audio.ndim == 2:
-            raw_audio = rearrange(raw_audio, 'b t -> b 1 t')
-
-        channels = raw_audio.shape[1]
-        assert (not self.stereo and channels == 1) or (
-                    self.stereo and channels == 2), 'stereo needs to be set to True if passing in audio signal that is stereo (channel dimension of 2). also need to be False if mono (channel dimension of 1)'
-
-        # to stft
-
         raw_audio, batch_audio_channel_packed_shape = pack_one(raw_audio, '* t')
 
         stft_window = self.stft_window_fn(device=device)
@@ -492,7 +488,33 @@ class BSRoformer(Module):
         stft_repr = unpack_one(stft_repr, batch_audio_channel_packed_shape, '* f t c')
         stft_repr = rearrange(stft_repr,
                               'b s f t c -> b (f s) t c')  # merge stereo / mono into the frequency, with frequency leading dimension, for band splitting
+        return stft_repr
+
+    def istft(self, stft_repr, length=None):
+        """
+        (b, n, (f s), t) complex STFT of stems -> (b, n, s, t) audio
+        """
+        device = stft_repr.device
+        x_is_mps = True if device.type == "mps" else False
+        num_stems = stft_repr.shape[1]
+        stft_window = self.stft_window_fn(device=device)
 
+        stft_repr = rearrange(stft_repr, 'b n (f s) t -> (b n s) f t', s=self.audio_channels)
+
+        # same as torch.stft() fix for MacOS MPS above
+        try:
+            recon_audio = torch.istft(stft_repr, **self.stft_kwargs, window=stft_window, return_complex=False, length=length)
+        except:
+            recon_audio = torch.istft(stft_repr.cpu() if x_is_mps else stft_repr, **self.stft_kwargs, window=stft_window.cpu() if x_is_mps else stft_window, return_complex=False, length=length).to(device)
+
+        recon_audio = rearrange(recon_audio, '(b n s) t -> b n s t', s=self.audio_channels, n=num_stems)
+        return recon_audio
+
+    def forward_masks(self, stft_repr):
+        """
+        (b, (f s), t, c) STFT from self.stft -> (b, n, (f s), t) complex masks of stems. Spectrogram
+        in, masks out: lets inference chunk and overlap-add in the STFT domain (utils.demix_spectral)
+        """
         x = rearrange(stft_repr, 'b f t c -> b t (f c)')
 
         if self.use_torch_checkpoint:
@@ -546,13 +568,46 @@ class BSRoformer(Module):
 
         x = self.final_norm(x)
 
-        num_stems = len(self.mask_estimators)
-
         if self.use_torch_checkpoint:
             mask = torch.stack([checkpoint(fn, x, use_reentrant=False) for fn in self.mask_estimators], dim=1)
         else:
             mask = torch.stack([fn(x) for fn in self.mask_estimators], dim=1)
         mask = rearrange(mask, 'b n t (f c) -> b n f t c', c=2)
+        return torch.view_as_complex(mask)
+
+    def forward(
+            self,
+            raw_audio,
+            target=None,
+            return_loss_breakdown=False
+    ):
+        """
+        einops
+
+        b - batch
+        f - freq
+        t - time
+        s - audio channel (1 for mono, 2 for stereo)
+        n - number of 'stems'
+        c - complex (2)
+        d - feature dimension
+        """
+
+        device = raw_audio.device
+
+        if raw_audio.ndim == 2:
+            raw_audio = rearrange(raw_audio, 'b t -> b 1 t')
+
+        channels = raw_audio.shape[1]
+        assert (not self.stereo and channels == 1) or (
+                    self.stereo and channels == 2), 'stereo needs to be set to True if passing in audio signal that is stereo (channel dimension of 2). also need to be False if mono (channel dimension of 1)'
+
+        # to stft
+
+        stft_repr = self.stft(raw_audio)
+
+        mask = self.forward_masks(stft_repr)
+        num_stems = mask.shape[1]
 
         # modulate frequency representation
 
@@ -561,21 +616,12 @@ class BSRoformer(Module):
         # complex number multiplication
 
         stft_repr = torch.view_as_complex(stft_repr)
-        mask = torch.view_as_complex(mask)
 
         stft_repr = stft_repr * mask
 
         # istft
 
-        stft_repr = rearrange(stft_repr, 'b n (f s) t -> (b n s) f t', s=self.audio_channels)
-
-        # same as torch.stft() fix for MacOS MPS above
-        try:
-            recon_audio = torch.istft(stft_repr, **self.stft_kwargs, window=stft_window, return_complex=False, length=raw_audio.shape[-1])
-        except:
-            recon_audio = torch.istft(stft_repr.cpu() if x_is_mps else stft_repr, **self.stft_kwargs, window=stft_window.cpu() if x_is_mps else stft_window, return_complex=False, length=raw_audio.shape[-1]).to(device)
-
-        recon_audio = rearrange(recon_audio, '(b n s) t -> b n s t', s=self.audio_channels, n=num_stems)
+        recon_audio = self.istft(stft_repr, length=raw_audio.shape[-1])
 
         if num_stems == 1:
             recon_audio = rearrange(recon_audio, 'b 1 s t -> b s t')
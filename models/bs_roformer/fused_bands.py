@@ -0,0 +1,234 @@
+import math
+
+import torch
+from torch import nn
+from torch.nn import Module, ModuleList
+import torch.nn.functional as F
+
+from einops import rearrange
+
+# BandSplit and MaskEstimator running all bands at once, instead of one RMSNorm + Linear / MLP per band.
+# Bands of similar size are grouped, weights of a group are stacked (padded to the largest band in it)
+# and run with one batched matmul. State dicts keep the per-band layout of BandSplit / MaskEstimator,
+# so existing checkpoints load as is and saved ones load into the unfused models.
+
+
+def group_bands(dim_inputs, max_padding=1.25):
+    """
+    Band indices sorted by size, split into groups where the largest band is at most
+    max_padding times the smallest one
+    """
+    order = sorted(range(len(dim_inputs)), key=lambda i: dim_inputs[i])
+    groups = []
+    for i in order:
+        if len(groups) > 0 and dim_inputs[i] <= dim_inputs[groups[-1][0]] * max_padding:
+            groups[-1].append(i)
+        else:
+            groups.append([i])
+    return groups
+
+
+class GroupedLinear(Module):
+    """
+    num_bands separate linear layers
+    """
+    def __init__(self, num_bands, dim_in, dim_out, fan_in=None):
+        super().__init__()
+        self.weight = nn.Parameter(torch.empty(num_bands, dim_in, dim_out))
+        self.bias = nn.Parameter(torch.empty(num_bands, dim_out))
+        # same init as nn.Linear of every band
+        fan_in = [dim_in] * num_bands if fan_in is None else fan_in
+        bound = torch.tensor([1 / math.sqrt(f) for f in fan_in])
+        with torch.no_grad():
+            self.weight.uniform_(-1, 1).mul_(bound[:, None, None])
+            self.bias.uniform_(-1, 1).mul_(bound[:, None])
+
+    def forward(self, x):
+        # band-major input (n, rows, dim_in) -> (n, rows, dim_out), one batched matmul for all bands
+        return torch.baddbmm(self.bias[:, None], x, self.weight)
+
+
+class FusedBandSplit(Module):
+    def __init__(
+            self,
+            dim,
+            dim_inputs,
+            max_padding=1.25
+    ):
+        super().__init__()
+        self.dim_inputs = dim_inputs
+        self.groups = group_bands(dim_inputs, max_padding)
+        self.group_dims = [max(dim_inputs[i] for i in group) for group in self.groups]
+
+        self.group_gammas = nn.ParameterList([])
+        self.group_linears = ModuleList([])
+        offsets = [0]
+        for dim_in in dim_inputs:
+            offsets.append(offsets[-1] + dim_in)
+        input_index = []
+        scales = []
+        for group, group_dim in zip(self.groups, self.group_dims):
+            self.group_gammas.append(nn.Parameter(torch.ones(len(group), group_dim)))
+            self.group_linears.append(GroupedLinear(len(group), group_dim, dim, fan_in=[dim_inputs[i] for i in group]))
+            for i in group:
+                input_index += list(range(offsets[i], offsets[i + 1])) + [offsets[-1]] * (group_dim - dim_inputs[i])
+            scales.append(torch.tensor([dim_inputs[i] ** 0.5 for i in group])[:, None])
+
+        band_order = torch.empty(len(dim_inputs), dtype=torch.long)
+        band_order[[i for group in self.groups for i in group]] = torch.arange(len(dim_inputs))
+        self.reorder_bands = not torch.equal(band_order, torch.arange(len(dim_inputs)))
+
+        self.register_buffer('input_index', torch.tensor(input_index), persistent=False)
+        self.register_buffer('band_order', band_order, persistent=False)
+        for g, scale in enumerate(scales):
+            self.register_buffer('group_scale_{}'.format(g), scale, persistent=False)
+
+        self._register_state_dict_hook(_fused_band_split_state_dict)
+        self._register_load_state_dict_pre_hook(self._load_per_band_state_dict)
+
+    def forward(self, x):
+        batch = x.shape[0]
+        # padding points to the zero column appended at the end
+        x = F.pad(x, (0, 1)).index_select(-1, self.input_index)
+        x = x.split([len(group) * group_dim for group, group_dim in zip(self.groups, self.group_dims)], dim=-1)
+
+        outs = []
+        for g, (group_x, gamma, linear) in enumerate(zip(x, self.group_gammas, self.group_linears)):
+            group_x = group_x.unflatten(-1, (len(self.groups[g]), self.group_dims[g]))
+            # RMSNorm of every band, zero padding doesn't change the norm
+            group_x = F.normalize(group_x, dim=-1) * getattr(self, 'group_scale_{}'.format(g)) * gamma
+            outs.append(linear(rearrange(group_x, 'b t n i -> n (b t) i')))
+
+        x = torch.cat(outs, dim=0)
+        if self.reorder_bands:
+            x = x.index_select(0, self.band_order)
+        return rearrange(x, 'n (b t) d -> b t n d', b=batch)
+
+    def _load_per_band_state_dict(self, state_dict, prefix, *args):
+        # to_features.{band}.0.gamma, to_features.{band}.1.weight/bias -> stacked group tensors
+        if prefix + 'to_features.0.1.weight' not in state_dict:
+            return
+        for g, group in enumerate(self.groups):
+            gamma = torch.ones_like(self.group_gammas[g])
+            weight = torch.zeros_like(self.group_linears[g].weight)
+            bias = torch.zeros_like(self.group_linears[g].bias)
+            for k, i in enumerate(group):
+                band_prefix = prefix + 'to_features.{}.'.format(i)
+                dim_in = self.dim_inputs[i]
+                gamma[k, :dim_in] = state_dict.pop(band_prefix + '0.gamma')
+                weight[k, :dim_in] = state_dict.pop(band_prefix + '1.weight').t()
+                bias[k] = state_dict.pop(band_prefix + '1.bias')
+            state_dict[prefix + 'group_gammas.{}'.format(g)] = gamma
+            state_dict[prefix + 'group_linears.{}.weight'.format(g)] = weight
+            state_dict[prefix + 'group_linears.{}.bias'.format(g)] = bias
+
+
+def _fused_band_split_state_dict(module, state_dict, prefix, local_metadata):
+    for g, group in enumerate(module.groups):
+        gamma = state_dict.pop(prefix + 'group_gammas.{}'.format(g))
+        weight = state_dict.pop(prefix + 'group_linears.{}.weight'.format(g))
+        bias = state_dict.pop(prefix + 'group_linears.{}.bias'.format(g))
+        for k, i in enumerate(group):
+            band_prefix = prefix + 'to_features.{}.'.format(i)
+            dim_in = module.dim_inputs[i]
+            state_dict[band_prefix + '0.gamma'] = gamma[k, :dim_in].clone()
+            state_dict[band_prefix + '1.weight'] = weight[k, :dim_in].t().clone()
+            state_dict[band_prefix + '1.bias'] = bias[k].clone()
+
+
+class FusedMaskEstimator(Module):
+    def __init__(
+            self,
+            dim,
+            dim_inputs,
+            hidden_dims,
+            max_padding=1.25
+    ):
+        super().__init__()
+        self.dim_inputs = dim_inputs
+        self.groups = group_bands(dim_inputs, max_padding)
+        self.group_dims = [max(dim_inputs[i] for i in group) for group in self.groups]
+        self.num_layers = len(hidden_dims) + 1
+
+        self.group_layers = ModuleList([])
+        offset = 0
+        positions = dict()
+        for group, group_dim in zip(self.groups, self.group_dims):
+            dims = (dim, *hidden_dims)
+            # last layer outputs both GLU halves, each padded to group_dim
+            layers = [GroupedLinear(len(group), dim_in, dim_out) for dim_in, dim_out in zip(dims, dims[1:] + (group_dim * 2,))]
+            self.group_layers.append(ModuleList(layers))
+            for k, i in enumerate(group):
+                positions[i] = offset + k * group_dim
+            offset += len(group) * group_dim
+
+        output_index = []
+        for i, dim_in in enumerate(dim_inputs):
+            output_index += range(positions[i], positions[i] + dim_in)
+
+        self.register_buffer('band_index', torch.tensor([i for group in self.groups for i in group]), persistent=False)
+        self.register_buffer('output_index', torch.tensor(output_index), persistent=False)
+        # bands already in order without padding (e.g. equal sized bands of BSRoformer) need no gather
+        self.reorder_outputs = output_index != list(range(offset))
+
+        self._register_state_dict_hook(_fused_mask_estimator_state_dict)
+        self._register_load_state_dict_pre_hook(self._load_per_band_state_dict)
+
+    def forward(self, x):
+        batch = x.shape[0]
+        x = rearrange(x.index_select(-2, self.band_index), 'b t n d -> n (b t) d')
+        x = x.split([len(group) for group in self.groups], dim=0)
+
+        outs = []
+        for group_x, layers in zip(x, self.group_layers):
+            for layer in layers[:-1]:
+                group_x = torch.tanh(layer(group_x))
+            group_x = F.glu(layers[-1](group_x), dim=-1)
+            outs.append(rearrange(group_x, 'n (b t) i -> b t (n i)', b=batch))
+
+        x = torch.cat(outs, dim=-1)
+        if self.reorder_outputs:
+            x = x.index_select(-1, self.output_index)
+        return x
+
+    def _load_per_band_state_dict(self, state_dict, prefix, *args):
+        # to_freqs.{band}.0.{2 * layer}.weight/bias -> stacked group tensors
+        if prefix + 'to_freqs.0.0.0.weight' not in state_dict:
+            return
+        for g, (group, group_dim) in enumerate(zip(self.groups, self.group_dims)):
+            for j, layer in enumerate(self.group_layers[g]):
+                weight = torch.zeros_like(layer.weight)
+                bias = torch.zeros_like(layer.bias)
+                for k, i in enumerate(group):
+                    layer_prefix = prefix + 'to_freqs.{}.0.{}.'.format(i, 2 * j)
+                    band_weight = state_dict.pop(layer_prefix + 'weight').t()
+                    band_bias = state_dict.pop(layer_prefix + 'bias')
+                    if j < self.num_layers - 1:
+                        weight[k] = band_weight
+                        bias[k] = band_bias
+                    else:
+                        dim_in = self.dim_inputs[i]
+                        weight[k, :, :dim_in] = band_weight[:, :dim_in]
+                        weight[k, :, group_dim:group_dim + dim_in] = band_weight[:, dim_in:]
+                        bias[k, :dim_in] = band_bias[:dim_in]
+                        bias[k, group_dim:group_dim + dim_in] = band_bias[dim_in:]
+                state_dict[prefix + 'group_layers.{}.{}.weight'.format(g, j)] = weight
+                state_dict[prefix + 'group_layers.{}.{}.bias'.format(g, j)] = bias
+
+
+def _fused_mask_estimator_state_dict(module, state_dict, prefix, local_metadata):
+    for g, (group, group_dim) in enumerate(zip(module.groups, module.group_dims)):
+        for j in range(module.num_layers):
+            weight = state_dict.pop(prefix + 'group_layers.{}.{}.weight'.format(g, j))
+            bias = state_dict.pop(prefix + 'group_layers.{}.{}.bias'.format(g, j))
+            for k, i in enumerate(group):
+                layer_prefix = prefix + 'to_freqs.{}.0.{}.'.format(i, 2 * j)
+                if j < module.num_layers - 1:
+                    band_weight = weight[k]
+                    band_bias = bias[k]
+                else:
+                    dim_in = module.dim_inputs[i]
+                    band_weight = torch.cat((weight[k, :, :dim_in], weight[k, :, group_dim:group_dim + dim_in]), dim=-1)
+                    band_bias = torch.cat((bias[k, :dim_in], bias[k, group_dim:group_dim + dim_in]))
+                state_dict[layer_prefix + 'weight'] = band_weight.t().clone()
+                state_dict[layer_prefix + 'bias'] = band_bias.clone()
@@ -6,6 +6,7 @@ from torch.nn import Module, ModuleList
 import torch.nn.functional as F
 
 from models.bs_roformer.attend import Attend
+from models.bs_roformer.fused_bands import FusedBandSplit, FusedMaskEstimator
 from torch.utils.checkpoint import checkpoint
 
 from beartype.typing import Tuple, Optional, List, Callable
@@ -91,7 +92,8 @@ class Attention(Module):
             dim_head=64,
             dropout=0.,
             rotary_embed=None,
-            flash=True
+            flash=True,
+            window_size=None
     ):
         super().__init__()
         self.heads = heads
@@ -100,7 +102,7 @@ class Attention(Module):
 
         self.rotary_embed = rotary_embed
 
-        self.attend = Attend(flash=flash, dropout=dropout)
+        self.attend = Attend(flash=flash, dropout=dropout, window_size=window_size)
 
         self.norm = RMSNorm(dim)
         self.to_qkv = nn.Linear(dim, dim_inner * 3, bias=False)
@@ -198,7 +200,8 @@ class Transformer(Module):
             norm_output=True,
             rotary_embed=None,
             flash_attn=True,
-            linear_attn=False
+            linear_attn=False,
+            window_size=None
     ):
         super().__init__()
         self.layers = ModuleList([])
@@ -208,7 +211,7 @@ class Transformer(Module):
                 attn = LinearAttention(dim=dim, dim_head=dim_head, heads=heads, dropout=attn_dropout, flash=flash_attn)
             else:
                 attn = Attention(dim=dim, dim_head=dim_head, heads=heads, dropout=attn_dropout,
-                                 rotary_embed=rotary_embed, flash=flash_attn)
+                                 rotary_embed=rotary_embed, flash=flash_attn, window_size=window_size)
 
             self.layers.append(ModuleList([
                 attn,
@@ -358,6 +361,8 @@ class MelBandRoformer(Module):
             mlp_expansion_factor=4,
             use_torch_checkpoint=False,
             skip_connection=False,
+            fused_bands=False,  # run all bands of band split and mask estimators with batched matmuls (models/bs_roformer/fused_bands.py)
+            time_window_size=None,  # frames on each side the time transformers attend to (sliding window), None - whole chunk
     ):
         super().__init__()
 
@@ -386,7 +391,8 @@ class MelBandRoformer(Module):
             if linear_transformer_depth > 0:
                 tran_modules.append(Transformer(depth=linear_transformer_depth, linear_attn=True, **transformer_kwargs))
             tran_modules.append(
-                Transformer(depth=time_transformer_depth, rotary_embed=time_rotary_embed, **transformer_kwargs)
+                Transformer(depth=time_transformer_depth, rotary_embed=time_rotary_embed, window_size=time_window_size,
+                            **transformer_kwargs)
             )
             tran_modules.append(
                 Transformer(depth=freq_transformer_depth, rotary_embed=freq_rotary_embed, **transformer_kwargs)
@@ -442,24 +448,43 @@ class MelBandRoformer(Module):
         self.register_buffer('num_freqs_per_band', num_freqs_per_band, persistent=False)
         self.register_buffer('num_bands_per_freq', num_bands_per_freq, persistent=False)
 
+        # denominator for averaging the masks of overlapping bands, per (f s) row of the stft, built once
+        # so forward doesn't expand index tensors to (b, n, f, t) for scatter_add on every call
+
+        band_average_denom = repeat(num_bands_per_freq, 'f -> (f r) 1 1', r=self.audio_channels)
+        self.register_buffer('band_average_denom', band_average_denom.float().clamp(min=1e-8), persistent=False)
+
         # band split and mask estimator
 
         freqs_per_bands_with_complex = tuple(2 * f * self.audio_channels for f in num_freqs_per_band.tolist())
 
-        self.band_split = BandSplit(
-            dim=dim,
-            dim_inputs=freqs_per_bands_with_complex
-        )
+        if fused_bands:
+            self.band_split = FusedBandSplit(
+                dim=dim,
+                dim_inputs=freqs_per_bands_with_complex
+            )
+        else:
+            self.band_split = BandSplit(
+                dim=dim,
+                dim_inputs=freqs_per_bands_with_complex
+            )
 
         self.mask_estimators = nn.ModuleList([])
 
         for _ in range(num_stems):
-            mask_estimator = MaskEstimator(
-                dim=dim,
-                dim_inputs=freqs_per_bands_with_complex,
-                depth=mask_estimator_depth,
-                mlp_expansion_factor=mlp_expansion_factor,
-            )
+            if fused_bands:
+                mask_estimator = FusedMaskEstimator(
+                    dim=dim,
+                    dim_inputs=freqs_per_bands_with_complex,
+                    hidden_dims=(dim * mlp_expansion_factor,) * mask_estimator_depth,
+                )
+            else:
+                mask_estimator = MaskEstimator(
+                    dim=dim,
+                    dim_inputs=freqs_per_bands_with_complex,
+                    depth=mask_estimator_depth,
+                    mlp_expansion_factor=mlp_expansion_factor,
+                )
 
             self.mask_estimators.append(mask_estimator)
 
@@ -477,41 +502,13 @@ class MelBandRoformer(Module):
 
         self.match_input_audio_length = match_input_audio_length
 
-    def forward(
-            self,
-            raw_audio,
-            target=None,
-            return_loss_breakdown=False
-    ):
+    def stft(self, raw_audio):
         """
-        einops
-
-        b - batch
-        f - freq
-        t - time
-        s - audio channel (1 for mono, 2 for stereo)
-        n - number of 'stems'
-        c - complex (2)
-        d - feature dimension
+        (b, s, t) audio -> (b, (f s), t, c) STFT as real and imaginary parts, stereo merged into the frequency
         """
-
-        device = raw_audio.device
-
-        if raw_audio.ndim == 2:
-            raw_audio = rearrange(raw_audio, 'b t -> b 1 t')
-
-        batch, channels, raw_audio_length = raw_audio.shape
-
-        istft_length = raw_audio_length if self.match_input_audio_length else None
-
-        assert (not self.stereo and channels == 1) or (
-                    self.stereo and channels == 2), 'stereo needs to be set to True if passing in audio signal that is stereo (channel dimension of 2). also need to be False if mono (channel dimension of 1)'
-
-        # to stft
-
         raw_audio, batch_audio_channel_packed_shape = pack_one(raw_audio, '* t')
 
-        stft_window = self.stft_window_fn(device=device)
+        stft_window = self.stft_window_fn(device=raw_audio.device)
 
         stft_repr = torch.stft(raw_audio, **self.stft_kwargs, window=stft_window, return_complex=True)
         stft_repr = torch.view_as_real(stft_repr)
@@ -519,14 +516,35 @@ class MelBandRoformer(Module):
         stft_repr = unpack_one(stft_repr, batch_audio_channel_packed_shape, '* f t c')
         stft_repr = rearrange(stft_repr,
                               'b s f t c -> b (f s) t c')  # merge stereo / mono into the frequency, with frequency leading dimension, for band splitting
+        return stft_repr
 
-        # index out all frequencies for all frequency ranges across bands ascending in one go
+    def istft(self, stft_repr, length=None):
+        """
+        (b, n, (f s), t) complex STFT of stems -> (b, n, s, t) audio
+        """
+        batch, num_stems = stft_repr.shape[:2]
+        stft_window = self.stft_window_fn(device=stft_repr.device)
+
+        stft_repr = rearrange(stft_repr, 'b n (f s) t -> (b n s) f t', s=self.audio_channels)
+        recon_audio = torch.istft(stft_repr, **self.stft_kwargs, window=stft_window, return_complex=False,
+                                  length=length)
 
-        batch_arange = torch.arange(batch, device=device)[..., None]
+        recon_audio = rearrange(recon_audio, '(b n s) t -> b n s t', b=batch, s=self.audio_channels, n=num_stems)
+        return recon_audio
+
+    def forward_masks(self, stft_repr):
+        """
+        (b, (f s), t, c) STFT from self.stft -> (b, n, (f s), t) complex masks of stems. Spectrogram
+        in, masks out: lets inference chunk and overlap-add in the STFT domain (utils.demix_spectral)
+        """
+        device = stft_repr.device
+        batch = stft_repr.shape[0]
+
+        # index out all frequencies for all frequency ranges across bands ascending in one go
 
         # account for stereo
 
-        x = stft_repr[batch_arange, self.freq_indices]
+        x = stft_repr.index_select(1, self.freq_indices)
 
         # fold the complex (real and imag) into the frequencies dimension
 
@@ -588,40 +606,66 @@ class MelBandRoformer(Module):
             masks = torch.stack([fn(x) for fn in self.mask_estimators], dim=1)
         masks = rearrange(masks, 'b n t (f c) -> b n f t c', c=2)
 
-        # modulate frequency representation
+        # need to average the estimated mask for the overlapped frequencies
+        # index_add_ takes the 1d freq_indices as is, the sum is divided by the cached band count per frequency
 
-        stft_repr = rearrange(stft_repr, 'b f t c -> b 1 f t c')
+        masks_summed = torch.zeros((batch, num_stems) + stft_repr.shape[1:], dtype=stft_repr.dtype, device=device)
+        masks_summed.index_add_(2, self.freq_indices, masks.type(stft_repr.dtype))
 
-        # complex number multiplication
+        masks_averaged = masks_summed / self.band_average_denom
 
-        stft_repr = torch.view_as_complex(stft_repr)
-        masks = torch.view_as_complex(masks)
+        masks_averaged = torch.view_as_complex(masks_averaged)
+        return masks_averaged
 
-        masks = masks.type(stft_repr.dtype)
+    def forward(
+            self,
+            raw_audio,
+            target=None,
+            return_loss_breakdown=False
+    ):
+        """
+        einops
 
-        # need to average the estimated mask for the overlapped frequencies
+        b - batch
+        f - freq
+        t - time
+        s - audio channel (1 for mono, 2 for stereo)
+        n - number of 'stems'
+        c - complex (2)
+        d - feature dimension
+        """
+
+        device = raw_audio.device
+
+        if raw_audio.ndim == 2:
+            raw_audio = rearrange(raw_audio, 'b t -> b 1 t')
+
+        batch, channels, raw_audio_length = raw_audio.shape
 
-        scatter_indices = repeat(self.freq_indices, 'f -> b n f t', b=batch, n=num_stems, t=stft_repr.shape[-1])
+        istft_length = raw_audio_length if self.match_input_audio_length else None
+
+        assert (not self.stereo and channels == 1) or (
+                    self.stereo and channels == 2), 'stereo needs to be set to True if passing in audio signal that is stereo (channel dimension of 2). also need to be False if mono (channel dimension of 1)'
 
-        stft_repr_expanded_stems = repeat(stft_repr, 'b 1 ... -> b n ...', n=num_stems)
-        masks_summed = torch.zeros_like(stft_repr_expanded_stems).scatter_add_(2, scatter_indices, masks)
+        # to stft
 
-        denom = repeat(self.num_bands_per_freq, 'f -> (f r) 1', r=channels)
+        stft_repr = self.stft(raw_audio)
 
-        masks_averaged = masks_summed / denom.clamp(min=1e-8)
+        masks_averaged = self.forward_masks(stft_repr)
+        num_stems = masks_averaged.shape[1]
 
         # modulate stft repr with estimated mask
 
-        stft_repr = stft_repr * masks_averaged
+        stft_repr = rearrange(stft_repr, 'b f t c -> b 1 f t c')
+        stft_repr = torch.view_as_complex(stft_repr)
 
-        # istft
+        # complex number multiplication
 
-        stft_repr = rearrange(stft_repr, 'b n (f s) t -> (b n s) f t', s=self.audio_channels)
+        stft_repr = stft_repr * masks_averaged
 
-        recon_audio = torch.istft(stft_repr, **self.stft_kwargs, window=stft_window, return_complex=False,
-                                  length=istft_length)
+        # istft
 
-        recon_audio = rearrange(recon_audio, '(b n s) t -> b n s t', b=batch, s=self.audio_channels, n=num_stems)
+        recon_audio = self.istft(stft_repr, length=istft_length)
 
         if num_stems == 1:
             recon_audio = rearrange(recon_audio, 'b 1 s t -> b s t')
@@ -6,7 +6,6 @@ import json
 import subprocess
 import time
 import psutil
-import shutil
 import pynvml
 import platform
 import copy
@@ -20,6 +19,7 @@ from PyQt5.QtCore import Qt, QThread, pyqtSignal, QSize, QTimer, QMutex, QWaitCo
 from PyQt5.QtGui import QFont, QIcon, QColor, QTextCharFormat, QTextCursor, QPainter, QPixmap, QDesktopServices, QFontInfo
 import resources_rc
 from archive import archive_folders
+from inference_worker import InferenceWorkerClient
 import tempfile
 
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
@@ -185,30 +185,6 @@ def load_or_create_config():
         return json.load(f)
 
 
-def organize_instrumental_files(store_dir):
-    instrumental_dir = os.path.join(store_dir, "instrumental")
-    if not os.path.exists(instrumental_dir):
-        os.makedirs(instrumental_dir)
-
-    moved_files = 0
-    start_time = time.time()
-    inst_lower = ['_instrumental', '_aspiration']
-
-    for filename in os.listdir(store_dir):
-        for lower in inst_lower:
-            if lower in filename.lower():
-                src_path = os.path.join(store_dir, filename)
-                dst_path = os.path.join(instrumental_dir, filename)
-                shutil.move(src_path, dst_path)
-                moved_files += 1
-
-    end_time = time.time()
-    logger.info(f"Organized {moved_files} instrumental files in {store_dir}")
-    logger.info(f"Time taken to organize files: {end_time - start_time:.2f} seconds")
-
-    return moved_files, end_time - start_time
-
-
 class SystemInfoThread(QThread):
     info_signal = pyqtSignal(str, str, bool, bool, bool)
 
@@ -341,14 +317,13 @@ class CustomComboBox(QComboBox):
 class InferenceThread(QThread):
     update_signal = pyqtSignal(str, bool)  # bool use for tqdm
     finished_signal = pyqtSignal(dict)
-    file_organization_signal = pyqtSignal(int, float)
 
-    def __init__(self, commands, input_folder):
+    def __init__(self, worker, commands, input_folder):
         super().__init__()
+        self.worker = worker
         self.commands = commands
         self.input_folder = input_folder
         self.is_running = True
-        self.process = None
 
     @staticmethod
     def extract_env_path(command):
@@ -380,41 +355,36 @@ class InferenceThread(QThread):
         summary["total_files"] = total_files
         logger.info(f"Total files in input folder: {total_files}")
 
-        for command, store_dir in self.commands:
-            if not self.is_running:
-                break
-            logger.info(f"Starting inference with command: {command}")
+        for command, args, store_dir in self.commands:
+            logger.info(f"Pipeline stage: {command}")
             self.update_signal.emit(f"使用模块: {module_names[store_dir]}", False)
             self.update_signal.emit(f"命令: {command}", False)
-            env_path = self.extract_env_path(command)
-            new_paths = f'{env_path}Scripts;{env_path}bin;{env_path};'
-            if new_paths not in env['PATH']:
-                env['PATH'] = new_paths + env['PATH']
-            self.process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                                            text=True, universal_newlines=True, env=env)
-            for line in self.process.stdout:
-                if not self.is_running:
-                    break
-                stripped_line = line.strip()
-                if line.startswith('\r') or "it/s]" in line:  # if is tqdm
-                    self.update_signal.emit(stripped_line, True)
-                else:
-                    self.update_signal.emit(stripped_line, False)
-                logger.debug(stripped_line)
-                if "error" in line.lower():
-                    summary["errors"] += 1
-            if self.is_running:
-                self.process.wait()
+        env_path = self.extract_env_path(self.worker.command)
+        new_paths = f'{env_path}Scripts;{env_path}bin;{env_path};'
+        if new_paths not in env['PATH']:
+            env['PATH'] = new_paths + env['PATH']
+        # All stages run in one worker request, stems are passed between them in memory. Stems of
+        # every stage are still written to its store_dir. The worker keeps models loaded between
+        # runs, it is started on first use
+        for event in self.worker.run_pipeline([args for _, args, _ in self.commands], save_intermediate=True):
+            if not self.is_running:
+                break
+            if event['event'] == 'progress':
+                self.update_signal.emit(event['text'], True)
+                continue
+            text = event.get('text', event.get('message'))
+            if text is None:
+                continue
+            self.update_signal.emit(text, False)
+            logger.debug(text)
+            if event['event'] == 'error' or "error" in text.lower():
+                summary["errors"] += 1
+        if self.is_running:
+            for _, _, store_dir in self.commands:
                 summary["modules"].append((module_names[store_dir], store_dir))
-                logger.info(f"Module {module_names[store_dir]} completed. ")
-
-                # Make sure all files are organized before continuing
-                moved_files, time_taken = organize_instrumental_files(store_dir)
-                self.file_organization_signal.emit(moved_files, time_taken)
-                
-            else:
-                self.terminate_process()
-            logger.info(f"Inference process completed or terminated for {module_names[store_dir]}")
+            logger.info("Inference pipeline completed")
+        else:
+            self.terminate_process()
 
         if self.is_running:
             summary["total_time"] = time.time() - start_time
@@ -426,24 +396,12 @@ class InferenceThread(QThread):
 
     def stop(self):
         self.is_running = False
-        if self.process:
-            self.terminate_process()
+        self.terminate_process()
 
     def terminate_process(self):
+        # Loaded models are lost, the worker is started again on the next run
         logger.info("Terminating inference process")
-        if self.process:
-            try:
-                parent = psutil.Process(self.process.pid)
-                children = parent.children(recursive=True)
-                for child in children:
-                    child.terminate()
-                parent.terminate()
-                gone, still_alive = psutil.wait_procs(children + [parent], timeout=5)
-                for p in still_alive:
-                    p.kill()
-            except psutil.NoSuchProcess:
-                pass
-        self.process = None
+        self.worker.terminate()
 
 
 class ModelEditDialog(QDialog):
@@ -947,6 +905,7 @@ class MainWindow(QMainWindow):
         super().__init__()
         self.background_label = None
         self.inference_thread = None
+        self.inference_worker = None
         self.setWindowTitle("MSST GUI v1.3.1     by 领航员未鸟")
         self.setGeometry(100, 100, 800, 810)
         self.setWindowIcon(QIcon(":/images/msst-icon.ico"))
@@ -1545,21 +1504,27 @@ class MainWindow(QMainWindow):
         force_cpu = self.force_cpu_checkbox.isChecked()
         use_tta = self.use_tta_checkbox.isChecked()
         commands = []
-        current_input_folder = self.safe_path(self.input_folder)
+        current_input_folder = os.path.normpath(self.input_folder)
 
         def add_command(model, store_dir):
             nonlocal current_input_folder
             if model != "None":
-                config_path = self.safe_path(self.get_config_path(model, fast_inference))
+                config_path = self.get_config_path(model, fast_inference)
                 model_type = self.get_model_type(model)
-                model_path = self.safe_path(f"pretrain/{model}")
+                model_path = os.path.normpath(f"pretrain/{model}")
                 if config_path and model_type != "unknown":
-                    cmd = f"{inference_base} --model_type {model_type} --start_check_point {model_path} --input_folder {current_input_folder} --store_dir {store_dir} --extract_instrumental --config_path {config_path}"
+                    config_path = os.path.normpath(config_path)
+                    args = ["--model_type", model_type, "--start_check_point", model_path,
+                            "--input_folder", current_input_folder, "--store_dir", store_dir,
+                            "--extract_instrumental", "--config_path", config_path]
+                    cmd = f"{inference_base} --model_type {model_type} --start_check_point {self.safe_path(model_path)} --input_folder {self.safe_path(current_input_folder)} --store_dir {store_dir} --extract_instrumental --config_path {self.safe_path(config_path)}"
                     if force_cpu:
+                        args.append("--force_cpu")
                         cmd += " --force_cpu"
                     if use_tta:
+                        args.append("--use_tta")
                         cmd += " --use_tta"
-                    commands.append((cmd, store_dir))
+                    commands.append((cmd, args, store_dir))
                     current_input_folder = store_dir
                     logger.info(f"Added command for {model}: {cmd}")
                 else:
@@ -1571,14 +1536,23 @@ class MainWindow(QMainWindow):
         add_command(self.other_model_combo.currentText(), "other_results")
 
         logger.info(f"Inference commands: {commands}")
+        if not commands:
+            QMessageBox.warning(self, "错误",
+                                "没有选择可用的模型，请至少选择一个模型！")
+            return
+
+        worker_command = inference_env + ' inference_worker.py'
+        if self.inference_worker is None or self.inference_worker.command != worker_command:
+            if self.inference_worker is not None:
+                self.inference_worker.shutdown()
+            self.inference_worker = InferenceWorkerClient(worker_command, env=env)
 
         self.output_console.clear()
         self.update_output("启动推理.........", color='cyan')
         # self.print_separator()
-        self.inference_thread = InferenceThread(commands, self.input_folder)
+        self.inference_thread = InferenceThread(self.inference_worker, commands, self.input_folder)
         self.inference_thread.update_signal.connect(self.process_inference_output)
         self.inference_thread.finished_signal.connect(self.inference_finished)
-        self.inference_thread.file_organization_signal.connect(self.file_organization_completed)
         self.inference_thread.start()
 
         self.run_button.setText("终止推理")
@@ -1606,9 +1580,6 @@ class MainWindow(QMainWindow):
         self.run_button.clicked.disconnect()
         self.run_button.clicked.connect(self.stop_inference)
 
-    def file_organization_completed(self, moved_files, time_taken):
-        self.update_output(f"Organized {moved_files} instrumental files in {time_taken:.2f} seconds", color='green')
-
     def stop_inference(self):
         if hasattr(self, 'inference_thread') and self.inference_thread.isRunning():
             logger.info("Stopping inference process")
@@ -1618,6 +1589,14 @@ class MainWindow(QMainWindow):
             self.update_output("推理线程已由用户强制终止", color='yellow')
             self.reset_run_button()
 
+    def closeEvent(self, event):
+        if self.inference_thread is not None and self.inference_thread.isRunning():
+            self.inference_thread.stop()
+            self.inference_thread.wait()
+        if self.inference_worker is not None:
+            self.inference_worker.shutdown()
+        super().closeEvent(event)
+
     def reset_run_button(self):
         self.run_button.setText("开始推理")
         self.run_button.setStyleSheet("")  # This will reset to the default style defined in setStyleSheet
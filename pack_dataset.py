@@ -0,0 +1,131 @@
+# coding: utf-8
+
+# Decodes a training dataset (any --dataset_type) once into a memory-mapped file, e.g.
+#   python pack_dataset.py --config_path config.yaml --data_path dataset/train --output_path dataset/train_packed
+# and then train with --data_path dataset/train_packed (same --dataset_type, or 1 <-> 4, 2 <-> 3).
+# MSSDataset slices random chunks directly from the file, without opening and decoding audio files.
+
+import argparse
+import multiprocessing
+import os
+import pickle
+import time
+import numpy as np
+import soundfile as sf
+from tqdm.auto import tqdm
+
+from dataset import MSSDataset, PACKED_AUDIO, PACKED_INDEX, get_activity_envelope
+from utils import load_config
+
+
+def read_stem(params):
+    # (2, length) float32, mono is duplicated to stereo
+    path, length = params
+    x = sf.read(path, dtype='float32', frames=length, always_2d=True)[0]
+    if x.shape[1] == 1:
+        x = np.repeat(x, 2, axis=1)
+    return x[:, :2]
+
+
+def get_stems(dataset):
+    # [(path, length)] of all audio to pack and function to build packed metadata from their offsets
+    stems = []
+    if dataset.dataset_type in [1, 4]:
+        for track_path, track_length in dataset.metadata:
+            for instr in dataset.instruments:
+                path = None
+                for extension in dataset.file_types:
+                    if os.path.isfile(track_path + '/{}.{}'.format(instr, extension)):
+                        path = track_path + '/{}.{}'.format(instr, extension)
+                        break
+                stems.append((path, track_length))
+
+        def make_metadata(offsets):
+            metadata = []
+            for i, (track_path, track_length) in enumerate(dataset.metadata):
+                track_offsets = offsets[i * len(dataset.instruments):(i + 1) * len(dataset.instruments)]
+                metadata.append((track_path, track_length, dict(zip(dataset.instruments, track_offsets))))
+            return metadata
+    else:
+        for instr in dataset.instruments:
+            stems += dataset.metadata[instr]
+
+        def make_metadata(offsets):
+            metadata = dict()
+            position = 0
+            for instr in dataset.instruments:
+                metadata[instr] = []
+                for path, length in dataset.metadata[instr]:
+                    metadata[instr].append((path, length, offsets[position]))
+                    position += 1
+            return metadata
+    return stems, make_metadata
+
+
+def pack_dataset(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_type", type=str, default='mdx23c', help="model type of config (htdemucs configs are read differently)")
+    parser.add_argument("--config_path", type=str, help="config with training.instruments to pack")
+    parser.add_argument("--data_path", nargs="+", type=str, help="dataset data paths, the same as for train.py")
+    parser.add_argument("--dataset_type", type=int, default=1, help="Dataset type. Must be one of: 1, 2, 3 or 4")
+    parser.add_argument("--output_path", type=str, help="folder for packed dataset")
+    parser.add_argument("--dtype", type=str, default='float16', choices=['float16', 'int16'], help="sample format, int16 clips samples outside of [-1, 1]")
+    parser.add_argument("--num_workers", type=int, default=multiprocessing.cpu_count(), help="processes to decode audio")
+    if args is None:
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args(args)
+
+    start_time = time.time()
+    config = load_config(args.model_type, args.config_path)
+    os.makedirs(args.output_path, exist_ok=True)
+    dataset = MSSDataset(config, args.data_path, metadata_path=os.path.join(args.output_path, 'metadata_{}.db'.format(args.dataset_type)),
+                         dataset_type=args.dataset_type)
+    stems, make_metadata = get_stems(dataset)
+
+    offsets = []
+    frames = 0
+    for path, length in stems:
+        offsets.append(frames if path is not None else -1)
+        if path is not None:
+            frames += length
+    print('Stems to pack: {} Size: {:.2f} GB'.format(len(stems), frames * 2 * np.dtype(args.dtype).itemsize / 1024 ** 3))
+
+    audio = np.memmap(os.path.join(args.output_path, PACKED_AUDIO), dtype=args.dtype, mode='w+', shape=(frames, 2))
+    scale = 1.0
+    if args.dtype == 'int16':
+        scale = 1 / 32767
+    to_read = [(path, length) for path, length in stems if path is not None]
+    to_read_offsets = [offset for offset in offsets if offset >= 0]
+    clipped = 0
+    activity = dict()
+    with multiprocessing.Pool(processes=max(args.num_workers, 1)) as p:
+        for offset, (path, length), x in tqdm(zip(to_read_offsets, to_read, p.imap(read_stem, to_read)), total=len(to_read)):
+            if len(x) < length:
+                print('Warning: {} is shorter than metadata length ({} < {}), padded with zeros'.format(path, len(x), length))
+                x = np.concatenate([x, np.zeros((length - len(x), 2), dtype=np.float32)])
+            # activity envelope of every stem by its offset, computed before quantization
+            activity[offset] = get_activity_envelope(x[:length])
+            if args.dtype == 'int16':
+                clipped += int((np.abs(x) > 1).sum())
+                x = np.round(np.clip(x, -1, 1) / scale).astype(np.int16)
+            audio[offset:offset + length] = x
+    audio.flush()
+    if clipped > 0:
+        print('Warning: {} samples were clipped to [-1, 1], use --dtype float16 to keep them'.format(clipped))
+
+    index = {
+        'dtype': args.dtype,
+        'scale': scale,
+        'frames': frames,
+        'dataset_type': args.dataset_type,
+        'instruments': list(dataset.instruments),
+        'metadata': make_metadata(offsets),
+        'activity': activity,
+    }
+    pickle.dump(index, open(os.path.join(args.output_path, PACKED_INDEX), 'wb'))
+    print('Packed dataset saved to {} ({:.2f} sec)'.format(args.output_path, time.time() - start_time))
+
+
+if __name__ == "__main__":
+    pack_dataset(None)
@@ -0,0 +1,188 @@
+# coding: utf-8
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+import torch
+import torch.nn as nn
+
+
+def profile_stage(profiler, name, track=None):
+    # profiler.stage, or nothing when profiling is off
+    if profiler is None:
+        return nullcontext()
+    return profiler.stage(name, track)
+
+
+def profile_model(profiler, tracks):
+    # profiler.model_stage, or nothing when profiling is off
+    if profiler is None:
+        return nullcontext()
+    return profiler.model_stage(tracks)
+
+
+def get_profiled_modules(module, prefix=''):
+    # Direct sub-modules of the model. ModuleList/ModuleDict have no forward, their items are used instead
+    for name, child in module.named_children():
+        if isinstance(child, (nn.ModuleList, nn.ModuleDict)):
+            yield from get_profiled_modules(child, prefix + name + '.')
+        else:
+            yield prefix + name, child
+
+
+class StageProfiler:
+    """
+    Instrumentation of run_folder enabled with --profile. Every stage records wall time, CPU time
+    of its thread (reader and writer threads are not counted in other stages) and allocated bytes (CUDA allocations on GPU, RSS growth on CPU). Forward hooks
+    record the same for sub-modules of the model (e.g. band_split, layers.0.0, mask_estimators.0 of
+    roformers). Results are saved as Chrome trace JSON (chrome://tracing or ui.perfetto.dev) for
+    every track and as a summary aggregated by stage.
+    On CUDA the device is synchronized around every stage, so times are exact but the run is slower.
+    """
+    def __init__(self, device='cpu'):
+        import psutil
+        self.device = device
+        self.cuda = str(device).startswith('cuda')
+        self.process = psutil.Process()
+        self.start_time = time.perf_counter()
+        self.events = []
+        self.lock = threading.Lock()
+        self.track_names = dict()
+        self.model_tracks = None
+        self.hooks = []
+        self.module_begins = dict()
+
+    def get_allocated(self):
+        if self.cuda:
+            return torch.cuda.memory_stats(self.device).get('allocated_bytes.all.allocated', 0)
+        return self.process.memory_info().rss
+
+    def begin(self):
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter(), time.thread_time(), self.get_allocated()
+
+    def end(self, name, begin, track=None, category='stage'):
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+        wall_start, cpu_start, allocated_start = begin
+        event = {
+            'name': name,
+            'cat': category,
+            'ts': (wall_start - self.start_time) * 1e6,
+            'dur': (time.perf_counter() - wall_start) * 1e6,
+            'tid': threading.get_ident(),
+            'track': track,
+            'cpu': time.thread_time() - cpu_start,
+            'bytes': max(self.get_allocated() - allocated_start, 0),
+        }
+        with self.lock:
+            self.events.append(event)
+
+    @contextmanager
+    def stage(self, name, track=None):
+        begin = self.begin()
+        try:
+            yield
+        finally:
+            self.end(name, begin, track)
+
+    @contextmanager
+    def model_stage(self, tracks):
+        # Sub-module events inside are assigned to tracks (list of track ids in the batch)
+        self.model_tracks = tracks
+        try:
+            with self.stage('model', tracks):
+                yield
+        finally:
+            self.model_tracks = None
+
+    def set_track_name(self, track, name):
+        self.track_names[track] = name
+
+    def add_model_hooks(self, model):
+        if isinstance(model, nn.DataParallel):
+            model = model.module
+        # Begins are stacked per thread, DataParallel replicas run the hooks concurrently
+        for name, module in get_profiled_modules(model):
+            self.hooks.append(module.register_forward_pre_hook(
+                lambda module, inputs, name=name: self.module_begins.setdefault(
+                    (name, threading.get_ident()), []).append(self.begin())))
+            self.hooks.append(module.register_forward_hook(
+                lambda module, inputs, output, name=name: self.end(
+                    name, self.module_begins[(name, threading.get_ident())].pop(), self.model_tracks, category='module')))
+
+    def remove_hooks(self):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+
+    def get_track_events(self, track):
+        events = []
+        for event in self.events:
+            tracks = event['track'] if isinstance(event['track'], list) else [event['track']]
+            if track in tracks:
+                events.append(event)
+        return events
+
+    def get_trace(self, events):
+        trace_events = []
+        for event in events:
+            tracks = event['track'] if isinstance(event['track'], list) else [event['track']]
+            trace_events.append({
+                'name': event['name'],
+                'cat': event['cat'],
+                'ph': 'X',
+                'ts': event['ts'],
+                'dur': event['dur'],
+                'pid': 0,
+                'tid': event['tid'],
+                'args': {
+                    'cpu_ms': event['cpu'] * 1000,
+                    'bytes': event['bytes'],
+                    'tracks': [self.track_names.get(t, t) for t in tracks if t is not None],
+                },
+            })
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+    def get_summary(self):
+        # {stage: {'count', 'wall', 'cpu', 'bytes'}}, stages sorted by wall time
+        summary = dict()
+        for event in self.events:
+            name = event['name'] if event['cat'] == 'stage' else 'model.' + event['name']
+            if name not in summary:
+                summary[name] = {'count': 0, 'wall': 0., 'cpu': 0., 'bytes': 0}
+            summary[name]['count'] += 1
+            summary[name]['wall'] += event['dur'] / 1e6
+            summary[name]['cpu'] += event['cpu']
+            summary[name]['bytes'] += event['bytes']
+        modules_wall = sum(value['wall'] for name, value in summary.items() if name.startswith('model.'))
+        if 'model' in summary and modules_wall > 0:
+            # Work of the model outside of the hooked sub-modules, e.g. STFT and iSTFT of roformers
+            summary['model.other'] = {'count': summary['model']['count'], 'wall': max(summary['model']['wall'] - modules_wall, 0.),
+                                      'cpu': 0., 'bytes': 0}
+        return dict(sorted(summary.items(), key=lambda x: -x[1]['wall']))
+
+    def print_summary(self):
+        summary = self.get_summary()
+        total = (time.perf_counter() - self.start_time)
+        print('{:<32} {:>8} {:>10} {:>7} {:>10} {:>12}'.format('Stage', 'Count', 'Wall sec', '%', 'CPU sec', 'Alloc MB'))
+        for name, value in summary.items():
+            print('{:<32} {:>8} {:>10.3f} {:>7.1f} {:>10.3f} {:>12.1f}'.format(
+                name, value['count'], value['wall'], 100 * value['wall'] / total, value['cpu'], value['bytes'] / 1024 ** 2))
+        print('Stages run in parallel threads (decode, encode) and nested ones (model.*) overlap, so % does not add up to 100')
+
+    def save(self, folder):
+        # One trace per track, a trace of the whole run and the summary
+        os.makedirs(folder, exist_ok=True)
+        for track, name in self.track_names.items():
+            with open(os.path.join(folder, '{}.trace.json'.format(name)), 'w') as f:
+                json.dump(self.get_trace(self.get_track_events(track)), f)
+        with open(os.path.join(folder, 'all_tracks.trace.json'), 'w') as f:
+            json.dump(self.get_trace(self.events), f)
+        with open(os.path.join(folder, 'summary.json'), 'w') as f:
+            json.dump(self.get_summary(), f, indent=2)
+        print('Profile saved to: {}'.format(folder))
@@ -23,7 +23,7 @@ from torch.optim.lr_scheduler import ReduceLROnPlateau
 import torch.nn.functional as F
 
 from dataset import MSSDataset
-from utils import demix, sdr, get_model_from_config
+from utils import demix, sdr, get_model_from_config, load_state_dict_file, get_state_dict
 from valid import valid_multi_gpu, valid
 
 import warnings
@@ -55,13 +55,8 @@ def manual_seed(seed):
 
 def load_not_compatible_weights(model, weights, verbose=False):
     new_model = model.state_dict()
-    old_model = torch.load(weights)
-    if 'state' in old_model:
-        # Fix for htdemucs weights loading
-        old_model = old_model['state']
-    if 'state_dict' in old_model:
-        # Fix for apollo weights loading
-        old_model = old_model['state_dict']
+    # Fix for htdemucs and apollo weights loading
+    old_model = get_state_dict(load_state_dict_file(weights))
 
     for el in new_model:
         if el in old_model:
@@ -162,7 +157,7 @@ def train_model(args):
         config,
         args.data_path,
         batch_size=batch_size,
-        metadata_path=os.path.join(args.results_path, 'metadata_{}.pkl'.format(args.dataset_type)),
+        metadata_path=os.path.join(args.results_path, 'metadata_{}.db'.format(args.dataset_type)),
         dataset_type=args.dataset_type,
     )
 
@@ -180,7 +175,7 @@ def train_model(args):
             load_not_compatible_weights(model, args.start_check_point, verbose=False)
         else:
             model.load_state_dict(
-                torch.load(args.start_check_point)
+                load_state_dict_file(args.start_check_point)
             )
 
     if torch.cuda.is_available():
@@ -269,6 +264,7 @@ def train_model(args):
         for i, (batch, mixes) in enumerate(pbar):
             y = batch.to(device)
             x = mixes.to(device)  # mixture
+            y, x = trainset.augment_batch(y, x)
 
             if 'normalize' in config.training:
                 if config.training.normalize:
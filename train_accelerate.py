@@ -23,7 +23,7 @@ import torch.nn.functional as F
 from accelerate import Accelerator
 
 from dataset import MSSDataset
-from utils import get_model_from_config, demix, sdr, prefer_target_instrument
+from utils import get_model_from_config, demix, sdr, prefer_target_instrument, load_state_dict_file
 from train import masked_loss, manual_seed, load_not_compatible_weights
 import warnings
 
@@ -138,7 +138,7 @@ def train_model(args):
         config,
         args.data_path,
         batch_size=batch_size,
-        metadata_path=os.path.join(args.results_path, 'metadata_{}.pkl'.format(args.dataset_type)),
+        metadata_path=os.path.join(args.results_path, 'metadata_{}.db'.format(args.dataset_type)),
         dataset_type=args.dataset_type,
         verbose=accelerator.is_main_process,
     )
@@ -168,7 +168,7 @@ def train_model(args):
             load_not_compatible_weights(model, args.start_check_point, verbose=False)
         else:
             model.load_state_dict(
-                torch.load(args.start_check_point)
+                load_state_dict_file(args.start_check_point)
             )
 
     optim_params = dict()
@@ -262,8 +262,7 @@ def train_model(args):
 
         pbar = tqdm(train_loader, disable=not accelerator.is_main_process)
         for i, (batch, mixes) in enumerate(pbar):
-            y = batch
-            x = mixes
+            y, x = trainset.augment_batch(batch, mixes)
 
             if args.model_type in ['mel_band_roformer', 'bs_roformer']:
                 # loss is computed in forward pass
@@ -0,0 +1,105 @@
+# coding: utf-8
+
+import argparse
+import glob
+import time
+import torch
+import numpy as np
+
+import warnings
+warnings.filterwarnings("ignore")
+
+from utils import get_model_from_config, prefer_target_instrument, load_checkpoint, TTA_VARIANTS
+from valid import proc_list_of_files
+
+
+def get_candidate_plans():
+    # All subsets of TTA_VARIANTS, starting with the plain run without TTA
+    plans = [[]]
+    for name in TTA_VARIANTS:
+        plans += [plan + [name] for plan in plans]
+    return plans
+
+
+def run_plan(tta_plan, tracks, model, args, config, device):
+    config.inference.tta_plan = tta_plan
+    args.use_tta = True
+    start_time = time.time()
+    all_metrics = proc_list_of_files(tracks, model, args, config, device, verbose=False, is_tqdm=False)
+    elapsed = time.time() - start_time
+    instruments = prefer_target_instrument(config)
+    sdr = np.mean([np.mean(all_metrics['sdr'][instr]) for instr in instruments if len(all_metrics['sdr'][instr]) > 0])
+    return sdr, elapsed
+
+
+def calibrate_tta(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_type", type=str, default='mdx23c', help="One of bandit, bandit_v2, bs_roformer, htdemucs, mdx23c, mel_band_roformer, scnet, scnet_unofficial, segm_models, swin_upernet, torchseg")
+    parser.add_argument("--config_path", type=str, help="path to config file")
+    parser.add_argument("--start_check_point", type=str, default='', help="Initial checkpoint to valid weights")
+    parser.add_argument("--valid_path", nargs="+", type=str, help="validate path")
+    parser.add_argument("--num_tracks", type=int, default=5, help="number of validation tracks used for calibration")
+    parser.add_argument("--extension", type=str, default='wav', help="Choose extension for validation")
+    parser.add_argument("--device_ids", nargs='+', type=int, default=0, help='list of gpu ids')
+    parser.add_argument("--force_cpu", action='store_true', help="Force the use of CPU even if CUDA is available")
+    parser.add_argument("--min_gain_per_sec", type=float, default=0.0, help="minimum SDR gain (dB) per extra second of compute for a TTA variant to be recommended")
+    if args is None:
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args(args)
+    args.metrics = ['sdr']
+
+    device = "cpu"
+    if args.force_cpu:
+        device = "cpu"
+    elif torch.cuda.is_available():
+        device = f'cuda:{args.device_ids[0]}' if type(args.device_ids) == list else f'cuda:{args.device_ids}'
+    elif torch.backends.mps.is_available():
+        device = "mps"
+    print("Using device: ", device)
+
+    model, config = get_model_from_config(args.model_type, args.config_path)
+    if args.start_check_point != '':
+        print('Start from checkpoint: {}'.format(args.start_check_point))
+        load_checkpoint(model, args.model_type, args.start_check_point, device)
+    model = model.eval().to(device)
+
+    tracks = []
+    for valid_path in args.valid_path:
+        tracks += sorted(glob.glob(valid_path + '/*/mixture.{}'.format(args.extension)))
+    tracks = tracks[:args.num_tracks]
+    if len(tracks) == 0:
+        print('No validation data found in: {}'.format(args.valid_path))
+        return None
+    print('Calibrate TTA on {} tracks'.format(len(tracks)))
+
+    # Warm up so the first timed plan doesn't pay for initialization
+    run_plan([], tracks[:1], model, args, config, device)
+
+    results = dict()
+    for tta_plan in get_candidate_plans():
+        sdr, elapsed = run_plan(tta_plan, tracks, model, args, config, device)
+        results[tuple(tta_plan)] = (sdr, elapsed)
+        print('TTA plan: {:40s} SDR: {:.4f} Time: {:.2f} sec'.format(str(tta_plan), sdr, elapsed))
+
+    base_sdr, base_time = results[()]
+    recommended = []
+    for name in TTA_VARIANTS:
+        sdr, elapsed = results[(name,)]
+        gain = sdr - base_sdr
+        extra_time = max(elapsed - base_time, 1e-6)
+        print('Variant {:20s} SDR gain: {:+.4f} Extra time: {:.2f} sec Gain per sec: {:+.4f}'.format(name, gain, elapsed - base_time, gain / extra_time))
+        if gain > 0 and gain / extra_time >= args.min_gain_per_sec:
+            recommended.append(name)
+
+    sdr, elapsed = results[tuple(recommended)]
+    print('Recommended TTA plan: {} (SDR: {:.4f} Time: {:.2f} sec)'.format(recommended, sdr, elapsed))
+    if len(recommended) > 0:
+        print('Add to the inference section of config and run with --use_tta:\n  tta_plan: {}'.format(recommended))
+    else:
+        print('No TTA variant pays for itself, run without --use_tta')
+    return recommended
+
+
+if __name__ == "__main__":
+    calibrate_tta(None)
@@ -1,11 +1,14 @@
 # coding: utf-8
 __author__ = 'Roman Solovyev (ZFTurbo): https://github.com/ZFTurbo/'
 
+import os
 import time
 import numpy as np
 import torch
 import torch.nn as nn
 import yaml
+import weakref
+from collections import deque
 import librosa
 import torch.nn.functional as F
 from ml_collections import ConfigDict
@@ -13,14 +16,20 @@ from omegaconf import OmegaConf
 from tqdm.auto import tqdm
 from numpy.typing import NDArray
 from typing import Dict, List
+from profiler import profile_stage, profile_model
 
 
-def get_model_from_config(model_type, config_path):
+def load_config(model_type, config_path):
     with open(config_path) as f:
         if model_type == 'htdemucs':
             config = OmegaConf.load(config_path)
         else:
             config = ConfigDict(yaml.load(f, Loader=yaml.FullLoader))
+    return config
+
+
+def get_model_from_config(model_type, config_path):
+    config = load_config(model_type, config_path)
 
     if model_type == 'mdx23c':
         from models.mdx23c_tfc_tdf_v3 import TFC_TDF_net
@@ -79,6 +88,48 @@ def get_model_from_config(model_type, config_path):
 
     return model, config
 
+
+def load_state_dict_file(checkpoint_path, device='cpu', weights_only=None):
+    """
+    Reads a checkpoint without deserializing the whole file into RAM first. .safetensors files
+    and zip-format torch checkpoints are memory-mapped, so tensors are only paged in when
+    load_state_dict copies them to the model. A .safetensors file next to a .ckpt (made by
+    convert_checkpoints.py) is used instead of it, unless the .ckpt was modified later.
+    """
+    root, ext = os.path.splitext(checkpoint_path)
+    converted_path = root + '.safetensors'
+    if ext != '.safetensors' and os.path.isfile(converted_path) and os.path.getmtime(converted_path) >= os.path.getmtime(checkpoint_path):
+        print('Use converted checkpoint: {}'.format(converted_path))
+        checkpoint_path = converted_path
+    if checkpoint_path.endswith('.safetensors'):
+        from safetensors.torch import load_file
+        return load_file(checkpoint_path, device=str(device))
+    try:
+        return torch.load(checkpoint_path, map_location=device, weights_only=weights_only, mmap=True)
+    except (RuntimeError, TypeError):
+        # Legacy (not zip) checkpoints can't be memory-mapped, torch < 2.1 has no mmap
+        return torch.load(checkpoint_path, map_location=device, weights_only=weights_only)
+
+
+def get_state_dict(checkpoint):
+    # Fix for htdemucs pretrained models
+    if 'state' in checkpoint:
+        checkpoint = checkpoint['state']
+    # Fix for apollo pretrained models
+    if 'state_dict' in checkpoint:
+        checkpoint = checkpoint['state_dict']
+    return checkpoint
+
+
+def load_checkpoint(model, model_type, checkpoint_path, device='cpu'):
+    # Loads start checkpoint weights into model (as in inference.py)
+    if model_type in ['htdemucs', 'apollo']:
+        state_dict = get_state_dict(load_state_dict_file(checkpoint_path, device, weights_only=False))
+    else:
+        state_dict = load_state_dict_file(checkpoint_path, device, weights_only=True)
+    model.load_state_dict(state_dict)
+
+
 def _getWindowingArray(window_size, fade_size):
     fadein = torch.linspace(0, 1, fade_size)
     fadeout = torch.linspace(1, 0, fade_size)
@@ -88,136 +139,559 @@ def _getWindowingArray(window_size, fade_size):
     return window
 
 
-def demix_track(config, model, mix, device, pbar=False):
+def _get_chunk_windows(windowing_array, starts, total_length, fade_size):
+    # One window per chunk: the first chunk has no fade-in and chunks reaching the end have no fade-out
+    chunk_size = windowing_array.shape[-1]
+    windows = windowing_array.repeat(len(starts), 1)
+    if fade_size > 0:
+        windows[starts == 0, :fade_size] = 1
+        windows[starts + chunk_size >= total_length, -fade_size:] = 1
+    return windows
+
+
+def _get_scatter_indices(starts, chunk_size):
+    # Flat positions of every sample of every chunk in the accumulator, shape (num_chunks * chunk_size, )
+    return (starts[:, None] + torch.arange(chunk_size, device=starts.device)).reshape(-1)
+
+
+def _overlap_add(result, x, starts, step):
+    # result: (stems, channels, length), x: (batch, stems, channels, chunk_size) already windowed
+    # starts must be increasing positions of the step grid
+    batch, stems, channels, chunk_size = x.shape
+    x = x.to(result.dtype).permute(1, 2, 0, 3)
+    if chunk_size % step == 0:
+        # View the accumulator as step-sized blocks: every chunk covers chunk_size // step
+        # consecutive blocks, so the whole batch is added with one strided add per block offset
+        n = chunk_size // step
+        blocks = result[..., :result.shape[-1] // step * step].view(stems, channels, -1, step)
+        x = x.reshape(stems, channels, batch, n, step)
+        first = int(starts[0]) // step
+        if int(starts[-1]) - int(starts[0]) == (batch - 1) * step:
+            for j in range(n):
+                blocks[:, :, first + j:first + j + batch] += x[:, :, :, j]
+        else:
+            # Gaps between chunks (skipped silent chunks)
+            first = starts // step
+            for j in range(n):
+                blocks.index_add_(2, first + j, x[:, :, :, j])
+    else:
+        result.index_add_(-1, _get_scatter_indices(starts, chunk_size), x.reshape(stems, channels, -1))
+
+
+def _get_normalization_envelope(windowing_array, starts, total_length, fade_size, step, batch_size):
+    # Sum of all chunk windows at each position. It depends only on time, so one 1-D
+    # tensor replaces the full (stems, channels, length) counter
+    chunk_size = windowing_array.shape[-1]
+    envelope = torch.zeros((1, 1, int(starts[-1]) + chunk_size), dtype=torch.float32, device=windowing_array.device)
+    for i in range(0, len(starts), batch_size):
+        batch_starts = starts[i:i + batch_size]
+        windows = _get_chunk_windows(windowing_array, batch_starts, total_length, fade_size)
+        _overlap_add(envelope, windows[:, None, None, :], batch_starts, step)
+    return envelope[0, 0]
+
+
+def _pad_chunk(part, chunk_size, reflect=True):
+    # Pad the last incomplete chunk of the track up to chunk_size
+    length = part.shape[-1]
+    if length < chunk_size:
+        if reflect and length > chunk_size // 2 + 1:
+            part = nn.functional.pad(input=part, pad=(0, chunk_size - length), mode='reflect')
+        else:
+            part = nn.functional.pad(input=part, pad=(0, chunk_size - length, 0, 0), mode='constant', value=0)
+    return part
+
+
+def _get_silence_level(config):
+    # Chunks with peak below inference.skip_silence_db (dBFS of the audio passed to the model,
+    # e.g. -60) are not run through the model. None if not set
+    threshold = config.inference.get('skip_silence_db')
+    if threshold is None:
+        return None
+    return 10 ** (threshold / 20)
+
+
+def _get_silent_chunks(config, mix, starts, chunk_size, step):
+    # Bool mask over starts of silent chunks of mix (channels, length), None if disabled
+    silence_level = _get_silence_level(config)
+    if silence_level is None:
+        return None
+    peak = mix.abs().amax(0)
+    peak = F.pad(peak, (0, max(int(starts[-1]) + chunk_size - peak.shape[-1], 0)))
+    chunk_peak = F.max_pool1d(peak[None, None], chunk_size, stride=step)[0, 0, :len(starts)]
+    return (chunk_peak < silence_level).to(starts.device)
+
+
+def _get_silent_output(config, arr, instruments):
+    # Model output for silent chunks: zeros, or the mixture itself for stems listed in
+    # inference.silence_passthrough (residual stems like 'other' or 'instrumental')
+    batch, channels, chunk_size = arr.shape
+    x = torch.zeros((batch, len(instruments), channels, chunk_size), dtype=arr.dtype, device=arr.device)
+    for instr in config.inference.get('silence_passthrough', None) or []:
+        if instr in instruments:
+            x[:, instruments.index(instr)] = arr
+    return x
+
+
+def _has_silence_passthrough(config, instruments):
+    return any(instr in instruments for instr in config.inference.get('silence_passthrough', None) or [])
+
+
+TTA_VARIANTS = ('channel_inverse', 'polarity_inverse')
+
+
+def get_tta_plan(config, use_tta=True) -> List[str]:
+    # TTA variants run besides the original: inference.tta_plan if set in config, otherwise all of them
+    if not use_tta:
+        return []
+    tta_plan = config.inference.get('tta_plan')
+    if tta_plan is None:
+        return list(TTA_VARIANTS)
+    for name in tta_plan:
+        if name not in TTA_VARIANTS:
+            raise ValueError('Unknown TTA variant: {}. Must be one of: {}'.format(name, ', '.join(TTA_VARIANTS)))
+    return list(tta_plan)
+
+
+def _apply_model(model, arr, num_stems, tta_plan=()):
+    # Run the model on a batch of chunks (batch, channels, chunk_size), returns (batch, stems, channels, chunk_size).
+    # TTA variants of every chunk go through the same forward call and the de-augmented outputs are averaged
+    batch, channels, chunk_size = arr.shape
+    if len(tta_plan) == 0:
+        return model(arr).reshape(batch, num_stems, channels, chunk_size)
+    variants = [arr]
+    for name in tta_plan:
+        if name == 'channel_inverse':
+            variants.append(arr.flip(1))
+        elif name == 'polarity_inverse':
+            variants.append(-arr)
+    x = model(torch.cat(variants, dim=0))
+    x = x.reshape(len(variants), batch, num_stems, channels, chunk_size)
+    out = x[0]
+    for i, name in enumerate(tta_plan, 1):
+        if name == 'channel_inverse':
+            out = out + x[i].flip(2)
+        elif name == 'polarity_inverse':
+            out = out - x[i]
+    return out / len(variants)
+
+
+# Batch size and piece length which didn't run out of memory, per model (see _apply_model_safe)
+_working_sizes = weakref.WeakKeyDictionary()
+
+
+def _get_hop_length(config):
+    # STFT hop of the model, shorter pieces of chunks must keep whole STFT frames
+    for section, key in [('model', 'stft_hop_length'), ('audio', 'hop_length'), ('audio', 'hop_size')]:
+        if section in config and config[section].get(key):
+            return int(config[section][key])
+    return 1
+
+
+def _apply_model_pieces(model, arr, num_stems, tta_plan, piece_size):
+    # Run every chunk of arr as shorter pieces of piece_size with overlap 4, crossfaded back to full chunks
+    batch, channels, chunk_size = arr.shape
+    step = max(piece_size // 4, 1)
+    starts = list(range(0, chunk_size - piece_size, step)) + [chunk_size - piece_size]
+    fade_size = piece_size // 10
+    windowingArray = _getWindowingArray(piece_size, fade_size).to(arr.device)
+    result = torch.zeros((batch, num_stems, channels, chunk_size), dtype=torch.float32, device=arr.device)
+    envelope = torch.zeros(chunk_size, dtype=torch.float32, device=arr.device)
+    for i, start in enumerate(starts):
+        window = windowingArray.clone()
+        if fade_size > 0 and i == 0:
+            window[:fade_size] = 1
+        if fade_size > 0 and i == len(starts) - 1:
+            window[-fade_size:] = 1
+        x = _apply_model(model, arr[..., start:start + piece_size], num_stems, tta_plan=tta_plan)
+        result[..., start:start + piece_size] += x.float() * window
+        envelope[start:start + piece_size] += window
+    return result / envelope
+
+
+def reset_oom_recovery(model):
+    """
+    Forgets the batch size and piece length _apply_model_safe fell back to for model,
+    so the next call starts again with the configured batch size.
+    """
+    _working_sizes.pop(model, None)
+
+
+def get_oom_recovery_sizes(model) -> Dict[str, int]:
+    # {'batch_size', 'piece_size'} _apply_model_safe fell back to for model, None where the configured size is used
+    sizes = _working_sizes.get(model, {})
+    return {key: sizes.get(key) for key in ('batch_size', 'piece_size')}
+
+
+def _apply_model_safe(model, arr, num_stems, tta_plan=(), hop_length=1, oom_recovery=False):
+    """
+    _apply_model which doesn't fail when the device runs out of memory (if oom_recovery is set):
+    the batch is halved down to single chunks, after that chunks are run as pieces of half length
+    (repeatedly, down to 1/8 of the chunk, multiples of hop_length) and crossfaded back. Working
+    sizes are remembered for the model, so next batches and tracks start with them, until
+    reset_oom_recovery is called.
+    """
+    if not oom_recovery:
+        return _apply_model(model, arr, num_stems, tta_plan=tta_plan)
+    return _apply_batches_safe(
+        model, arr,
+        lambda part: _apply_model(model, part, num_stems, tta_plan=tta_plan),
+        lambda part, piece_size: _apply_model_pieces(model, part, num_stems, tta_plan, piece_size),
+        hop_length=hop_length,
+    )
+
+
+def _apply_batches_safe(model, arr, apply, apply_pieces=None, hop_length=1):
+    # OOM recovery of _apply_model_safe for apply(part) on batches of arr. Without apply_pieces(part, piece_size)
+    # the batch is only split down to single chunks
+    sizes = _working_sizes.setdefault(model, {'batch_size': None, 'piece_size': None, 'piece_ok': False})
+    batch = arr.shape[0]
+    chunk_size = arr.shape[-1]
+    outputs = []
+    i = 0
+    while i < batch:
+        batch_size = min(sizes['batch_size'] or batch, batch)
+        part = arr[i:i + batch_size]
+        piece_size = sizes['piece_size']
+        pieces = piece_size is not None and piece_size < chunk_size
+        try:
+            if not pieces:
+                x = apply(part)
+            else:
+                x = apply_pieces(part, piece_size)
+        except RuntimeError as e:
+            if not is_oom_error(e):
+                if pieces and not sizes['piece_ok']:
+                    # First run with shorter pieces failed: models with fixed input length (e.g. mdx23c) can't use them
+                    sizes['piece_size'] = None
+                    raise RuntimeError('Out of memory with batch size 1 and the model does not support chunks of {} samples: {}'.format(piece_size, e)) from e
+                raise
+            next_piece_size = (piece_size or chunk_size) // 2 // hop_length * hop_length
+            if batch_size == 1 and (apply_pieces is None or next_piece_size < chunk_size // 8):
+                raise
+            x = None
+        if x is not None:
+            if pieces:
+                sizes['piece_ok'] = True
+            outputs.append(x)
+            i += len(part)
+            continue
+
+        # Handled outside of except, so memory held by the traceback is already released
+        if arr.device.type == 'cuda':
+            torch.cuda.empty_cache()
+        if batch_size > 1:
+            sizes['batch_size'] = batch_size // 2
+            print('Out of memory, batch size reduced to {}'.format(sizes['batch_size']))
+        else:
+            sizes['batch_size'] = 1
+            sizes['piece_size'] = next_piece_size
+            sizes['piece_ok'] = False
+            print('Out of memory with batch size 1, chunks are processed in parts of {} samples'.format(sizes['piece_size']))
+    if len(outputs) == 1:
+        return outputs[0]
+    return torch.cat(outputs, dim=0)
+
+
+def _get_demix_params(config, model_type, device):
+    # Chunking of demix_tracks and demix_stream: (instruments, chunk_size, step, fade_size, border, window, reflect)
+    if model_type == 'htdemucs':
+        # Demucs chunks are averaged with a flat window and not padded at the ends of the track
+        instruments = list(config.training.instruments)
+        C = config.training.samplerate * config.training.segment
+        step = C // config.inference.num_overlap
+        return instruments, C, step, 0, 0, torch.ones(C, device=device), False
+    instruments = prefer_target_instrument(config)
     C = config.audio.chunk_size
-    N = config.inference.num_overlap
+    step = int(C // config.inference.num_overlap)
     fade_size = C // 10
-    step = int(C // N)
-    border = C - step
-    batch_size = config.inference.batch_size
+    # windowingArray crossfades at segment boundaries to mitigate clicking artifacts
+    windowingArray = _getWindowingArray(C, fade_size).to(device)
+    return instruments, C, step, fade_size, C - step, windowingArray, True
 
-    length_init = mix.shape[-1]
 
-    # Do pad from the beginning and end to account floating window results better
-    if length_init > 2 * border and (border > 0):
-        mix = nn.functional.pad(mix, (border, border), mode='reflect')
+def _get_spectral_model(model):
+    # Models with stft / forward_masks / istft (roformers) can be run in the STFT domain
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    if all(hasattr(model, name) for name in ('stft', 'forward_masks', 'istft')):
+        return model
+    return None
 
-    # windowingArray crossfades at segment boundaries to mitigate clicking artifacts
-    windowingArray = _getWindowingArray(C, fade_size)
 
-    with torch.cuda.amp.autocast(enabled=config.training.use_amp):
-        with torch.inference_mode():
-            req_shape = (len(prefer_target_instrument(config)),) + tuple(mix.shape)
-
-            result = torch.zeros(req_shape, dtype=torch.float32)
-            counter = torch.zeros(req_shape, dtype=torch.float32)
-            i = 0
-            batch_data = []
-            batch_locations = []
-            progress_bar = tqdm(total=mix.shape[1], desc="Processing audio chunks", leave=False) if pbar else None
-
-            while i < mix.shape[1]:
-                # print(i, i + C, mix.shape[1])
-                part = mix[:, i:i + C].to(device)
-                length = part.shape[-1]
-                if length < C:
-                    if length > C // 2 + 1:
-                        part = nn.functional.pad(input=part, pad=(0, C - length), mode='reflect')
-                    else:
-                        part = nn.functional.pad(input=part, pad=(0, C - length, 0, 0), mode='constant', value=0)
-                batch_data.append(part)
-                batch_locations.append((i, length))
-                i += step
+def use_spectral_inference(config, model) -> bool:
+    # inference.spectral_inference in config turns on demix_spectral for models which support it
+    return bool(config.inference.get('spectral_inference', False)) and _get_spectral_model(model) is not None
 
-                if len(batch_data) >= batch_size or (i >= mix.shape[1]):
-                    arr = torch.stack(batch_data, dim=0)
-                    x = model(arr)
 
-                    window = windowingArray
-                    if i - step == 0:  # First audio chunk, no fadein
-                        window[:fade_size] = 1
-                    elif i >= mix.shape[1]:  # Last audio chunk, no fadeout
-                        window[-fade_size:] = 1
+def _flip_spec_channels(x, audio_channels):
+    # Swap stereo channels of (..., (f s), frames) spectrograms or masks
+    shape = x.shape
+    freq_dim = x.dim() - 2
+    return x.reshape(shape[:freq_dim] + (-1, audio_channels) + shape[freq_dim + 1:]).flip(freq_dim + 1).reshape(shape)
 
-                    for j in range(len(batch_locations)):
-                        start, l = batch_locations[j]
-                        result[..., start:start+l] += x[j][..., :l].cpu() * window[..., :l]
-                        counter[..., start:start+l] += window[..., :l]
 
-                    batch_data = []
-                    batch_locations = []
+class _MasksModule(nn.Module):
+    # forward_masks of a spectral model as forward, so chunk batches can be split by nn.DataParallel.
+    # Masks are returned as real tensors (..., 2), which DataParallel gathers like any other output
 
-                if progress_bar:
-                    progress_bar.update(step)
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
 
-            if progress_bar:
-                progress_bar.close()
+    def forward(self, spec):
+        return torch.view_as_real(self.model.forward_masks(spec))
 
-            estimated_sources = result / counter
-            estimated_sources = estimated_sources.cpu().numpy()
-            np.nan_to_num(estimated_sources, copy=False, nan=0.0)
 
-            if length_init > 2 * border and (border > 0):
-                # Remove pad
-                estimated_sources = estimated_sources[..., border:-border]
+class _DataParallelMasks(nn.DataParallel):
+    # Runs forward_masks on all device_ids of a DataParallel spectral model
 
-    return {k: v for k, v in zip(prefer_target_instrument(config), estimated_sources)}
+    def __init__(self, model):
+        super().__init__(_MasksModule(model.module), device_ids=model.device_ids, output_device=model.output_device)
+        self.audio_channels = model.module.audio_channels
 
-def demix_track_demucs(config, model, mix, device, pbar=False):
-    S = len(config.training.instruments)
-    C = config.training.samplerate * config.training.segment
-    N = config.inference.num_overlap
-    batch_size = config.inference.batch_size
-    step = C // N
-    # print(S, C, N, step, mix.shape, mix.device)
+    def forward_masks(self, spec):
+        return torch.view_as_complex(self(spec))
+
+
+def _get_masks_model(model):
+    # forward_masks runner for demix_spectral, keeping the device_ids of a DataParallel model
+    if isinstance(model, nn.DataParallel):
+        return _DataParallelMasks(model)
+    return _get_spectral_model(model)
 
+
+def _apply_masks_model(model, spec, tta_plan=()):
+    # Masks (batch, stems, (f s), frames) for STFT chunks (batch, (f s), frames, 2). TTA variants go through the
+    # same forward call as in _apply_model. Inverting the polarity of the input keeps the mask the same
+    if len(tta_plan) == 0:
+        return model.forward_masks(spec)
+    variants = [spec]
+    for name in tta_plan:
+        if name == 'channel_inverse':
+            variants.append(_flip_spec_channels(spec.movedim(-1, 0), model.audio_channels).movedim(0, -1))
+        elif name == 'polarity_inverse':
+            variants.append(-spec)
+    x = model.forward_masks(torch.cat(variants, dim=0))
+    x = x.reshape((len(variants), spec.shape[0]) + x.shape[1:])
+    out = x[0]
+    for i, name in enumerate(tta_plan, 1):
+        if name == 'channel_inverse':
+            out = out + _flip_spec_channels(x[i], model.audio_channels)
+        elif name == 'polarity_inverse':
+            out = out + x[i]
+    return out / len(variants)
+
+
+def demix_spectral(config, model, mix, device, use_tta: bool = False, pbar=False, profiler=None, track=None,
+                   oom_recovery: bool = False) -> Dict[str, NDArray]:
+    """
+    demix for roformers in the STFT domain. The track gets one STFT, chunks and their overlap are taken
+    on STFT frames (chunk_size // hop_length + 1 frames, as the model sees a chunk), masks of the chunks
+    are overlap-added and every stem gets one iSTFT. Compared to demix, every sample is transformed
+    once instead of num_overlap times and there is no crossfade of separated audio. Chunk batches are
+    split over device_ids of a DataParallel model; with oom_recovery they are halved on out of memory,
+    but unlike demix, single chunks are not run as shorter pieces.
+    """
+    spectral_model = _get_spectral_model(model)
+    masks_model = _get_masks_model(model)
+    instruments = prefer_target_instrument(config)
+    mix = torch.as_tensor(mix, dtype=torch.float32)
+    length = mix.shape[-1]
+    hop_length = spectral_model.stft_kwargs['hop_length']
+    chunk_frames = config.audio.chunk_size // hop_length + 1
+    step = max(chunk_frames // config.inference.num_overlap, 1)
+    fade_size = chunk_frames // 10
+    tta_plan = get_tta_plan(config, use_tta)
+    batch_size = max(1, config.inference.batch_size // (len(tta_plan) + 1))
+
+    # Pad the end of the track, so the last chunk is complete
+    starts = torch.arange(0, -(-length // hop_length) + 1, step, device=device)
+    total_frames = int(starts[-1]) + chunk_frames
+    pad = (total_frames - 1) * hop_length - length
+    mix = nn.functional.pad(mix, (0, pad), mode='reflect' if pad < length else 'constant')
+    windowingArray = _getWindowingArray(chunk_frames, fade_size).to(device)
+
+    progress_bar = tqdm(total=length, desc="Processing audio chunks", leave=False) if pbar else None
     with torch.cuda.amp.autocast(enabled=config.training.use_amp):
         with torch.inference_mode():
-            req_shape = (S, ) + tuple(mix.shape)
-            result = torch.zeros(req_shape, dtype=torch.float32)
-            counter = torch.zeros(req_shape, dtype=torch.float32)
-            i = 0
-            batch_data = []
-            batch_locations = []
-            progress_bar = tqdm(total=mix.shape[1], desc="Processing audio chunks", leave=False) if pbar else None
-
-            while i < mix.shape[1]:
-                # print(i, i + C, mix.shape[1])
-                part = mix[:, i:i + C].to(device)
-                length = part.shape[-1]
-                if length < C:
-                    part = nn.functional.pad(input=part, pad=(0, C - length, 0, 0), mode='constant', value=0)
-                batch_data.append(part)
-                batch_locations.append((i, length))
-                i += step
-
-
-                if len(batch_data) >= batch_size or (i >= mix.shape[1]):
-                    arr = torch.stack(batch_data, dim=0)
-                    x = model(arr)
-                    for j in range(len(batch_locations)):
-                        start, l = batch_locations[j]
-                        result[..., start:start+l] += x[j][..., :l].cpu()
-                        counter[..., start:start+l] += 1.
-                    batch_data = []
-                    batch_locations = []
+            with profile_stage(profiler, 'stft', track):
+                spec = spectral_model.stft(mix[None].to(device))[0]
+                freqs = spec.shape[0]
+                envelope = _get_normalization_envelope(windowingArray, starts, total_frames, fade_size, step, batch_size)
+                # Real and imaginary parts of masks are accumulated as separate rows
+                result = torch.zeros((len(instruments), freqs * 2, total_frames), dtype=torch.float32, device=device)
 
+            for i in range(0, len(starts), batch_size):
+                batch_starts = starts[i:i + batch_size]
+                with profile_stage(profiler, 'chunking', track):
+                    arr = torch.stack([spec[:, start:start + chunk_frames] for start in batch_starts.tolist()])
+                with profile_model(profiler, [track]):
+                    if oom_recovery:
+                        x = _apply_batches_safe(model, arr, lambda part: _apply_masks_model(masks_model, part, tta_plan=tta_plan))
+                    else:
+                        x = _apply_masks_model(masks_model, arr, tta_plan=tta_plan)
+                with profile_stage(profiler, 'overlap_add', track):
+                    x = torch.view_as_real(x).transpose(-1, -2).reshape(len(batch_starts), len(instruments), freqs * 2, chunk_frames)
+                    windows = _get_chunk_windows(windowingArray, batch_starts, total_frames, fade_size)
+                    _overlap_add(result, x * windows[:, None, None, :], batch_starts, step)
                 if progress_bar:
-                    progress_bar.update(step)
+                    progress_bar.update(min(step * hop_length * len(batch_starts), progress_bar.total - progress_bar.n))
 
+            with profile_stage(profiler, 'istft', track):
+                masks = result / envelope
+                masks = torch.view_as_complex(masks.reshape(len(instruments), freqs, 2, total_frames).transpose(-1, -2).contiguous())
+                stems_spec = torch.view_as_complex(spec.float().contiguous()) * masks
+                estimated_sources = spectral_model.istft(stems_spec[None], length=mix.shape[-1])[0, ..., :length]
+                estimated_sources = estimated_sources.float().cpu().numpy()
+    if progress_bar:
+        progress_bar.close()
+    np.nan_to_num(estimated_sources, copy=False, nan=0.0)
+    return {k: v for k, v in zip(instruments, estimated_sources)}
+
+
+def demix_tracks(config, model, tracks, device, model_type: str = None, use_tta: bool = False, pbar=False, profiler=None,
+                 oom_recovery: bool = False):
+    """
+    Separates several tracks with chunk batches pooled across them. tracks yields (track_id, mix)
+    with mix of shape (channels, length), results are yielded as (track_id, {instrument: (channels, length)})
+    in the same order. Every track gets the same output as with demix, but instead of running its last
+    batch under-filled, the batch is completed with chunks of the next tracks. Tracks are taken from
+    tracks only when the queued chunks can't fill a batch anymore. profiler (profiler.StageProfiler)
+    records chunking, model, overlap-add and finishing stages. With oom_recovery, batches which run out
+    of memory are split (see _apply_model_safe).
+    """
+    if use_spectral_inference(config, model):
+        # Chunks are taken from the spectrogram of each track, they are not pooled across tracks
+        for track_id, mix in tracks:
+            yield track_id, demix_spectral(config, model, mix, device, use_tta=use_tta, pbar=pbar, profiler=profiler, track=track_id,
+                                           oom_recovery=oom_recovery)
+        return
+    instruments, C, step, fade_size, border, windowingArray, reflect = _get_demix_params(config, model_type, device)
+    batch_size = config.inference.batch_size
+    tta_plan = get_tta_plan(config, use_tta)
+    # Every chunk is run once per TTA variant in the same batch, keep the model batch close to batch_size
+    batch_size = max(1, batch_size // (len(tta_plan) + 1))
+    passthrough = _has_silence_passthrough(config, instruments)
+    hop_length = _get_hop_length(config)
+
+    def add_chunks(state, x, starts):
+        windows = _get_chunk_windows(windowingArray, starts, state['length'], fade_size)
+        _overlap_add(state['result'], x * windows[:, None, None, :], starts, step)
+
+    def start_track(track_id, mix):
+        mix = torch.as_tensor(mix, dtype=torch.float32)
+        state = {'id': track_id, 'length_init': mix.shape[-1]}
+        # Do pad from the beginning and end to account floating window results better
+        state['padded'] = state['length_init'] > 2 * border and border > 0
+        if state['padded']:
+            mix = nn.functional.pad(mix, (border, border), mode='reflect')
+        state['mix'] = mix
+        state['length'] = mix.shape[-1]
+        starts = torch.arange(0, state['length'], step, device=device)
+        state['envelope'] = _get_normalization_envelope(windowingArray, starts, state['length'], fade_size, step, batch_size)
+        # Accumulator spans the last (padded) chunk completely, the tail is cut off at the end
+        state['result'] = torch.zeros((len(instruments), mix.shape[0], len(state['envelope'])), dtype=torch.float32, device=device)
+
+        silent = _get_silent_chunks(config, mix, starts, C, step)
+        if silent is not None:
+            if passthrough:
+                silent_starts = starts[silent]
+                for i in range(0, len(silent_starts), batch_size):
+                    batch_starts = silent_starts[i:i + batch_size]
+                    arr = torch.stack([_pad_chunk(mix[:, start:start + C].to(device), C, reflect=reflect) for start in batch_starts.tolist()])
+                    add_chunks(state, _get_silent_output(config, arr, instruments), batch_starts)
             if progress_bar:
-                progress_bar.close()
+                progress_bar.update(step * int(silent.sum()))
+            starts = starts[~silent]
+        state['remaining'] = len(starts)
+        return state, starts.tolist()
 
-            estimated_sources = result / counter
-            estimated_sources = estimated_sources.cpu().numpy()
-            np.nan_to_num(estimated_sources, copy=False, nan=0.0)
+    def finish_track(state):
+        length = state['length']
+        estimated_sources = state['result'][..., :length] / state['envelope'][:length]
+        estimated_sources = estimated_sources.cpu().numpy()
+        np.nan_to_num(estimated_sources, copy=False, nan=0.0)
+        if state['padded']:
+            # Remove pad
+            estimated_sources = estimated_sources[..., border:-border]
+        return {k: v for k, v in zip(instruments, estimated_sources)}
 
-    if S > 1:
-        return {k: v for k, v in zip(config.training.instruments, estimated_sources)}
-    else:
+    progress_bar = tqdm(total=0, desc="Processing audio chunks", leave=False) if pbar else None
+    tracks = iter(tracks)
+    pending = deque()  # (track state, chunk start) not run yet
+    active = deque()  # tracks not yielded yet, in order
+    ended = False
+    while True:
+        # Autocast and inference mode are not kept across yields, they would leak into the caller
+        with torch.cuda.amp.autocast(enabled=config.training.use_amp):
+            with torch.inference_mode():
+                while not ended and len(pending) < batch_size:
+                    try:
+                        track_id, mix = next(tracks)
+                    except StopIteration:
+                        ended = True
+                        break
+                    if progress_bar:
+                        progress_bar.total += mix.shape[-1]
+                        progress_bar.refresh()
+                    with profile_stage(profiler, 'chunking', track_id):
+                        state, starts = start_track(track_id, mix)
+                    active.append(state)
+                    pending.extend((state, start) for start in starts)
+
+                if len(pending) > 0:
+                    batch = [pending.popleft() for _ in range(min(batch_size, len(pending)))]
+                    batch_tracks = list(dict.fromkeys(state['id'] for state, _ in batch))
+                    with profile_stage(profiler, 'chunking', batch_tracks):
+                        arr = torch.stack([_pad_chunk(state['mix'][:, start:start + C].to(device), C, reflect=reflect) for state, start in batch])
+                    with profile_model(profiler, batch_tracks):
+                        x = _apply_model_safe(model, arr, len(instruments), tta_plan=tta_plan, hop_length=hop_length,
+                                              oom_recovery=oom_recovery)
+
+                    # Route outputs back to the accumulator of their track
+                    with profile_stage(profiler, 'overlap_add', batch_tracks):
+                        i = 0
+                        while i < len(batch):
+                            state = batch[i][0]
+                            j = i + 1
+                            while j < len(batch) and batch[j][0] is state:
+                                j += 1
+                            starts = torch.tensor([start for _, start in batch[i:j]], device=device)
+                            add_chunks(state, x[i:j], starts)
+                            state['remaining'] -= j - i
+                            i = j
+                    if progress_bar:
+                        progress_bar.update(step * len(batch))
+
+                finished = []
+                while len(active) > 0 and active[0]['remaining'] == 0:
+                    state = active.popleft()
+                    with profile_stage(profiler, 'finish', state['id']):
+                        finished.append((state['id'], finish_track(state)))
+
+        for track_id, estimated_sources in finished:
+            yield track_id, estimated_sources
+        if ended and len(pending) == 0 and len(active) == 0:
+            break
+
+    if progress_bar:
+        progress_bar.close()
+
+
+def demix_track(config, model, mix, device, pbar=False, use_tta=False, oom_recovery=False):
+    for _, estimated_sources in demix_tracks(config, model, [(0, mix)], device, use_tta=use_tta, pbar=pbar, oom_recovery=oom_recovery):
         return estimated_sources
 
 
+def demix_track_demucs(config, model, mix, device, pbar=False, use_tta=False, oom_recovery=False):
+    for _, estimated_sources in demix_tracks(config, model, [(0, mix)], device, model_type='htdemucs', use_tta=use_tta, pbar=pbar,
+                                             oom_recovery=oom_recovery):
+        if len(config.training.instruments) > 1:
+            return estimated_sources
+        else:
+            return np.stack(list(estimated_sources.values()))
+
+
 def sdr(references, estimates):
     # compute SDR for one song
     delta = 1e-7  # avoid numerical errors
@@ -400,12 +874,153 @@ def get_metrics(
     return result
 
 
-def demix(config, model, mix: NDArray, device, pbar=False, model_type: str = None) -> Dict[str, NDArray]:
+def demix(config, model, mix: NDArray, device, pbar=False, model_type: str = None, use_tta: bool = False,
+          oom_recovery: bool = False) -> Dict[str, NDArray]:
     mix = torch.tensor(mix, dtype=torch.float32)
     if model_type == 'htdemucs':
-        return demix_track_demucs(config, model, mix, device, pbar=pbar)
+        return demix_track_demucs(config, model, mix, device, pbar=pbar, use_tta=use_tta, oom_recovery=oom_recovery)
     else:
-        return demix_track(config, model, mix, device, pbar=pbar)
+        return demix_track(config, model, mix, device, pbar=pbar, use_tta=use_tta, oom_recovery=oom_recovery)
+
+
+def demix_stream(config, model, chunk_iter, device, model_type: str = None, use_tta: bool = False, profiler=None, track=None,
+                 oom_recovery: bool = False):
+    """
+    Streaming version of demix. Consumes audio blocks of shape (channels, length) from chunk_iter
+    and yields dicts {instrument: (channels, length)} as soon as every chunk overlapping a region
+    was processed. Concatenated outputs match demix on the whole track, while memory stays
+    bounded by chunk_size * num_overlap instead of the track length. Stages are recorded as
+    track in profiler (profiler.StageProfiler) if given. oom_recovery is passed to _apply_model_safe.
+    """
+    if use_spectral_inference(config, model):
+        # The spectrogram is taken from the whole track, so it is read first
+        blocks = [torch.as_tensor(block, dtype=torch.float32) for block in chunk_iter]
+        if len(blocks) > 0:
+            yield demix_spectral(config, model, torch.cat(blocks, dim=-1), device, use_tta=use_tta, profiler=profiler, track=track,
+                                 oom_recovery=oom_recovery)
+        return
+    instruments, C, step, fade_size, border, windowingArray, reflect = _get_demix_params(config, model_type, device)
+    batch_size = config.inference.batch_size
+    tta_plan = get_tta_plan(config, use_tta)
+    batch_size = max(1, batch_size // (len(tta_plan) + 1))
+    hop_length = _get_hop_length(config)
+    chunk_iter = iter(chunk_iter)
+
+    # Reflect padding (as in demix_track) is only used for tracks longer than 2 * border,
+    # so read enough audio first to know if the track qualifies
+    blocks = []
+    buffered = 0
+    ended = False
+    while buffered <= 2 * border or buffered == 0:
+        try:
+            block = torch.as_tensor(next(chunk_iter), dtype=torch.float32)
+        except StopIteration:
+            ended = True
+            break
+        blocks.append(block)
+        buffered += block.shape[-1]
+    if buffered == 0:
+        return
+    buffer = torch.cat(blocks, dim=-1)
+    if ended and border > 0:
+        # Short track: nothing to stream
+        for _, estimated_sources in demix_tracks(config, model, [(track, buffer)], device, model_type=model_type, use_tta=use_tta, profiler=profiler,
+                                                 oom_recovery=oom_recovery):
+            yield estimated_sources
+        return
+    if border > 0:
+        buffer = torch.cat([nn.functional.pad(buffer[:, :border + 1], (border, 0), mode='reflect')[:, :border], buffer], dim=-1)
+
+    # Everything below is in padded coordinates. buffer holds input from buffer_pos,
+    # result/envelope hold the overlap-add tail starting at next_start
+    buffer_pos = 0
+    next_start = 0
+    padded_length = buffer.shape[-1] if ended else None
+    result = None
+    envelope = None
+    while True:
+        # Read until a full batch of chunks is ready (the chunk after it must have started too,
+        # so chunks touching the end of the track are known when they are processed)
+        while not ended and buffer_pos + buffer.shape[-1] <= next_start + (batch_size - 1) * step + C:
+            try:
+                block = torch.as_tensor(next(chunk_iter), dtype=torch.float32)
+            except StopIteration:
+                ended = True
+                if border > 0:
+                    tail = nn.functional.pad(buffer[:, -(border + 1):], (0, border), mode='reflect')[:, -border:]
+                    buffer = torch.cat([buffer, tail], dim=-1)
+                padded_length = buffer_pos + buffer.shape[-1]
+                break
+            buffer = torch.cat([buffer, block], dim=-1)
+
+        available = buffer_pos + buffer.shape[-1]
+        batch_starts = []
+        start = next_start
+        while len(batch_starts) < batch_size and (start + C < available or (ended and start < available)):
+            batch_starts.append(start)
+            start += step
+        if len(batch_starts) == 0:
+            break
+
+        with torch.cuda.amp.autocast(enabled=config.training.use_amp):
+            with torch.inference_mode():
+                with profile_stage(profiler, 'chunking', track):
+                    batch_data = []
+                    for start in batch_starts:
+                        part = buffer[:, start - buffer_pos:start - buffer_pos + C].to(device)
+                        batch_data.append(_pad_chunk(part, C, reflect=reflect))
+                    arr = torch.stack(batch_data, dim=0)
+                silence_level = _get_silence_level(config)
+                with profile_model(profiler, [track]):
+                    if silence_level is None:
+                        x = _apply_model_safe(model, arr, len(instruments), tta_plan=tta_plan, hop_length=hop_length,
+                                              oom_recovery=oom_recovery)
+                    else:
+                        # Chunks can't be classified ahead of batching here, silent ones are masked out of the batch
+                        silent = arr.abs().amax(dim=(1, 2)) < silence_level
+                        x = _get_silent_output(config, arr, instruments)
+                        if not silent.all():
+                            x[~silent] = _apply_model_safe(model, arr[~silent], len(instruments), tta_plan=tta_plan, hop_length=hop_length,
+                                                           oom_recovery=oom_recovery).to(x.dtype)
+
+                with profile_stage(profiler, 'overlap_add', track):
+                    # Chunk positions relative to the accumulator, which starts at next_start
+                    rel_starts = torch.tensor(batch_starts, device=device) - next_start
+                    total_length = padded_length if ended else float('inf')
+                    windows = _get_chunk_windows(windowingArray, rel_starts + next_start, total_length, fade_size)
+
+                    acc_length = batch_starts[-1] + C - next_start
+                    new_result = torch.zeros((len(instruments), buffer.shape[0], acc_length), dtype=torch.float32, device=device)
+                    new_envelope = torch.zeros((1, 1, acc_length), dtype=torch.float32, device=device)
+                    if result is not None:
+                        new_result[..., :result.shape[-1]] = result
+                        new_envelope[..., :envelope.shape[-1]] = envelope
+                    _overlap_add(new_result, x * windows[:, None, None, :], rel_starts, step)
+                    _overlap_add(new_envelope, windows[:, None, None, :], rel_starts, step)
+
+                    # Positions before the next chunk start will not receive any more contributions
+                    finalized_end = batch_starts[-1] + step
+                    if ended and finalized_end >= padded_length:
+                        finalized_end = padded_length
+                    n = finalized_end - next_start
+                    estimated_sources = new_result[..., :n] / new_envelope[0, 0, :n]
+                    estimated_sources = estimated_sources.cpu().numpy()
+                    np.nan_to_num(estimated_sources, copy=False, nan=0.0)
+                    result = new_result[..., n:].clone()
+                    envelope = new_envelope[..., n:].clone()
+
+        # Remove pad
+        out_start = max(next_start, border)
+        out_end = finalized_end if padded_length is None else min(finalized_end, padded_length - border)
+        if out_end > out_start:
+            estimated_sources = estimated_sources[..., out_start - next_start:out_end - next_start]
+            yield {k: v for k, v in zip(instruments, estimated_sources)}
+
+        next_start = finalized_end
+        if ended and next_start >= padded_length:
+            break
+        buffer = buffer[:, next_start - buffer_pos:]
+        buffer_pos = next_start
 
 
 def prefer_target_instrument(config: ConfigDict) -> List[str]:
@@ -413,3 +1028,69 @@ def prefer_target_instrument(config: ConfigDict) -> List[str]:
         return [config.training.target_instrument]
     else:
         return config.training.instruments
+
+
+def is_oom_error(e) -> bool:
+    # Allocation failure on GPU (torch.cuda.OutOfMemoryError, MPS) or CPU
+    message = str(e).lower()
+    return isinstance(e, RuntimeError) and any(text in message for text in ['out of memory', "can't allocate memory", 'not enough memory'])
+
+
+def measure_peak_rss(stop, result):
+    # Polls process RSS until stop is set, result[0] keeps the maximum. CPU allocations have no
+    # peak counter like torch.cuda.max_memory_allocated
+    import psutil
+    process = psutil.Process()
+    while not stop.is_set():
+        result[0] = max(result[0], process.memory_info().rss)
+        time.sleep(0.01)
+
+
+# Written by autotune.py, read by inference.py
+TUNING_PROFILES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autotune_profiles.json')
+
+
+def get_device_name(device) -> str:
+    device = str(device)
+    if device.startswith('cuda'):
+        return torch.cuda.get_device_name(torch.device(device))
+    if device == 'cpu':
+        return 'cpu:{}'.format(os.cpu_count())
+    return device
+
+
+def get_tuning_key(model_type, config_path, device) -> str:
+    # Profiles depend on the config contents (chunk size, model size), not on the weights
+    import hashlib
+    with open(config_path, 'rb') as f:
+        config_hash = hashlib.sha1(f.read()).hexdigest()[:16]
+    return '{}|{}|{}'.format(model_type, config_hash, get_device_name(device))
+
+
+def load_tuning_profiles(path=TUNING_PROFILES_PATH) -> Dict:
+    import json
+    if not os.path.isfile(path):
+        return dict()
+    with open(path) as f:
+        return json.load(f)
+
+
+def apply_tuning_profile(model_type, config_path, config, device, path=TUNING_PROFILES_PATH):
+    """
+    Sets config.inference.batch_size (and CPU threads) from the autotune.py profile of this
+    model config and device, if there is one. The batch size measured for the closest
+    num_overlap is used. Returns the profile or None.
+    """
+    profile = load_tuning_profiles(path).get(get_tuning_key(model_type, config_path, device))
+    if profile is None:
+        return None
+    overlaps = sorted(int(overlap) for overlap in profile['batch_size'])
+    num_overlap = config.inference.num_overlap
+    overlap = min(overlaps, key=lambda x: abs(x - num_overlap))
+    batch_size = profile['batch_size'][str(overlap)]
+    print('Use autotune profile: batch_size {} (config: {})'.format(batch_size, config.inference.batch_size))
+    config.inference.batch_size = batch_size
+    if str(device) == 'cpu' and profile.get('num_threads'):
+        print('Use autotune profile: {} CPU threads'.format(profile['num_threads']))
+        torch.set_num_threads(profile['num_threads'])
+    return profile
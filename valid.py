@@ -17,7 +17,7 @@ import multiprocessing
 import warnings
 warnings.filterwarnings("ignore")
 
-from utils import demix, get_metrics, get_model_from_config, prefer_target_instrument
+from utils import demix, get_metrics, get_model_from_config, prefer_target_instrument, load_checkpoint
 
 def proc_list_of_files(
     mixture_paths,
@@ -77,30 +77,7 @@ def proc_list_of_files(
                 std = mono.std()
                 mix = (mix - mean) / std
 
-        if use_tta:
-            # orig, channel inverse, polarity inverse
-            track_proc_list = [mix.copy(), mix[::-1].copy(), -1. * mix.copy()]
-        else:
-            track_proc_list = [mix.copy()]
-
-        full_result = []
-        for mix in track_proc_list:
-            waveforms = demix(config, model, mix, device, model_type=args.model_type)
-            full_result.append(waveforms)
-
-        # Average all values in single dict
-        waveforms = full_result[0]
-        for i in range(1, len(full_result)):
-            d = full_result[i]
-            for el in d:
-                if i == 2:
-                    waveforms[el] += -1.0 * d[el]
-                elif i == 1:
-                    waveforms[el] += d[el][::-1].copy()
-                else:
-                    waveforms[el] += d[el]
-        for el in waveforms:
-            waveforms[el] = waveforms[el] / len(full_result)
+        waveforms = demix(config, model, mix, device, model_type=args.model_type, use_tta=use_tta)
 
         pbar_dict = {}
         for instr in instruments:
@@ -352,7 +329,7 @@ def check_validation(args):
     parser.add_argument("--num_workers", type=int, default=0, help="dataloader num_workers")
     parser.add_argument("--pin_memory", type=bool, default=False, help="dataloader pin_memory")
     parser.add_argument("--extension", type=str, default='wav', help="Choose extension for validation")
-    parser.add_argument("--use_tta", action='store_true', help="Flag adds test time augmentation during inference (polarity and channel inverse). While this triples the runtime, it reduces noise and slightly improves prediction quality.")
+    parser.add_argument("--use_tta", action='store_true', help="Flag adds test time augmentation during inference (polarity and channel inverse). While this triples the runtime, it reduces noise and slightly improves prediction quality. Variants can be selected with tta_plan in the inference section of config (see tta_calibration.py).")
     parser.add_argument("--metrics", nargs='+', type=str, default=["sdr"], choices=['sdr', 'l1_freq', 'si_sdr', 'log_wmse', 'aura_stft', 'aura_mrstft', 'bleedless', 'fullness'], help='List of metrics to use.')
     if args is None:
         args = parser.parse_args()
@@ -365,15 +342,7 @@ def check_validation(args):
     model, config = get_model_from_config(args.model_type, args.config_path)
     if args.start_check_point != '':
         print('Start from checkpoint: {}'.format(args.start_check_point))
-        state_dict = torch.load(args.start_check_point)
-        if args.model_type in ['htdemucs', 'apollo']:
-            # Fix for htdemucs pretrained models
-            if 'state' in state_dict:
-                state_dict = state_dict['state']
-            # Fix for apollo pretrained models
-            if 'state_dict' in state_dict:
-                state_dict = state_dict['state_dict']
-        model.load_state_dict(state_dict)
+        load_checkpoint(model, args.model_type, args.start_check_point)
 
     print("Instruments: {}".format(config.training.instruments))
 